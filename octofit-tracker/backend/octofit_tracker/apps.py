@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.core import checks
+
+
+class OctofitTrackerConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'octofit_tracker'
+
+    def ready(self):
+        from . import instrumentation, mongo, response_cache, signals  # noqa: F401
+        instrumentation.install()
+        checks.register(response_cache.check_shared_cache)
+        checks.register(mongo.check_motor)
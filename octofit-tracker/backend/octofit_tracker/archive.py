@@ -0,0 +1,394 @@
+"""
+Cold storage of old activities in compressed columnar files.
+
+``manage.py archive_activities`` moves activities older than
+``OCTOFIT_ARCHIVE_AFTER_DAYS`` out of MongoDB into zstd-compressed Parquet
+files under ``OCTOFIT_ARCHIVE_DIR``, one directory per month:
+``activities/month=2025-03/part-<ObjectId>.parquet``. The hot collection
+keeps only recent activities, so its documents and indexes stay in RAM.
+
+Native activity reads (lists, filtered and per-user lists, exports) query
+both tiers. The Mongo filter of the query is translated into a pyarrow
+expression. Archived rows are read month by month in date order, so a
+page sorted by date stops at the first months that fill it. The rows are
+then merged into the hot results.
+
+Text searches match archived rows on the fields of the collection's text
+index, each quoted phrase as a case-insensitive substring; searches ranked
+by relevance cover the hot collection only.
+
+Totals, ranks, rollups and statistics are materialized, so archiving
+changes none of them, and their rebuilds read the archive too. Archived
+activities are not served by id and are only rewritten by rescoring and by
+user renames and email changes, a month file at a time.
+
+pyarrow is optional: without it nothing is archived and reads stay hot-only.
+"""
+import operator
+import os
+import re
+import shutil
+from datetime import datetime, timedelta, timezone
+from functools import reduce
+
+from bson import ObjectId
+from django.conf import settings
+
+from . import changefeed, response_cache
+from .mongo import get_db
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+MONTH_PREFIX = 'month='
+COMPRESSION = 'zstd'
+ROW_GROUP_SIZE = 64 * 1024
+CHUNK_SIZE = 5000
+
+_COMPARISONS = {
+    '$eq': operator.eq, '$ne': operator.ne,
+    '$lt': operator.lt, '$lte': operator.le,
+    '$gt': operator.gt, '$gte': operator.ge,
+}
+
+
+class UnsupportedFilter(ValueError):
+    """A Mongo filter the archive cannot evaluate"""
+
+
+def _naive_utc(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _value(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return _naive_utc(value)
+    return value
+
+
+def _condition(field, condition):
+    if not (isinstance(condition, dict) and condition and all(op.startswith('$') for op in condition)):
+        return field.is_null() if condition is None else field == _value(condition)
+    terms = []
+    for op, value in condition.items():
+        if op in _COMPARISONS:
+            terms.append(_COMPARISONS[op](field, _value(value)))
+        elif op == '$in':
+            terms.append(field.isin([_value(item) for item in value]))
+        elif op == '$regex':
+            ignore_case = 'i' in condition.get('$options', '')
+            terms.append(pc.match_substring_regex(field, value, ignore_case=ignore_case))
+        elif op != '$options':
+            raise UnsupportedFilter(op)
+    return reduce(operator.and_, terms)
+
+
+def _text_condition(search, text_fields):
+    """Every quoted phrase of a ``$text`` search, or else any of its words,
+    as a case-insensitive substring of one of ``text_fields``"""
+    phrases = re.findall(r'"([^"]*)"', search)
+    words = re.sub(r'"[^"]*"', ' ', search).split()
+
+    def matches(term):
+        return reduce(operator.or_, [
+            pc.match_substring(ds.field(field), term, ignore_case=True) for field in text_fields
+        ])
+
+    if phrases:
+        return reduce(operator.and_, map(matches, phrases))
+    return reduce(operator.or_, map(matches, words)) if words else ds.scalar(False)
+
+
+def expression(spec, text_fields=()):
+    """Translate a Mongo filter into a pyarrow dataset expression; None
+    matches everything. ``$text`` searches ``text_fields``. Raises
+    UnsupportedFilter for operators other than comparisons, ``$in``,
+    ``$regex``, ``$and``, ``$or`` and ``$text``."""
+    terms = []
+    for key, value in spec.items():
+        if key == '$and':
+            terms.extend(term for term in (expression(clause, text_fields) for clause in value) if term is not None)
+        elif key == '$or':
+            alternatives = [expression(clause, text_fields) for clause in value]
+            if all(alternative is not None for alternative in alternatives):
+                terms.append(reduce(operator.or_, alternatives))
+        elif key == '$text' and text_fields:
+            terms.append(_text_condition(value['$search'], text_fields))
+        elif key.startswith('$'):
+            raise UnsupportedFilter(key)
+        else:
+            terms.append(_condition(ds.field(key), value))
+    return reduce(operator.and_, terms) if terms else None
+
+
+def month_start(date):
+    return datetime(date.year, date.month, 1)
+
+
+def next_month(date):
+    return datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+
+class Archive:
+    """Monthly Parquet partitions of one collection's old documents"""
+
+    def __init__(self, collection, columns, date_field, text_fields=()):
+        self.collection = collection
+        # (name, pyarrow type alias); _id is the ObjectId's hex string, which
+        # sorts like the ObjectId
+        self.columns = columns
+        self.date_field = date_field
+        # Columns ``$text`` searches match, those of the collection's text index
+        self.text_fields = text_fields
+        self._datasets = {}
+
+    @property
+    def root(self):
+        return os.path.join(settings.OCTOFIT_ARCHIVE_DIR, self.collection)
+
+    def schema(self):
+        return pa.schema([(name, pa.type_for_alias(alias)) for name, alias in self.columns])
+
+    def months(self):
+        """Archived months in ascending order, e.g. ``['2025-01', '2025-02']``"""
+        if pa is None:
+            return []
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(name[len(MONTH_PREFIX):] for name in names if name.startswith(MONTH_PREFIX))
+
+    def month_path(self, month):
+        return os.path.join(self.root, MONTH_PREFIX + month)
+
+    def files(self, month):
+        path = self.month_path(month)
+        return tuple(sorted(
+            os.path.join(path, name) for name in os.listdir(path) if name.endswith('.parquet')
+        ))
+
+    def month_dataset(self, month):
+        """The month's files as a dataset, reused until files are added"""
+        files = self.files(month)
+        cached = self._datasets.get(month)
+        if cached is None or cached[0] != files:
+            cached = self._datasets[month] = (files, ds.dataset(list(files), schema=self.schema(), format='parquet'))
+        return cached[1]
+
+    def document(self, row):
+        row['_id'] = ObjectId(row['_id'])
+        return row
+
+    def row(self, document):
+        row = {name: document.get(name) for name, _ in self.columns}
+        row['_id'] = str(row['_id'])
+        if row[self.date_field] is not None:
+            row[self.date_field] = _naive_utc(row[self.date_field])
+        return row
+
+    def read_columns(self, projection, sort):
+        names = [name for name, _ in self.columns]
+        if projection is None:
+            return names
+        wanted = {'_id', *projection, *(field for field, _ in sort or [])}
+        return [name for name in names if name in wanted]
+
+    def scan(self, spec, projection=None, sort=None, limit=0):
+        """Yield archived documents matching the Mongo filter ``spec``, in
+        pymongo ``sort`` order and at most ``limit`` of them"""
+        condition = expression(spec, self.text_fields)
+        columns = self.read_columns(projection, sort)
+        sort_keys = [(field, 'descending' if direction < 0 else 'ascending') for field, direction in sort or []]
+        months = self.months()
+        if sort and sort[0][0] == self.date_field:
+            # Months hold disjoint date ranges: read them in order and stop
+            # once ``limit`` rows are in
+            groups = [[month] for month in (reversed(months) if sort[0][1] < 0 else months)]
+        else:
+            groups = [months] if months else []
+        remaining = limit
+        for group in groups:
+            datasets = [self.month_dataset(month) for month in group]
+            dataset = datasets[0] if len(datasets) == 1 else ds.dataset(datasets)
+            table = dataset.to_table(columns=columns, filter=condition)
+            if sort_keys and remaining and table.num_rows > remaining:
+                table = table.take(pc.select_k_unstable(table, k=remaining, sort_keys=sort_keys))
+            if sort_keys:
+                table = table.sort_by(sort_keys)
+            if remaining:
+                table = table.slice(0, remaining)
+            for row in table.to_pylist():
+                yield self.document(row)
+            if limit:
+                remaining -= table.num_rows
+                if remaining <= 0:
+                    return
+
+    def find(self, spec, projection=None, sort=None, limit=0):
+        return list(self.scan(spec, projection, sort, limit))
+
+    def count(self, spec):
+        condition = expression(spec, self.text_fields)
+        return sum(self.month_dataset(month).count_rows(filter=condition) for month in self.months())
+
+    def archived_ids(self, month):
+        if month not in self.months():
+            return set()
+        table = self.month_dataset(month).to_table(columns=['_id'])
+        return {ObjectId(value) for value in table.column('_id').to_pylist()}
+
+    def move(self, db, month, spec):
+        """Move the documents matching ``spec``, all dated in ``month``, from
+        the collection into a new file of the month; returns how many moved.
+
+        Documents already in the month's files (a previous run stopped
+        between writing and deleting) are deleted without being written
+        again.
+        """
+        archived = self.archived_ids(month)
+        target = os.path.join(self.month_path(month), f'part-{ObjectId()}.parquet')
+        cursor = db[self.collection].find(spec, dict.fromkeys((name for name, _ in self.columns), 1))
+        cursor = cursor.sort([(self.date_field, 1), ('_id', 1)]).batch_size(CHUNK_SIZE)
+        ids = []
+        writer = None
+        batch = []
+        try:
+            for document in cursor:
+                ids.append(document['_id'])
+                if document['_id'] not in archived:
+                    batch.append(self.row(document))
+                if len(batch) == ROW_GROUP_SIZE:
+                    writer = self.write_batch(writer, target, batch)
+                    batch = []
+            if batch:
+                writer = self.write_batch(writer, target, batch)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is not None:
+            os.replace(target + '.tmp', target)
+
+        # Shadows first, so a derived-data worker sees the deletes as
+        # already applied rather than taking the activities back out of totals
+        shadow = db[changefeed.SHADOWS[self.collection]]
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start + CHUNK_SIZE]
+            shadow.delete_many({'_id': {'$in': chunk}})
+            db[self.collection].delete_many({'_id': {'$in': chunk}})
+        return len(ids)
+
+    def group_counts(self, columns):
+        """Return ``{tuple of column values: archived rows}`` over every month"""
+        counts = {}
+        for month in self.months():
+            table = self.month_dataset(month).to_table(columns=columns)
+            for row in table.group_by(columns).aggregate([([], 'count_all')]).to_pylist():
+                key = tuple(row[name] for name in columns)
+                counts[key] = counts.get(key, 0) + row['count_all']
+        return counts
+
+    def update_rows(self, key, changes):
+        """Set ``changes[value]``, a dict of column values, on the archived
+        rows whose ``key`` column holds ``value``; only months holding such
+        rows are rewritten. Returns the number of rows changed."""
+        if not changes or not self.months():
+            return 0
+        condition = ds.field(key).isin(list(changes))
+        changed = 0
+        for month in self.months():
+            dataset = self.month_dataset(month)
+            if not dataset.count_rows(filter=condition):
+                continue
+            columns = dataset.to_table().to_pydict()
+            for index, value in enumerate(columns[key]):
+                if value in changes:
+                    for name, new in changes[value].items():
+                        columns[name][index] = new
+                    changed += 1
+            self.rewrite_month(month, pa.Table.from_pydict(columns, schema=self.schema()))
+        return changed
+
+    def rewrite_month(self, month, table):
+        """Replace the month's files with one file holding ``table``.
+
+        The new file is written to a hidden directory which is then swapped
+        in; a swap interrupted half-way is undone by the next call.
+        """
+        path = self.month_path(month)
+        staged = os.path.join(self.root, f'.staged-{month}')
+        replaced = os.path.join(self.root, f'.replaced-{month}')
+        if os.path.isdir(replaced) and not os.path.isdir(path):
+            os.rename(replaced, path)
+        for leftover in (staged, replaced):
+            shutil.rmtree(leftover, ignore_errors=True)
+        os.makedirs(staged)
+        target = os.path.join(staged, f'part-{ObjectId()}.parquet')
+        pq.write_table(table.cast(self.schema()), target, compression=COMPRESSION, row_group_size=ROW_GROUP_SIZE)
+        os.rename(path, replaced)
+        os.rename(staged, path)
+        shutil.rmtree(replaced)
+
+    def write_batch(self, writer, target, rows):
+        if writer is None:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            writer = pq.ParquetWriter(target + '.tmp', self.schema(), compression=COMPRESSION)
+        writer.write_table(pa.Table.from_pylist(rows, schema=self.schema()), row_group_size=ROW_GROUP_SIZE)
+        return writer
+
+
+activities = Archive('activities', [
+    ('_id', 'string'),
+    ('user_email', 'string'),
+    ('user_name', 'string'),
+    ('activity_type', 'string'),
+    ('duration', 'int64'),
+    ('distance', 'double'),
+    ('calories', 'int64'),
+    ('points', 'int64'),
+    ('date', 'timestamp[ms]'),
+    ('notes', 'string'),
+], 'date', text_fields=['user_name', 'activity_type', 'notes'])
+
+ARCHIVES = {activities.collection: activities}
+
+
+def for_collection(collection):
+    """The collection's Archive if it holds anything, else None"""
+    archive = ARCHIVES.get(collection)
+    return archive if archive is not None and archive.months() else None
+
+
+def archive_activities(age_days, db=None, dry_run=False):
+    """Move activities dated more than ``age_days`` ago into the archive, a
+    month at a time; returns ``{month: activities moved}``"""
+    if pa is None:
+        raise ImportError('Archiving needs pyarrow')
+    db = db if db is not None else get_db()
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=age_days)
+    oldest = db['activities'].find_one({'date': {'$lt': cutoff}}, {'date': 1}, sort=[('date', 1)])
+    moved = {}
+    start = month_start(oldest['date']) if oldest is not None else cutoff
+    while start < cutoff:
+        end = next_month(start)
+        spec = {'date': {'$gte': start, '$lt': min(end, cutoff)}}
+        month = start.strftime('%Y-%m')
+        if dry_run:
+            count = db['activities'].count_documents(spec)
+        else:
+            count = activities.move(db, month, spec)
+        if count:
+            moved[month] = count
+        start = end
+    if moved and not dry_run:
+        response_cache.invalidate('activities')
+    return moved
@@ -13,4 +13,12 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'octofit_tracker.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from octofit_tracker.indexes import ensure_indexes_on_startup  # noqa: E402
+from octofit_tracker.live import with_live_feed  # noqa: E402
+
+# /api/leaderboard/stream/ is a long-lived Server-Sent Events response
+application = with_live_feed(django_application)
+
+ensure_indexes_on_startup()
@@ -0,0 +1,133 @@
+"""
+Async read API.
+
+List and detail views for every viewset registered on the router, served
+with Motor so one ASGI worker can keep many reads in flight on a single
+thread. They reuse the viewsets' filter, search and ordering declarations,
+the keyset paginator and the serializers' field representations, so
+``/api/async/<resource>/`` returns the same payloads as ``/api/<resource>/``.
+
+Work that still blocks (building the query, which may look up the text
+index, reading archived rows, the count cache) runs on a worker thread so
+the event loop keeps serving other requests.
+
+Motor 2.5 is the last release for pymongo 3, which djongo requires; it does
+not import on Python 3.11 or later, so the backend runs on Python 3.10.
+"""
+import asyncio
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.http import HttpResponse
+from django.urls import path
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from . import native, pagination
+from .mongo import get_motor_db
+from .serializers import requested_fields
+
+
+class AsyncReadView(View):
+    viewset = None
+
+    async def get(self, request, pk=None):
+        drf_request = Request(request)
+        view = self.viewset(
+            request=drf_request, format_kwarg=None, kwargs={'pk': pk} if pk else {},
+            action='list' if pk is None else 'retrieve', detail=pk is not None,
+        )
+        collection = get_motor_db(view.read_alias(request))[view.queryset.model._meta.db_table]
+        try:
+            serializer = native.document_serializer(view.get_serializer_class())
+            serializer = serializer.subset(requested_fields(drf_request, serializer.names()))
+            if pk is None:
+                data = await self.list(view, drf_request, collection, serializer)
+            else:
+                data = await self.retrieve(collection, pk, serializer)
+        except APIException as exc:
+            # e.g. 400 for a bad filter, 404 for an unknown cursor; shaped
+            # like DRF's exception handler output
+            detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            return self.render(detail, exc.status_code)
+        if data is None:
+            return self.render({'detail': 'Not found.'}, status.HTTP_404_NOT_FOUND)
+        return self.render(data)
+
+    async def list(self, view, request, collection, serializer):
+        query = await asyncio.to_thread(native.NativeQuery, view, request, fields=serializer.projection_fields)
+        ordering = query.ordering()
+        paginator = view.paginator
+        if paginator is None:
+            cursor = collection.find(query.spec, query.projection())
+            if ordering:
+                cursor = cursor.sort(query.sort(ordering))
+            documents = await cursor.to_list(None)
+            if query.archive is not None:
+                archived = await asyncio.to_thread(
+                    query.archive.find, query.spec, query.projection(), query.sort(ordering))
+                documents = sorted(documents + archived, key=native.sort_key(query.sort(ordering)))
+            return serializer.many(documents)
+
+        operation, arguments = paginator.collection_query(
+            query.spec, request, ordering, query.text_search, query.fields)
+        if operation == 'aggregate':
+            documents = await collection.aggregate(arguments).to_list(None)
+        else:
+            cursor = collection.find(arguments['filter'], arguments['projection']).sort(arguments['sort'])
+            documents = await cursor.limit(arguments['limit']).to_list(None)
+            if query.archive is not None:
+                # Archived rows are read from local files on a worker thread
+                documents = await asyncio.to_thread(paginator.merge_archive, documents, query.archive, arguments)
+        paginator.count = await self.count(paginator, collection, query.spec, query.archive)
+        page = paginator.finish_page(documents, paginator.cursor)
+        return paginator.get_paginated_response(serializer.many(page)).data
+
+    async def count(self, paginator, collection, spec, archive=None):
+        """Motor counterpart of ``KeysetPagination.resolve_count``"""
+        method = paginator.count_method(spec)
+        if method is None:
+            return None
+        if method == pagination.COUNT_ESTIMATED:
+            count = await collection.estimated_document_count()
+            if archive is not None:
+                count += await asyncio.to_thread(archive.count, {})
+            return count
+        if method == pagination.COUNT_CACHED:
+            count = await asyncio.to_thread(pagination.cached_count, collection.name, spec)
+            if count is not None:
+                return count
+        count = await collection.count_documents(spec)
+        if archive is not None:
+            count += await asyncio.to_thread(archive.count, spec)
+        if method == pagination.COUNT_CACHED:
+            await asyncio.to_thread(pagination.store_count, collection.name, spec, count)
+        return count
+
+    async def retrieve(self, collection, pk, serializer):
+        fields = serializer.projection_fields
+        projection = dict.fromkeys(fields, 1) if fields is not None else None
+        try:
+            document = await collection.find_one({'_id': ObjectId(pk)}, projection)
+        except InvalidId:
+            return None
+        return None if document is None else serializer.to_representation(document)
+
+    def render(self, data, status_code=status.HTTP_200_OK):
+        return HttpResponse(JSONRenderer().render(data), status=status_code,
+                            content_type='application/json')
+
+
+def async_urlpatterns(router):
+    """Async list/detail routes for every viewset registered on ``router``"""
+    urlpatterns = []
+    for prefix, viewset, basename in router.registry:
+        view = AsyncReadView.as_view(viewset=viewset)
+        urlpatterns += [
+            path(f'{prefix}/', view, name=f'async-{basename}-list'),
+            path(f'{prefix}/<str:pk>/', view, name=f'async-{basename}-detail'),
+        ]
+    return urlpatterns
@@ -0,0 +1,208 @@
+"""
+Derived-data worker fed by changes to ``activities`` and ``users``.
+
+With ``OCTOFIT_DERIVED_DATA = 'worker'`` request handlers only write the
+source documents, and the ``derived_worker`` command keeps totals, ranks,
+rollups, statistics and denormalized copies up to date from their changes.
+Changes come from a change stream, or on a single-node server without one
+from a poller that picks up new documents by ``_id`` and reconciles
+updates and deletes with periodic sweeps.
+
+Change events carry the new document but not the old one, so the worker
+keeps a shadow copy of the fields it last applied for every source
+document. Each micro-batch is applied as the difference between the
+latest documents and their shadows. Replaying events after a restart
+therefore changes nothing, and the stored resume point only needs to be
+no later than the last applied batch.
+"""
+import time
+
+from pymongo import DeleteOne, ReplaceOne
+from pymongo.errors import OperationFailure
+
+from . import leaderboard, propagation
+from .mongo import get_db
+
+STATE_COLLECTION = 'changefeed_state'
+STATE_ID = 'derived'
+SHADOWS = {'activities': 'activities_shadow', 'users': 'users_shadow'}
+SHADOW_FIELDS = {
+    'activities': leaderboard.ACTIVITY_FIELDS,
+    'users': ['email', 'name', 'team'],
+}
+# Source fields read besides the shadowed ones: a team move carries the
+# user's current points along
+EXTRA_FIELDS = {'activities': [], 'users': ['total_points']}
+
+
+def _projection(collection):
+    return dict.fromkeys(SHADOW_FIELDS[collection] + EXTRA_FIELDS[collection], 1)
+
+
+def _shadow_of(collection, document):
+    return {field: document.get(field) for field in SHADOW_FIELDS[collection]}
+
+
+def record(events, change):
+    """Fold a change stream event into ``events``: ``{collection: {_id:
+    latest document, or None once deleted}}``"""
+    collection = change['ns']['coll']
+    if collection not in SHADOWS or 'documentKey' not in change:
+        return
+    document = change.get('fullDocument') if change['operationType'] != 'delete' else None
+    events.setdefault(collection, {})[change['documentKey']['_id']] = document
+
+
+def apply_events(events, db=None):
+    """Apply a micro-batch of ``record``-ed events and update the shadows"""
+    db = db if db is not None else get_db()
+    for collection, documents in events.items():
+        if not documents:
+            continue
+        shadow = db[SHADOWS[collection]]
+        previous = {
+            item.pop('_id'): item for item in shadow.find({'_id': {'$in': list(documents)}})
+        }
+        pending = []
+        writes = []
+        for pk, document in documents.items():
+            old = previous.get(pk)
+            new = None if document is None else _shadow_of(collection, document)
+            if old == new:
+                continue
+            pending.append((pk, old, new, document))
+            if new is None:
+                writes.append(DeleteOne({'_id': pk}))
+            else:
+                writes.append(ReplaceOne({'_id': pk}, dict(new, _id=pk), upsert=True))
+        if not pending:
+            continue
+        if collection == 'activities':
+            changes = leaderboard.ActivityChanges()
+            for pk, old, new, _ in pending:
+                if old is not None:
+                    changes.add(old, -1)
+                if new is not None:
+                    changes.add(new)
+            changes.apply(db)
+        else:
+            propagation.propagate([
+                (
+                    None if old is None else dict(old, _id=pk, total_points=(document or {}).get('total_points')),
+                    None if new is None else dict(new, _id=pk, total_points=document.get('total_points')),
+                )
+                for pk, old, new, document in pending
+            ], db)
+        # Shadows last: a crash in between replays this batch, it is not lost
+        shadow.bulk_write(writes, ordered=False)
+
+
+def bootstrap(db=None):
+    """Shadow every source document as it is now, i.e. treat the current
+    derived data as up to date, and return poll checkpoints for that point"""
+    db = db if db is not None else get_db()
+    for collection, shadow in SHADOWS.items():
+        projection = dict.fromkeys(SHADOW_FIELDS[collection], 1)
+        db[collection].aggregate([{'$project': projection}, {'$out': shadow}])
+    return latest_ids(db)
+
+
+def latest_ids(db=None):
+    """Poll checkpoints at the newest document of each source collection"""
+    db = db if db is not None else get_db()
+    return {
+        collection: (db[collection].find_one(sort=[('_id', -1)], projection={'_id': 1}) or {}).get('_id')
+        for collection in SHADOWS
+    }
+
+
+def load_state(db=None):
+    db = db if db is not None else get_db()
+    return db[STATE_COLLECTION].find_one({'_id': STATE_ID})
+
+
+def save_state(db=None, **state):
+    db = db if db is not None else get_db()
+    db[STATE_COLLECTION].update_one({'_id': STATE_ID}, {'$set': state}, upsert=True)
+
+
+def watch(db=None, resume_after=None, batch_size=500, max_wait=1.0):
+    """Yield ``(events, resume_token)`` micro-batches from a change stream.
+
+    A batch closes after ``batch_size`` events or ``max_wait`` seconds; empty
+    batches are yielded too so callers can checkpoint and stop. Raises
+    OperationFailure on servers without change streams.
+    """
+    db = db if db is not None else get_db()
+    pipeline = [{'$match': {'ns.coll': {'$in': list(SHADOWS)}}}]
+    with db.watch(pipeline, full_document='updateLookup', resume_after=resume_after,
+                  max_await_time_ms=max(1, int(max_wait * 1000))) as stream:
+        while stream.alive:
+            events = {}
+            count = 0
+            deadline = time.monotonic() + max_wait
+            while count < batch_size and time.monotonic() < deadline:
+                change = stream.try_next()
+                if change is None:
+                    break
+                record(events, change)
+                count += 1
+            yield events, stream.resume_token
+
+
+def poll(db=None, checkpoints=None, batch_size=500):
+    """Return ``(events, checkpoints)`` for documents created after the
+    ``{collection: last _id}`` checkpoints.
+
+    ObjectIds are generated client side, so a document can land just behind
+    one already seen; ``reconcile`` picks those up.
+    """
+    db = db if db is not None else get_db()
+    checkpoints = dict(checkpoints or {})
+    events = {}
+    for collection in SHADOWS:
+        last = checkpoints.get(collection)
+        query = {} if last is None else {'_id': {'$gt': last}}
+        documents = db[collection].find(query, _projection(collection)).sort('_id', 1).limit(batch_size)
+        for document in documents:
+            events.setdefault(collection, {})[document['_id']] = document
+            checkpoints[collection] = document['_id']
+    return events, checkpoints
+
+
+def reconcile(db=None, batch_size=500):
+    """Sweep every source collection against its shadow and yield event
+    batches for the documents that were updated or deleted"""
+    db = db if db is not None else get_db()
+    for collection, shadow in SHADOWS.items():
+        sources = db[collection].find({}, _projection(collection)).sort('_id', 1).batch_size(batch_size)
+        shadows = db[shadow].find().sort('_id', 1).batch_size(batch_size)
+        source = next(sources, None)
+        copy = next(shadows, None)
+        documents = {}
+        while source is not None or copy is not None:
+            if copy is None or (source is not None and source['_id'] < copy['_id']):
+                documents[source['_id']] = source
+                source = next(sources, None)
+            elif source is None or copy['_id'] < source['_id']:
+                documents[copy['_id']] = None
+                copy = next(shadows, None)
+            else:
+                pk = source['_id']
+                if _shadow_of(collection, source) != _shadow_of(collection, copy):
+                    documents[pk] = source
+                source, copy = next(sources, None), next(shadows, None)
+            if len(documents) >= batch_size:
+                yield {collection: documents}
+                documents = {}
+        if documents:
+            yield {collection: documents}
+
+
+def supports_change_streams(db=None):
+    db = db if db is not None else get_db()
+    try:
+        with db.watch([{'$match': {'ns.coll': {'$in': list(SHADOWS)}}}], max_await_time_ms=1):
+            return True
+    except OperationFailure:
+        return False
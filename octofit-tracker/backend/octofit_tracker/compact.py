@@ -0,0 +1,154 @@
+"""
+Compact serialization for the hot list endpoints.
+
+``CompactSerializer`` shapes raw Mongo documents like ``DocumentSerializer``
+but picks each field's converter once per serializer class: builtins for
+character, integer and float fields and a direct ISO 8601 formatter for
+UTC datetimes, instead of a DRF field call per value. ``CompactResponse``
+then encodes the page with orjson when it is installed.
+
+The bytes match what ``JSONRenderer`` writes for the same data. Anything
+orjson would write differently (exponent floats, integers beyond 64 bits,
+lone surrogates, fields of unknown shape) is rendered by ``JSONRenderer``
+itself.
+"""
+import datetime
+
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import ISO_8601, api_settings
+
+from .native import DocumentSerializer
+from .serializers import ActivitySerializer, LeaderboardSerializer, UserSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SERIALIZERS = [ActivitySerializer, LeaderboardSerializer, UserSerializer]
+
+# Floats the json module writes without an exponent; orjson agrees on these
+FLOAT_RANGE = (1e-4, 1e16)
+
+_renderer = JSONRenderer()
+
+
+def _overrides(field, base):
+    return type(field).to_representation is not base.to_representation
+
+
+def _datetime_converter(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    zone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+    if (output_format is None or output_format.lower() != ISO_8601
+            or zone is None or zone.utcoffset(None) != datetime.timedelta(0)):
+        return field.to_representation
+
+    def convert(value):
+        # Mongo returns naive UTC datetimes: make_aware() + isoformat() with
+        # '+00:00' written as 'Z', without the round trip
+        if type(value) is datetime.datetime and value.tzinfo is None:
+            return value.isoformat() + 'Z'
+        return field.to_representation(value)
+    return convert
+
+
+class CompactSerializer(DocumentSerializer):
+    """Shape raw documents for ``serializer_class`` with precompiled converters"""
+
+    def __init__(self, serializer_class):
+        self.fields = []
+        self.float_fields = []
+        # Fields whose values orjson may not encode like the json module
+        self.fallback_fields = []
+        for name, field in serializer_class().fields.items():
+            source = field.source
+            if name == 'id' and isinstance(field, serializers.SerializerMethodField):
+                source, convert = '_id', str
+            elif isinstance(field, serializers.CharField) and not _overrides(field, serializers.CharField):
+                convert = str
+            elif isinstance(field, serializers.IntegerField) and not _overrides(field, serializers.IntegerField):
+                convert = int
+            elif isinstance(field, serializers.FloatField) and not _overrides(field, serializers.FloatField):
+                convert = float
+                self.float_fields.append(name)
+            elif isinstance(field, serializers.DateTimeField) and not _overrides(field, serializers.DateTimeField):
+                convert = _datetime_converter(field)
+            else:
+                convert = field.to_representation
+                self.fallback_fields.append(name)
+            self.fields.append((name, source, convert))
+        self.orjson_safe = orjson is not None and not self.fallback_fields
+
+    def to_representation(self, document):
+        get = document.get
+        return {
+            name: None if (value := get(source)) is None else convert(value)
+            for name, source, convert in self.fields
+        }
+
+    def subset(self, names):
+        subset = super().subset(names)
+        if subset is not self:
+            subset.float_fields = [name for name in self.float_fields if name in names]
+            subset.fallback_fields = [name for name in self.fallback_fields if name in names]
+            subset.orjson_safe = orjson is not None and not subset.fallback_fields
+        return subset
+
+    def floats_in_range(self, rows):
+        low, high = FLOAT_RANGE
+        for row in rows:
+            for name in self.float_fields:
+                value = row[name]
+                if value and not low <= abs(value) < high:
+                    return False
+        return True
+
+    def dumps(self, data, rows):
+        """Encode ``data``, whose shaped rows are ``rows``, as JSONRenderer would"""
+        if self.orjson_safe and self.floats_in_range(rows):
+            try:
+                content = orjson.dumps(data)
+            except orjson.JSONEncodeError:
+                pass
+            else:
+                # JSONRenderer escapes the JavaScript line terminators
+                return content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return _renderer.render(data)
+
+
+_compact_serializers = {}
+
+
+def compact_serializer(serializer_class):
+    """Return the CompactSerializer for ``serializer_class``, or None when
+    the fast path is off or not enabled for it"""
+    if not getattr(settings, 'OCTOFIT_COMPACT_JSON', False) or serializer_class not in SERIALIZERS:
+        return None
+    if serializer_class not in _compact_serializers:
+        _compact_serializers[serializer_class] = CompactSerializer(serializer_class)
+    return _compact_serializers[serializer_class]
+
+
+class CompactResponse(Response):
+    """
+    A Response for rows shaped by a CompactSerializer. Plain JSON is encoded
+    by the serializer; other formats (browsable API, NDJSON, CSV, indented
+    JSON) go through the negotiated renderer as usual.
+    """
+    def __init__(self, data, serializer, rows, **kwargs):
+        super().__init__(data, **kwargs)
+        self.compact = serializer
+        self.rows = rows
+
+    @property
+    def rendered_content(self):
+        renderer = getattr(self, 'accepted_renderer', None)
+        if (type(renderer) is not JSONRenderer or self.content_type is not None
+                or renderer.get_indent(self.accepted_media_type, self.renderer_context) is not None):
+            return super().rendered_content
+        self['Content-Type'] = renderer.media_type
+        return self.compact.dumps(self.data, self.rows)
@@ -0,0 +1,178 @@
+"""
+MongoDB index management derived from the viewsets' query declarations.
+
+Every ``filterset_fields`` entry gets a compound index with the view's
+default ordering (``user_email, -date``), and every ordering field gets its
+own index. ``_id`` is appended as the keyset pagination tie-breaker so the
+page sort is served from the index as well. Views that use
+``TextSearchFilter`` get a text index over their ``search_fields``.
+Collections holding derived data declare their own ``INDEXES``.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import PyMongoError
+
+from . import recommendations, rollups, stats
+from .mongo import get_db
+from .search import forget_text_index, uses_text_search
+
+logger = logging.getLogger(__name__)
+
+
+def registered_viewsets():
+    from .urls import router
+    return [viewset for prefix, viewset, basename in router.registry]
+
+
+def _term(term):
+    return term.lstrip('-'), DESCENDING if term.startswith('-') else ASCENDING
+
+
+def _with_tiebreak(keys):
+    direction = keys[-1][1] if keys else DESCENDING
+    if not any(field == '_id' for field, _ in keys):
+        keys = keys + [('_id', direction)]
+    return keys
+
+
+def index_specs(viewset):
+    """Return the index key lists a viewset's queries need"""
+    model = viewset.queryset.model
+    default = list(getattr(viewset, 'ordering', None) or model._meta.ordering or [])
+    primary = [_term(default[0])] if default else []
+    descending = {term.lstrip('-') for term in default if term.startswith('-')}
+
+    specs = []
+    for field in getattr(viewset, 'filterset_fields', None) or []:
+        specs.append(_with_tiebreak([(field, ASCENDING)] + primary))
+    for term in default:
+        specs.append(_with_tiebreak([_term(term)]))
+    for field in getattr(viewset, 'ordering_fields', None) or []:
+        direction = DESCENDING if field in descending else ASCENDING
+        specs.append(_with_tiebreak([(field, direction)]))
+    if uses_text_search(viewset):
+        specs.append([(field, TEXT) for field in viewset.search_fields])
+    return specs
+
+
+def _is_text(keys):
+    return any(direction == TEXT for _, direction in keys)
+
+
+def collection_specs():
+    """Return ``{collection: [keys, ...]}`` across all registered viewsets"""
+    collections = {}
+    for viewset in registered_viewsets():
+        collection = viewset.queryset.model._meta.db_table
+        specs = collections.setdefault(collection, [])
+        for keys in index_specs(viewset):
+            if keys not in specs:
+                specs.append(keys)
+    for collection, specs in derived_specs().items():
+        collections.setdefault(collection, []).extend(specs)
+    return collections
+
+
+def derived_specs():
+    """Indexes of collections that are not behind a viewset"""
+    return {
+        rollups.COLLECTION: rollups.INDEXES,
+        stats.COLLECTION: stats.INDEXES,
+        recommendations.COLLECTION: recommendations.INDEXES,
+    }
+
+
+def ensure_indexes(db=None, dry_run=False):
+    """Create any missing indexes and return ``{collection: [index names]}``"""
+    db = db if db is not None else get_db()
+    created = {}
+    for collection, specs in collection_specs().items():
+        existing = {
+            tuple(info['key']) for info in db[collection].index_information().values()
+        }
+        # A collection holds at most one text index, stored as _fts/_ftsx keys
+        has_text = any(dict(keys).get('_fts') == TEXT for keys in existing)
+        missing = [
+            keys for keys in specs
+            if not (has_text if _is_text(keys) else tuple(keys) in existing)
+        ]
+        if not missing:
+            continue
+        if dry_run:
+            created[collection] = [
+                '_'.join(f'{field}_{direction}' for field, direction in keys) for keys in missing
+            ]
+        else:
+            created[collection] = db[collection].create_indexes([
+                IndexModel(keys, name=f'{collection}_text') if _is_text(keys) else IndexModel(keys)
+                for keys in missing
+            ])
+            forget_text_index(collection)
+    return created
+
+
+def _ensure_indexes_logged():
+    try:
+        for collection, names in ensure_indexes().items():
+            logger.info('Created indexes on %s: %s', collection, ', '.join(names))
+    except PyMongoError as exc:
+        logger.warning('Could not ensure MongoDB indexes: %s', exc)
+
+
+def ensure_indexes_on_startup():
+    """Create missing indexes in the background when the WSGI/ASGI
+    application loads, so an unreachable server does not block startup"""
+    if getattr(settings, 'OCTOFIT_ENSURE_INDEXES_ON_STARTUP', False):
+        threading.Thread(target=_ensure_indexes_logged, daemon=True).start()
+
+
+def unused_indexes(db=None):
+    """Return ``(collection, index name, ops)`` for indexes never used since
+    the server started, according to ``$indexStats``"""
+    db = db if db is not None else get_db()
+    unused = []
+    for collection in collection_specs():
+        for stats in db[collection].aggregate([{'$indexStats': {}}]):
+            ops = stats['accesses']['ops']
+            if stats['name'] != '_id_' and ops == 0:
+                unused.append((collection, stats['name'], ops))
+    return unused
+
+
+def _plan_stages(plan):
+    stages = [plan['stage']]
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            stages.extend(_plan_stages(child))
+    return stages
+
+
+def unindexed_queries(db=None):
+    """Explain a representative query per spec and return the ones whose
+    winning plan still scans the collection or sorts in memory"""
+    db = db if db is not None else get_db()
+    filter_fields = {}
+    for viewset in registered_viewsets():
+        filter_fields.setdefault(viewset.queryset.model._meta.db_table, set()).update(
+            getattr(viewset, 'filterset_fields', None) or [])
+
+    problems = []
+    for collection, specs in collection_specs().items():
+        sample = db[collection].find_one() or {}
+        for keys in specs:
+            if _is_text(keys):
+                continue
+            field, _ = keys[0]
+            if field in filter_fields.get(collection, ()):
+                query, sort = {field: sample.get(field)}, keys[1:]
+            else:
+                query, sort = {}, keys
+            explain = db[collection].find(query).sort(sort).limit(1).explain()
+            stages = _plan_stages(explain['queryPlanner']['winningPlan'])
+            slow = [stage for stage in ('COLLSCAN', 'SORT') if stage in stages]
+            if slow:
+                problems.append((collection, keys, slow))
+    return problems
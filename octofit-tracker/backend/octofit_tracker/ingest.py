@@ -0,0 +1,224 @@
+"""
+Bulk activity ingestion.
+
+Records are validated column by column for a whole chunk at a time rather
+than through one serializer instance per record, written with unordered
+``insert_many`` and folded into a single batch of derived-data changes.
+Records without points or calories are scored a chunk at a time. Numbers
+given as strings are coerced as the single-activity serializer does.
+"""
+from datetime import timezone
+from itertools import islice
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.validators import validate_email
+from django.utils.dateparse import parse_datetime
+from pymongo.errors import BulkWriteError
+from rest_framework import serializers
+
+from . import leaderboard as leaderboard_engine
+from . import response_cache, scoring
+from .models import Activity
+from .mongo import get_db
+from .parsers import InvalidRecord
+
+CHUNK_SIZE = 1000
+
+REQUIRED = ['user_email', 'user_name', 'activity_type', 'duration', 'date']
+OPTIONAL = {'distance': None, 'notes': ''}
+# Computed by the scoring rules when left out
+SCORED = ['calories', 'points']
+
+
+def _max_length(name):
+    return Activity._meta.get_field(name).max_length
+
+
+def _check_email(values):
+    for value in values:
+        try:
+            if not isinstance(value, str):
+                raise DjangoValidationError('Not a string')
+            validate_email(value)
+        except DjangoValidationError:
+            yield 'Enter a valid email address.'
+        else:
+            yield None
+
+
+def _check_string(name, allow_blank=False):
+    max_length = _max_length(name)
+
+    def check(values):
+        for value in values:
+            if not isinstance(value, str):
+                yield 'Not a valid string.'
+            elif not value and not allow_blank:
+                yield 'This field may not be blank.'
+            elif max_length and len(value) > max_length:
+                yield f'Ensure this field has no more than {max_length} characters.'
+            else:
+                yield None
+    return check
+
+
+def _coerce(field, native):
+    """Return a column coercion: values of the ``native`` types pass as they
+    are, anything else goes through the DRF ``field`` the serializer uses"""
+    def coerce(values):
+        for value in values:
+            if value is None or (isinstance(value, native) and not isinstance(value, bool)):
+                yield value, None
+                continue
+            try:
+                yield field.to_internal_value(value), None
+            except serializers.ValidationError as exc:
+                yield value, str(exc.detail[0])
+    return coerce
+
+
+def _to_utc(value):
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    if parsed is None:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+COLUMN_CHECKS = {
+    'user_email': _check_email,
+    'user_name': _check_string('user_name'),
+    'activity_type': _check_string('activity_type'),
+    'notes': _check_string('notes', allow_blank=True),
+}
+COLUMN_COERCIONS = {
+    'duration': _coerce(serializers.IntegerField(), int),
+    'distance': _coerce(serializers.FloatField(), (int, float)),
+    'calories': _coerce(serializers.IntegerField(), int),
+    'points': _coerce(serializers.IntegerField(), int),
+}
+
+
+def _add_error(errors, index, name, message):
+    errors.setdefault(index, {}).setdefault(name, [message])
+
+
+def validate_chunk(records):
+    """Validate a list of records column-wise.
+
+    Returns ``(documents, errors)`` where ``documents`` holds ``(index,
+    document)`` pairs ready for insertion and ``errors`` maps a record index
+    to its field errors.
+    """
+    errors = {}
+    rows = []
+    for index, record in enumerate(records):
+        if isinstance(record, InvalidRecord):
+            _add_error(errors, index, 'non_field_errors', record.message)
+        elif not isinstance(record, dict):
+            _add_error(errors, index, 'non_field_errors', 'Expected an object.')
+        else:
+            rows.append((index, record))
+    indexes = [index for index, _ in rows]
+
+    columns = {name: [record.get(name) for _, record in rows] for name in REQUIRED}
+    for name, default in OPTIONAL.items():
+        columns[name] = [record.get(name, default) for _, record in rows]
+    for name in SCORED:
+        columns[name] = [record.get(name) for _, record in rows]
+
+    for name in REQUIRED:
+        for index, value in zip(indexes, columns[name]):
+            if value is None:
+                _add_error(errors, index, name, 'This field is required.')
+
+    dates = [_to_utc(value) for value in columns['date']]
+    for index, value, parsed in zip(indexes, columns['date'], dates):
+        if value is not None and parsed is None:
+            _add_error(errors, index, 'date', 'Datetime has wrong format.')
+    columns['date'] = dates
+
+    for name, check in COLUMN_CHECKS.items():
+        for index, value, message in zip(indexes, columns[name], check(columns[name])):
+            if message and value is not None:
+                _add_error(errors, index, name, message)
+    for name, coerce in COLUMN_COERCIONS.items():
+        coerced = []
+        for index, (value, message) in zip(indexes, coerce(columns[name])):
+            if message:
+                _add_error(errors, index, name, message)
+            coerced.append(value)
+        columns[name] = coerced
+
+    documents = [
+        (index, {name: column[position] for name, column in columns.items()})
+        for position, index in enumerate(indexes)
+        if index not in errors
+    ]
+    for _, document in documents:
+        if document['distance'] is not None:
+            document['distance'] = float(document['distance'])
+    unscored = [document for _, document in documents if document['points'] is None or document['calories'] is None]
+    if unscored:
+        points, calories = scoring.score_batch(
+            [document['activity_type'] for document in unscored],
+            [document['duration'] for document in unscored],
+            [document['distance'] for document in unscored],
+        )
+        for document, score, burned in zip(unscored, points.tolist(), calories.tolist()):
+            if document['points'] is None:
+                document['points'] = score
+            if document['calories'] is None:
+                document['calories'] = burned
+    return documents, errors
+
+
+def insert_chunk(documents, db):
+    """insert_many the validated documents; return the inserted ones and
+    per-index write errors"""
+    if not documents:
+        return [], {}
+    indexes = [index for index, _ in documents]
+    batch = [document for _, document in documents]
+    failed = {}
+    try:
+        db.activities.insert_many(batch, ordered=False)
+    except BulkWriteError as exc:
+        for error in exc.details.get('writeErrors', []):
+            failed[indexes[error['index']]] = {'non_field_errors': [error.get('errmsg', 'Write failed.')]}
+    inserted = [document for index, document in documents if index not in failed]
+    return inserted, failed
+
+
+def ingest(records, chunk_size=CHUNK_SIZE):
+    """Validate and insert an iterable of activity records chunk by chunk.
+
+    Returns ``(inserted_count, errors)`` with errors sorted by record index.
+    """
+    db = get_db()
+    records = iter(records)
+    offset = 0
+    inserted_count = 0
+    errors = []
+    changes = leaderboard_engine.ActivityChanges()
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        documents, invalid = validate_chunk(chunk)
+        inserted, failed = insert_chunk(documents, db)
+        invalid.update(failed)
+        errors.extend(
+            {'index': offset + index, 'errors': invalid[index]} for index in sorted(invalid)
+        )
+        for document in inserted:
+            changes.add(document)
+        inserted_count += len(inserted)
+        offset += len(chunk)
+
+    if inserted_count:
+        response_cache.invalidate('activities')
+    if leaderboard_engine.updates_inline():
+        changes.apply(db)
+    return inserted_count, errors
@@ -0,0 +1,305 @@
+"""
+Per-request query instrumentation.
+
+A pymongo command listener counts the Mongo round trips of the request
+being served and sums their duration. A connection execute wrapper
+measures the time djongo spends on SQL outside of those round trips,
+which is mostly translation. ``InstrumentationMiddleware`` reports both,
+with render and total time, in a ``Server-Timing`` header. It also adds
+them to per-process Prometheus counters served at ``/metrics``.
+
+Commands slower than ``OCTOFIT_SLOW_QUERY_MS`` are sampled into the
+``octofit_tracker.slow_queries`` log. Each entry carries the command's
+filter or pipeline and a summary of its ``explain`` plan. Plans are
+fetched by a background thread, so the request that ran the slow query
+does not wait for them.
+
+Motor runs commands on executor threads that do not inherit the request
+context. Async views therefore show up in the slow-query log and in
+request totals, but not in per-request query counts.
+"""
+import contextvars
+import logging
+import queue
+import random
+import threading
+import time
+
+from bson import SON, json_util
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+from .mongo import get_client
+
+slow_query_logger = logging.getLogger('octofit_tracker.slow_queries')
+
+# Commands whose filter is worth logging and which can be explained
+EXPLAINABLE = {'find', 'aggregate', 'count', 'distinct'}
+# Driver bookkeeping stripped from logged and explained commands
+DRIVER_FIELDS = {'lsid', 'txnNumber', '$clusterTime', '$db', '$readPreference', 'readConcern'}
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+SLOW_QUERY_QUEUE_SIZE = 100
+
+_current = contextvars.ContextVar('octofit_request_stats', default=None)
+
+
+def enabled():
+    return getattr(settings, 'OCTOFIT_INSTRUMENTATION', False)
+
+
+class RequestStats:
+    def __init__(self, path):
+        self.path = path
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.sql_statements = 0
+        self.orm_time = 0.0
+        self.render_time = 0.0
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Attribute Mongo round trips to the current request and sample slow ones"""
+
+    def __init__(self):
+        self.pending = {}
+
+    def started(self, event):
+        if event.command_name in EXPLAINABLE:
+            self.pending[(event.connection_id, event.request_id)] = event
+
+    def succeeded(self, event):
+        self.finished(event)
+
+    def failed(self, event):
+        self.finished(event)
+
+    def finished(self, event):
+        started = self.pending.pop((event.connection_id, event.request_id), None)
+        seconds = event.duration_micros / 1e6
+        stats = _current.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += seconds
+        if started is not None and seconds * 1000 >= getattr(settings, 'OCTOFIT_SLOW_QUERY_MS', 100):
+            if random.random() < getattr(settings, 'OCTOFIT_SLOW_QUERY_SAMPLE', 1.0):
+                slow_queries.submit(started, seconds, stats.path if stats is not None else None)
+
+
+def time_sql(execute, sql, params, many, context):
+    """Connection execute wrapper: SQL time outside of Mongo round trips"""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    db_time = stats.db_time
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.sql_statements += 1
+        stats.orm_time += time.perf_counter() - start - (stats.db_time - db_time)
+
+
+def install_sql_timer(sender, connection, **kwargs):
+    """``connection_created`` receiver adding ``time_sql`` to new connections"""
+    if time_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_sql)
+
+
+def command_document(command):
+    return SON((key, value) for key, value in command.items() if key not in DRIVER_FIELDS)
+
+
+def plan_stages(plan):
+    """Render a winning plan innermost stage first, e.g.
+    ``IXSCAN(email_1) -> FETCH -> LIMIT``"""
+    stage = plan.get('stage', '?')
+    if plan.get('indexName'):
+        stage += f"({plan['indexName']})"
+    children = [plan['inputStage']] if 'inputStage' in plan else plan.get('inputStages', [])
+    inner = ' + '.join(plan_stages(child) for child in children)
+    return f'{inner} -> {stage}' if inner else stage
+
+
+def plan_summary(explain):
+    planner = explain.get('queryPlanner')
+    for stage in explain.get('stages', []) if planner is None else []:
+        planner = stage.get('$cursor', {}).get('queryPlanner')
+        if planner is not None:
+            break
+    if planner is None:
+        return 'unknown'
+    winning = planner['winningPlan']
+    return plan_stages(winning.get('queryPlan', winning))
+
+
+class SlowQueryLog:
+    """Explain sampled slow commands on a background thread and log them"""
+
+    def __init__(self):
+        self.queue = queue.Queue(SLOW_QUERY_QUEUE_SIZE)
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def submit(self, event, seconds, path):
+        metrics.increment('octofit_mongo_slow_queries_total', command=event.command_name)
+        try:
+            self.queue.put_nowait((event.database_name, event.command_name, command_document(event.command),
+                                   seconds, path))
+        except queue.Full:
+            return
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name='octofit-slow-queries', daemon=True)
+                self.worker.start()
+
+    def run(self):
+        while True:
+            self.write(*self.queue.get())
+            self.queue.task_done()
+
+    def write(self, database, command_name, command, seconds, path):
+        try:
+            explain = get_client()[database].command(SON([('explain', command), ('verbosity', 'queryPlanner')]))
+            plan = plan_summary(explain)
+        except PyMongoError as exc:
+            plan = f'explain failed: {exc}'
+        slow_query_logger.warning(
+            'Slow %s on %s.%s took %.1f ms (request %s) plan: %s command: %s',
+            command_name, database, command.get(command_name), seconds * 1000, path or '-', plan,
+            json_util.dumps(command),
+        )
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Metrics:
+    """Per-process counters and histograms in the Prometheus text format"""
+
+    HELP = {
+        'octofit_http_requests_total': ('counter', 'Requests served, by view, method and status.'),
+        'octofit_http_request_duration_seconds': ('histogram', 'Time to produce a response.'),
+        'octofit_http_request_db_queries_total': ('counter', 'Mongo round trips made by requests.'),
+        'octofit_http_request_db_seconds_total': ('counter', 'Time requests spent in Mongo round trips.'),
+        'octofit_http_request_orm_seconds_total': ('counter', 'Time requests spent in djongo outside Mongo.'),
+        'octofit_http_request_render_seconds_total': ('counter', 'Time spent rendering response bodies.'),
+        'octofit_http_response_bytes_total': ('counter', 'Response body bytes, streaming responses excluded.'),
+        'octofit_mongo_slow_queries_total': ('counter', 'Mongo commands slower than OCTOFIT_SLOW_QUERY_MS.'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            for bound in DURATION_BUCKETS + ['+Inf']:
+                key = (name + '_bucket', labels + (('le', str(bound)),))
+                self.values[key] = self.values.get(key, 0) + (bound == '+Inf' or value <= bound)
+            for suffix, amount in (('_sum', value), ('_count', 1)):
+                key = (name + suffix, labels)
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        # Insertion order keeps each histogram's buckets in ascending order
+        with self.lock:
+            values = list(self.values.items())
+        lines = []
+        for name, (kind, help_text) in self.HELP.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            for (key, labels), value in values:
+                if key == name or (kind == 'histogram' and key.rsplit('_', 1)[0] == name):
+                    lines.append(f'{key}{_labels(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+
+metrics = Metrics()
+slow_queries = SlowQueryLog()
+command_timer = CommandTimer()
+
+
+def install():
+    """Register the command listener and the SQL timer; called from
+    AppConfig.ready() so they are in place before any client is created"""
+    if enabled():
+        monitoring.register(command_timer)
+        connection_created.connect(install_sql_timer)
+
+
+def metrics_view(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _milliseconds(seconds):
+    return f'{seconds * 1000:.1f}'
+
+
+class InstrumentationMiddleware(MiddlewareMixin):
+    """
+    Time each request's Mongo round trips, djongo SQL handling and
+    rendering; report them in ``Server-Timing`` and the ``/metrics`` counters
+    """
+    def process_request(self, request):
+        if enabled():
+            request.octofit_stats = RequestStats(request.path)
+            _current.set(request.octofit_stats)
+
+    def process_template_response(self, request, response):
+        stats = getattr(request, 'octofit_stats', None)
+        if stats is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                stats.render_time += time.perf_counter() - start
+            response.add_post_render_callback(rendered)
+        return response
+
+    def process_response(self, request, response):
+        stats = getattr(request, 'octofit_stats', None)
+        if stats is None:
+            return response
+        _current.set(None)
+        total = time.perf_counter() - stats.started
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={_milliseconds(stats.db_time)};desc="{stats.queries} queries"',
+            f'orm;dur={_milliseconds(stats.orm_time)};desc="{stats.sql_statements} statements"',
+            f'render;dur={_milliseconds(stats.render_time)}',
+            f'total;dur={_milliseconds(total)}',
+        ])
+
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        if view == 'metrics':
+            return response
+        metrics.increment('octofit_http_requests_total', view=view, method=request.method,
+                          status=response.status_code)
+        metrics.observe('octofit_http_request_duration_seconds', total, view=view)
+        metrics.increment('octofit_http_request_db_queries_total', stats.queries, view=view)
+        metrics.increment('octofit_http_request_db_seconds_total', stats.db_time, view=view)
+        metrics.increment('octofit_http_request_orm_seconds_total', stats.orm_time, view=view)
+        metrics.increment('octofit_http_request_render_seconds_total', stats.render_time, view=view)
+        if not response.streaming:
+            metrics.increment('octofit_http_response_bytes_total', len(response.content), view=view)
+        return response
@@ -0,0 +1,328 @@
+"""
+Incremental leaderboard engine.
+
+Activity writes are turned into per-user point deltas which are applied with
+atomic ``$inc`` updates to ``users.total_points`` and ``teams.total_points``.
+Leaderboard entries are kept in rank order by moving only the entry that
+changed: the entries it overtakes (or falls behind) are contiguous in rank, so
+a single ``update_many`` shifts them by one and the moved entry takes the gap.
+The same writes feed the day, week and month rollups in ``rollups`` and the
+per-user statistics in ``stats``.
+
+A move reads the entry's position and then shifts its neighbours in separate
+writes, so moves on one board hold a lock document in ``leaderboard_locks``
+for the duration. Any number of web or worker processes can write. A lock
+is leased for ``LOCK_LEASE`` seconds and a background thread extends the
+leases its process holds, so long re-rankings keep their lock while a
+crashed holder's lock is taken over once its lease runs out.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+from bson import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from . import response_cache, rollups, stats
+from .mongo import get_db
+
+logger = logging.getLogger(__name__)
+
+INDIVIDUAL = 'individual'
+TEAM = 'team'
+
+ACTIVITY_FIELDS = [
+    'user_email', 'activity_type', 'duration', 'distance',
+    'calories', 'points', 'date',
+]
+
+LOCK_COLLECTION = 'leaderboard_locks'
+# Seconds after which a board lock left by a crashed process is taken over
+LOCK_LEASE = 30
+
+# Threads of one process queue here rather than polling the lock document
+_board_locks = {INDIVIDUAL: threading.Lock(), TEAM: threading.Lock()}
+# board -> (db, owner) of the locks this process holds
+_held = {}
+_renewer = None
+_renewer_lock = threading.Lock()
+
+
+def activity_snapshot(activity):
+    """Return the fields of an Activity that derived data depends on"""
+    return {field: getattr(activity, field) for field in ACTIVITY_FIELDS}
+
+
+def updates_inline():
+    """Whether writes update derived data themselves, rather than leaving it
+    to the ``derived_worker`` command (OCTOFIT_DERIVED_DATA = 'worker')"""
+    return getattr(settings, 'OCTOFIT_DERIVED_DATA', 'inline') != 'worker'
+
+
+def record_activity_change(old=None, new=None):
+    """Apply the difference between two activity snapshots.
+
+    ``old`` is None for a create and ``new`` is None for a delete.
+    """
+    if not updates_inline():
+        return
+    changes = ActivityChanges()
+    if old is not None:
+        changes.add(old, -1)
+    if new is not None:
+        changes.add(new)
+    changes.apply()
+
+
+class ActivityChanges:
+    """
+    What a batch of activity writes does to derived data: point deltas per
+    user for totals and ranks, plus rollup and statistics increments
+    """
+    def __init__(self):
+        self.deltas = {}
+        self.rollups = {}
+        self.stats = {}
+
+    def add(self, activity, sign=1):
+        """Record an inserted activity, or a removed one with ``sign=-1``"""
+        email = activity['user_email']
+        self.deltas[email] = self.deltas.get(email, 0) + sign * (activity['points'] or 0)
+        rollups.add_activity(self.rollups, activity, sign)
+        stats.add_activity(self.stats, activity, sign)
+
+    def apply(self, db=None):
+        db = db if db is not None else get_db()
+        rollups.apply_increments(self.rollups, db)
+        stats.apply_increments(self.stats, db)
+        apply_deltas(self.deltas, db)
+        if self.rollups and not any(self.deltas.values()):
+            # e.g. an activity moved to another date: apply_deltas had nothing
+            # to do and did not invalidate the windowed boards
+            response_cache.invalidate('leaderboard')
+
+
+def apply_deltas(deltas, db=None):
+    """Apply ``{user_email: points_delta}`` to users, teams and the leaderboard.
+
+    User and team totals are each incremented with one batched ``bulk_write``
+    and read back with one query; only the leaderboard moves are per entry.
+    """
+    db = db if db is not None else get_db()
+    deltas = {email: delta for email, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    db.users.bulk_write([
+        UpdateOne({'email': email}, {'$inc': {'total_points': delta}})
+        for email, delta in deltas.items()
+    ], ordered=False)
+    users = db.users.find(
+        {'email': {'$in': list(deltas)}},
+        {'name': 1, 'email': 1, 'team': 1, 'total_points': 1},
+    )
+    team_deltas = {}
+    for user in users:
+        set_points(db, INDIVIDUAL, {'email': user['email']}, user['total_points'],
+                   name=user['name'], team=user.get('team'))
+        if user.get('team'):
+            team_deltas[user['team']] = team_deltas.get(user['team'], 0) + deltas[user['email']]
+
+    apply_team_deltas(team_deltas, db)
+    response_cache.invalidate('leaderboard')
+
+
+def apply_team_deltas(team_deltas, db):
+    """Apply ``{team_name: points_delta}`` to team totals and the team board"""
+    team_deltas = {name: delta for name, delta in team_deltas.items() if delta}
+    if not team_deltas:
+        return
+    db.teams.bulk_write([
+        UpdateOne({'name': name}, {'$inc': {'total_points': delta}})
+        for name, delta in team_deltas.items()
+    ], ordered=False)
+    for team in db.teams.find({'name': {'$in': list(team_deltas)}}, {'name': 1, 'total_points': 1}):
+        set_points(db, TEAM, {'name': team['name']}, team['total_points'])
+
+
+@contextmanager
+def board_lock(db, board):
+    """Hold the lock of ``board`` across processes.
+
+    The lock is a document taken with a conditional upsert: while another
+    owner holds an unexpired lease the upsert hits the unique ``_id`` and
+    is retried.
+    """
+    with _board_locks[board]:
+        owner = ObjectId()
+        delay = 0.005
+        while True:
+            now = datetime.utcnow()
+            try:
+                db[LOCK_COLLECTION].update_one(
+                    {'_id': board, '$or': [{'owner': None}, {'expires': {'$lt': now}}]},
+                    {'$set': {'owner': owner, 'expires': now + timedelta(seconds=LOCK_LEASE)}},
+                    upsert=True,
+                )
+                break
+            except DuplicateKeyError:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+        _held[board] = (db, owner)
+        _ensure_renewer()
+        try:
+            yield
+        finally:
+            del _held[board]
+            db[LOCK_COLLECTION].update_one({'_id': board, 'owner': owner}, {'$set': {'owner': None}})
+
+
+def renew_leases():
+    """Extend the lease of every board lock this process holds"""
+    for board, (db, owner) in list(_held.items()):
+        try:
+            renewed = db[LOCK_COLLECTION].update_one(
+                {'_id': board, 'owner': owner},
+                {'$set': {'expires': datetime.utcnow() + timedelta(seconds=LOCK_LEASE)}},
+            ).matched_count
+        except PyMongoError:
+            logger.exception('Could not renew the %s leaderboard lock', board)
+            continue
+        if not renewed and _held.get(board, (None, None))[1] == owner:
+            logger.error('The %s leaderboard lock expired while held', board)
+
+
+def _ensure_renewer():
+    global _renewer
+    with _renewer_lock:
+        if _renewer is None or not _renewer.is_alive():
+            _renewer = threading.Thread(target=_renew, name='octofit-lock-renewer', daemon=True)
+            _renewer.start()
+
+
+def _renew():
+    while True:
+        time.sleep(LOCK_LEASE / 3)
+        renew_leases()
+
+
+def set_points(db, board, key, points, **fields):
+    """Give the entry matching ``key`` on ``board`` a new points total and
+    re-rank it, creating the entry at the bottom of the board if needed."""
+    leaderboard = db.leaderboard
+    query = dict(key, type=board)
+    with board_lock(db, board):
+        entry = leaderboard.find_one(query, {'points': 1, 'rank': 1})
+        if entry is None:
+            entry = dict(query, **fields)
+            entry.update({
+                'points': None,
+                'rank': leaderboard.count_documents({'type': board}) + 1,
+                'last_updated': datetime.now(),
+            })
+            entry['_id'] = leaderboard.insert_one(entry).inserted_id
+
+        rank = entry['rank']
+        old_points = entry['points']
+        if old_points is None or points > old_points:
+            # Overtake the entries directly above that now have fewer points
+            shifted = leaderboard.update_many(
+                {'type': board, 'rank': {'$lt': rank}, 'points': {'$lt': points}},
+                {'$inc': {'rank': 1}},
+            ).modified_count
+            rank -= shifted
+        elif points < old_points:
+            # Fall behind the entries directly below that now have more points
+            shifted = leaderboard.update_many(
+                {'type': board, 'rank': {'$gt': rank}, 'points': {'$gt': points}},
+                {'$inc': {'rank': -1}},
+            ).modified_count
+            rank += shifted
+
+        update = dict(fields, points=points, rank=rank, last_updated=datetime.now())
+        leaderboard.update_one({'_id': entry['_id']}, {'$set': update})
+    return rank
+
+
+def remove_entry(db, board, key):
+    """Delete the entry matching ``key`` on ``board`` and close the gap in
+    the ranks below it; returns the deleted entry, or None"""
+    with board_lock(db, board):
+        entry = db.leaderboard.find_one_and_delete(dict(key, type=board), {'points': 1, 'rank': 1})
+        if entry is not None:
+            db.leaderboard.update_many({'type': board, 'rank': {'$gt': entry['rank']}}, {'$inc': {'rank': -1}})
+    return entry
+
+
+def rebuild_totals(user_points, db=None, chunk_size=5000):
+    """Set every user's total to ``{user_email: points}`` (0 if absent), team
+    totals to the sum of their users' and re-rank both boards"""
+    db = db if db is not None else get_db()
+    team_points = {}
+    updates = []
+    entries = {}
+    for user in db.users.find({}, {'name': 1, 'email': 1, 'team': 1, 'total_points': 1}):
+        points = user_points.get(user['email'], 0)
+        if user.get('team'):
+            team_points[user['team']] = team_points.get(user['team'], 0) + points
+        if points != user.get('total_points'):
+            updates.append(UpdateOne({'_id': user['_id']}, {'$set': {'total_points': points}}))
+        entries[user['email']] = ({'email': user['email']}, points, {'name': user['name'], 'team': user.get('team')})
+    _bulk_write(db.users, updates, chunk_size)
+
+    updates = []
+    team_entries = {}
+    for team in db.teams.find({}, {'name': 1, 'total_points': 1}):
+        points = team_points.get(team['name'], 0)
+        if points != team.get('total_points'):
+            updates.append(UpdateOne({'_id': team['_id']}, {'$set': {'total_points': points}}))
+        team_entries[team['name']] = ({'name': team['name']}, points, {})
+    _bulk_write(db.teams, updates, chunk_size)
+
+    for board, key_field, totals in ((INDIVIDUAL, 'email', entries), (TEAM, 'name', team_entries)):
+        with board_lock(db, board):
+            rerank(db, board, key_field, totals, chunk_size)
+    response_cache.invalidate('users', 'teams', 'leaderboard')
+
+
+def rerank(db, board, key_field, totals, chunk_size=5000):
+    """Rewrite the points and ranks of a whole board from ``{key: (key query,
+    points, fields)}``, highest points first and ties in their current order.
+    Entries are created for keys with points; entries without a key keep
+    their points."""
+    entries = list(db.leaderboard.find({'type': board}, {key_field: 1, 'points': 1, 'rank': 1}))
+    known = {entry.get(key_field) for entry in entries}
+    now = datetime.now()
+    missing = [
+        dict(query, type=board, **fields, points=points, rank=None, last_updated=now)
+        for key, (query, points, fields) in totals.items()
+        if key not in known and points
+    ]
+    for start in range(0, len(missing), chunk_size):
+        db.leaderboard.insert_many(missing[start:start + chunk_size], ordered=False)
+    entries += missing
+    if not entries:
+        return
+    points = np.array([
+        totals[entry[key_field]][1] if entry.get(key_field) in totals else entry['points'] or 0
+        for entry in entries
+    ], dtype=np.int64)
+    current = np.array([entry['rank'] or len(entries) + 1 for entry in entries], dtype=np.int64)
+    ranks = np.empty(len(entries), dtype=np.int64)
+    # Highest points first, then the current rank, then insertion order
+    ranks[np.lexsort((np.arange(len(entries)), current, -points))] = np.arange(1, len(entries) + 1)
+    _bulk_write(db.leaderboard, [
+        UpdateOne({'_id': entry['_id']}, {'$set': {'points': value, 'rank': rank, 'last_updated': now}})
+        for entry, value, rank in zip(entries, points.tolist(), ranks.tolist())
+        if (value, rank) != (entry['points'], entry['rank'])
+    ], chunk_size)
+
+
+def _bulk_write(collection, updates, chunk_size):
+    for start in range(0, len(updates), chunk_size):
+        collection.bulk_write(updates[start:start + chunk_size], ordered=False)
@@ -0,0 +1,196 @@
+"""
+Live leaderboard feed over Server-Sent Events.
+
+``GET /api/leaderboard/stream/?type=individual|team`` is answered by the
+ASGI application directly. One hub per event loop reads the top of each
+board every ``OCTOFIT_LIVE_INTERVAL`` seconds while anyone is subscribed,
+diffs it with the previous read and fans the changed entries out to every
+subscriber, so the database sees one query per board per interval however
+many dashboards are open.
+
+Each subscriber has a small bounded queue. A client that falls behind does
+not hold up the hub or grow memory: its backlog is replaced by a snapshot
+of the boards it follows, which supersedes the changes it missed.
+"""
+import asyncio
+import json
+import logging
+import weakref
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from . import leaderboard, native, routing
+from .mongo import get_motor_db
+from .serializers import LeaderboardSerializer
+
+logger = logging.getLogger(__name__)
+
+STREAM_PATH = '/api/leaderboard/stream/'
+BOARDS = [leaderboard.INDIVIDUAL, leaderboard.TEAM]
+QUEUE_SIZE = 16
+HEARTBEAT = 15.0
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+class Subscriber:
+    def __init__(self, hub, boards):
+        self.hub = hub
+        self.boards = boards
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+
+    def offer(self, event):
+        """Queue an event; a full queue is collapsed into fresh snapshots"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            for board in self.boards:
+                self.queue.put_nowait(self.hub.snapshot(board))
+
+
+class LeaderboardHub:
+    """Reads the boards on behalf of every subscriber on one event loop"""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.entries = {board: {} for board in BOARDS}
+        self.sequence = 0
+        self.task = None
+        self.ready = asyncio.Event()
+
+    async def subscribe(self, boards):
+        subscriber = Subscriber(self, boards)
+        self.subscribers.add(subscriber)
+        if self.task is None or self.task.done():
+            self.ready.clear()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        await self.ready.wait()
+        # Changes published during the first read are part of the snapshot
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        for board in boards:
+            subscriber.offer(self.snapshot(board))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def event(self, name, data):
+        self.sequence += 1
+        return self.sequence, name, data
+
+    def snapshot(self, board):
+        return self.event('snapshot', {'type': board, 'entries': list(self.entries[board].values())})
+
+    def publish(self, board, changes, removed):
+        event = self.event('rank', {'type': board, 'changes': changes, 'removed': removed})
+        for subscriber in list(self.subscribers):
+            if board in subscriber.boards:
+                subscriber.offer(event)
+
+    async def run(self):
+        interval = getattr(settings, 'OCTOFIT_LIVE_INTERVAL', 1.0)
+        while self.subscribers:
+            for board in BOARDS:
+                try:
+                    await self.refresh(board)
+                except Exception:
+                    logger.exception('Could not read the %s leaderboard', board)
+            self.ready.set()
+            await asyncio.sleep(interval)
+        # The next subscriber starts from a fresh read
+        self.entries = {board: {} for board in BOARDS}
+
+    async def refresh(self, board):
+        size = getattr(settings, 'OCTOFIT_LIVE_BOARD_SIZE', 100)
+        serializer = native.document_serializer(LeaderboardSerializer)
+        collection = get_motor_db(routing.reporting_alias())['leaderboard']
+        cursor = collection.find({'type': board}).sort('rank', 1).limit(size)
+        entries = {}
+        for document in await cursor.to_list(size):
+            entry = serializer.to_representation(document)
+            entries[entry['id']] = entry
+        previous = self.entries[board]
+        changes = [entry for key, entry in entries.items() if previous.get(key) != entry]
+        removed = [key for key in previous if key not in entries]
+        self.entries[board] = entries
+        if changes or removed:
+            self.publish(board, changes, removed)
+
+
+def get_hub():
+    loop = asyncio.get_running_loop()
+    if loop not in _hubs:
+        _hubs[loop] = LeaderboardHub()
+    return _hubs[loop]
+
+
+def encode(event):
+    sequence, name, data = event
+    payload = json.dumps(data, separators=(',', ':'))
+    return f'id: {sequence}\nevent: {name}\ndata: {payload}\n\n'.encode('utf-8')
+
+
+async def _plain(send, status, message):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': message.encode('utf-8')})
+
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream(scope, receive, send):
+    """ASGI app streaming leaderboard changes as text/event-stream"""
+    if scope['method'] != 'GET':
+        return await _plain(send, 405, 'Method not allowed')
+    board = parse_qs(scope['query_string'].decode('latin-1')).get('type', [None])[0]
+    if board is not None and board not in BOARDS:
+        return await _plain(send, 400, f"type must be one of: {', '.join(BOARDS)}")
+
+    hub = get_hub()
+    subscriber = await hub.subscribe([board] if board else BOARDS)
+    headers = [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]
+    if getattr(settings, 'CORS_ALLOW_ALL_ORIGINS', False):
+        headers.append((b'access-control-allow-origin', b'*'))
+    disconnected = asyncio.ensure_future(_disconnected(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        while True:
+            get = asyncio.ensure_future(subscriber.queue.get())
+            done, _ = await asyncio.wait({get, disconnected}, timeout=HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                get.cancel()
+                break
+            if get in done:
+                body = encode(get.result())
+            else:
+                get.cancel()
+                body = b': keep-alive\n\n'
+            # Waits while the client's socket buffer is full; meanwhile the
+            # hub collapses this subscriber's backlog into snapshots
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    except OSError:
+        pass
+    finally:
+        hub.unsubscribe(subscriber)
+        disconnected.cancel()
+
+
+def with_live_feed(application):
+    """Wrap an ASGI application so ``STREAM_PATH`` is served by ``stream``"""
+    async def app(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == STREAM_PATH:
+            return await stream(scope, receive, send)
+        return await application(scope, receive, send)
+    return app
@@ -0,0 +1,125 @@
+"""
+Minimal asyncio HTTP/1.1 load generator for the load test and benchmark
+commands. Each simulated client keeps one keep-alive connection open and
+issues requests back to back until the deadline.
+"""
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def _read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if not size:
+                break
+            chunks.append(chunk[:-2])
+        body = b''.join(chunks)
+    else:
+        body = await reader.read()
+    if status_line.startswith(b'HTTP/1.0'):
+        keep_alive = headers.get('connection', '').lower() == 'keep-alive'
+    else:
+        keep_alive = headers.get('connection', '').lower() != 'close'
+    return status, len(body), keep_alive
+
+
+async def _client(host, port, paths, deadline, results):
+    connection = None
+    position = 0
+    while time.perf_counter() < deadline:
+        path = paths[position % len(paths)]
+        position += 1
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(host, port)
+            reader, writer = connection
+            request = f'GET {path} HTTP/1.1\r\nHost: {host}\r\nAccept: application/json\r\n\r\n'
+            start = time.perf_counter()
+            writer.write(request.encode('ascii'))
+            await writer.drain()
+            status, size, keep_alive = await _read_response(reader)
+            results['latencies'].append(time.perf_counter() - start)
+            results['bytes'] += size
+            if status >= 400:
+                results['errors'] += 1
+            if not keep_alive:
+                writer.close()
+                connection = None
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError):
+            results['errors'] += 1
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+async def _run(base_url, paths, concurrency, duration):
+    parts = urlsplit(base_url)
+    host, port = parts.hostname, parts.port or 80
+    prefix = parts.path.rstrip('/')
+    paths = [prefix + path for path in paths]
+    results = {'latencies': [], 'errors': 0, 'bytes': 0}
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(
+        _client(host, port, paths[i % len(paths):] + paths[:i % len(paths)], deadline, results)
+        for i in range(concurrency)
+    ))
+    return results, time.perf_counter() - started
+
+
+def run(base_url, paths, concurrency=1, duration=10.0):
+    """Drive ``paths`` on ``base_url`` with ``concurrency`` clients for
+    ``duration`` seconds and return latency and throughput statistics"""
+    results, elapsed = asyncio.run(_run(base_url, list(paths), concurrency, duration))
+    latencies = sorted(results['latencies'])
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': results['errors'],
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'bytes': results['bytes'],
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def wait_for_server(host, port, timeout=30.0):
+    """Block until something accepts connections on ``host:port``"""
+    async def probe():
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(host, port)
+                writer.close()
+                return
+            except OSError:
+                if time.perf_counter() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+    asyncio.run(probe())
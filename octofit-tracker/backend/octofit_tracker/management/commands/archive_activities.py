@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from octofit_tracker import archive
+
+
+class Command(BaseCommand):
+    help = 'Move old activities out of MongoDB into monthly compressed Parquet files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None, metavar='DAYS',
+                            help='Archive activities older than this many days '
+                                 '(default: OCTOFIT_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Count the activities that would be archived without moving them')
+
+    def handle(self, *args, **options):
+        if archive.pa is None:
+            raise CommandError('Archiving needs pyarrow (pip install pyarrow)')
+        days = options['older_than']
+        if days is None:
+            days = settings.OCTOFIT_ARCHIVE_AFTER_DAYS
+        if days < 1:
+            raise CommandError('--older-than must be at least 1 day')
+
+        moved = archive.archive_activities(days, dry_run=options['dry_run'])
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        for month, count in moved.items():
+            self.stdout.write(f'  {month}: {count}')
+        total = sum(moved.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {total} activities older than {days} days into {archive.activities.root}'))
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory
+from statistics import median
+import time
+
+from octofit_tracker.mongo import get_db
+from octofit_tracker.views import (
+    UserViewSet, TeamViewSet, ActivityViewSet,
+    LeaderboardViewSet, WorkoutViewSet
+)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the djongo ORM read path against the native pymongo read path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50,
+                            help='Requests per endpoint and read path')
+        parser.add_argument('--page-size', type=int, default=50)
+
+    def handle(self, *args, **options):
+        factory = APIRequestFactory()
+        page = {'page_size': options['page_size']}
+        activity = get_db().activities.find_one({}, {'user_email': 1}) or {}
+        email = activity.get('user_email', '')
+
+        cases = [
+            ('users', UserViewSet, 'list', page),
+            ('users/by_team', UserViewSet, 'by_team', page),
+            ('teams', TeamViewSet, 'list', page),
+            ('activities', ActivityViewSet, 'list', page),
+            ('activities?user_email', ActivityViewSet, 'list', dict(page, user_email=email)),
+            ('activities?search', ActivityViewSet, 'list', dict(page, search='run')),
+            ('activities/by_user', ActivityViewSet, 'by_user', dict(page, email=email)),
+            ('leaderboard', LeaderboardViewSet, 'list', page),
+            ('leaderboard/individual', LeaderboardViewSet, 'individual', page),
+            ('workouts', WorkoutViewSet, 'list', page),
+        ]
+
+        self.stdout.write(f"{'endpoint':<26}{'orm p50':>10}{'native p50':>12}{'speedup':>9}")
+        for name, viewset, action, params in cases:
+            view = viewset.as_view({'get': action})
+            timings = {}
+            payloads = {}
+            for path, native_reads in (('orm', False), ('native', True)):
+                with override_settings(OCTOFIT_NATIVE_READS=native_reads):
+                    payloads[path] = view(factory.get('/', params)).data
+                    samples = []
+                    for _ in range(options['iterations']):
+                        start = time.perf_counter()
+                        view(factory.get('/', params))
+                        samples.append(time.perf_counter() - start)
+                timings[path] = median(samples) * 1000
+
+            speedup = timings['orm'] / timings['native'] if timings['native'] else 0
+            self.stdout.write(
+                f"{name:<26}{timings['orm']:>8.2f}ms{timings['native']:>10.2f}ms{speedup:>8.1f}x"
+            )
+            if payloads['orm'] != payloads['native']:
+                self.stdout.write(self.style.WARNING(f'  {name}: responses differ between paths'))
@@ -0,0 +1,89 @@
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from bson import ObjectId
+from datetime import datetime, timedelta
+from statistics import median
+import random
+import time
+
+from octofit_tracker import compact, native
+from octofit_tracker.models import User, Activity, Leaderboard
+from octofit_tracker.serializers import UserSerializer, ActivitySerializer, LeaderboardSerializer
+
+
+def synthetic_documents(kind, count, rng):
+    now = datetime(2026, 10, 1)
+    documents = []
+    for n in range(count):
+        email = f'user{n}@octofit.test'
+        if kind == 'users':
+            documents.append({'_id': ObjectId(), 'name': f'User {n}', 'email': email, 'team': f'Team {n % 10}',
+                              'joined_date': now - timedelta(days=n % 365), 'total_points': rng.randint(0, 5000)})
+        elif kind == 'activities':
+            documents.append({'_id': ObjectId(), 'user_email': email, 'user_name': f'User {n}',
+                              'activity_type': rng.choice(['Running', 'Cycling', 'Yoga']),
+                              'duration': rng.randint(10, 120), 'calories': rng.randint(50, 900),
+                              'distance': round(rng.uniform(1, 40), 2) if n % 3 else None,
+                              'points': rng.randint(5, 150), 'date': now - timedelta(minutes=n),
+                              'notes': 'Morning session'})
+        else:
+            documents.append({'_id': ObjectId(), 'type': 'individual', 'name': f'User {n}', 'email': email,
+                              'team': f'Team {n % 10}', 'points': 10000 - n, 'rank': n + 1,
+                              'last_updated': now})
+    return documents
+
+
+class Command(BaseCommand):
+    help = 'Benchmark DRF serializers against the compact fast path on in-memory documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000, help='Documents per response')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        renderer = JSONRenderer()
+        cases = [
+            ('users', User, UserSerializer),
+            ('activities', Activity, ActivitySerializer),
+            ('leaderboard', Leaderboard, LeaderboardSerializer),
+        ]
+        if compact.orjson is None:
+            self.stdout.write(self.style.WARNING('orjson is not installed; compact rows use the json module'))
+
+        self.stdout.write(f"{'serializer':<14}{'drf p50':>10}{'native p50':>12}{'compact p50':>13}{'speedup':>9}")
+        for name, model, serializer_class in cases:
+            documents = synthetic_documents(name, options['rows'], rng)
+            instances = [model(**document) for document in documents]
+            document_serializer = native.document_serializer(serializer_class)
+            compact_serializer = compact.CompactSerializer(serializer_class)
+
+            def drf():
+                return renderer.render({'results': serializer_class(instances, many=True).data})
+
+            def native_path():
+                return renderer.render({'results': document_serializer.many(documents)})
+
+            def compact_path():
+                rows = compact_serializer.many(documents)
+                return compact_serializer.dumps({'results': rows}, rows)
+
+            timings = {}
+            payloads = {}
+            for path, func in (('drf', drf), ('native', native_path), ('compact', compact_path)):
+                payloads[path] = func()
+                samples = []
+                for _ in range(options['iterations']):
+                    start = time.perf_counter()
+                    func()
+                    samples.append(time.perf_counter() - start)
+                timings[path] = median(samples) * 1000
+
+            speedup = timings['drf'] / timings['compact'] if timings['compact'] else 0
+            self.stdout.write(
+                f"{name:<14}{timings['drf']:>8.2f}ms{timings['native']:>10.2f}ms"
+                f"{timings['compact']:>11.2f}ms{speedup:>8.1f}x"
+            )
+            if not payloads['drf'] == payloads['native'] == payloads['compact']:
+                self.stdout.write(self.style.WARNING(f'  {name}: output differs between paths'))
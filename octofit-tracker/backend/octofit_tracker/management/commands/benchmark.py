@@ -0,0 +1,158 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from datetime import datetime
+from io import StringIO
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from octofit_tracker import loadtest
+from octofit_tracker.mongo import get_db
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def rss_mb(pid):
+    """Current and peak resident set size of a process, from /proc"""
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    values[name] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return values.get('VmRSS'), values.get('VmHWM')
+
+
+class Command(BaseCommand):
+    help = ('Seed the database at a configurable scale, drive every API endpoint with '
+            'concurrent clients and write latency/throughput/memory figures to a JSON report')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=None,
+                            help='Reseed with populate_db using this many synthetic users')
+        parser.add_argument('--activities-per-user', type=int, default=10)
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds per endpoint')
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8002)
+        parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes')
+        parser.add_argument('--no-server', action='store_true',
+                            help='Use a server that is already listening on --host/--port')
+        parser.add_argument('--output', default=None,
+                            help='Report path (default: benchmark-<commit>.json)')
+        parser.add_argument('--compare', default=None,
+                            help='Earlier report to print a p95/throughput comparison against')
+
+    def endpoints(self):
+        db = get_db()
+        activity = db.activities.find_one({}, {'user_email': 1}) or {}
+        team = db.teams.find_one({}, {'name': 1}) or {}
+        user = db.users.find_one({}, {'_id': 1}) or {}
+        email = activity.get('user_email', '')
+        endpoints = {
+            'users': '/api/users/',
+            'users/by_team': f"/api/users/by_team/?team={team.get('name', '')}",
+            'teams': '/api/teams/',
+            'activities': '/api/activities/',
+            'activities?user_email': f'/api/activities/?user_email={email}',
+            'activities?ordering=points': '/api/activities/?ordering=-points',
+            'activities/by_user': f'/api/activities/by_user/?email={email}',
+            'activities/recent': '/api/activities/recent/',
+            'leaderboard': '/api/leaderboard/',
+            'leaderboard/individual': '/api/leaderboard/individual/',
+            'leaderboard/team': '/api/leaderboard/team/',
+            'workouts': '/api/workouts/',
+        }
+        if user:
+            endpoints['users/<id>'] = f"/api/users/{user['_id']}/"
+        if team:
+            endpoints['teams/<id>/members'] = f"/api/teams/{team['_id']}/members/"
+        return {name: path.replace(' ', '%20') for name, path in endpoints.items()}
+
+    def handle(self, *args, **options):
+        commit = git_commit()
+        report = {
+            'commit': commit,
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'config': {key: options[key] for key in (
+                'users', 'activities_per_user', 'concurrency', 'duration', 'workers')},
+            'seed': None,
+            'endpoints': {},
+        }
+
+        if options['users'] is not None:
+            self.stdout.write(f"Seeding {options['users']} users x {options['activities_per_user']} activities...")
+            start = time.perf_counter()
+            call_command('populate_db', users=options['users'],
+                         activities_per_user=options['activities_per_user'], stdout=StringIO())
+            report['seed'] = {'seconds': time.perf_counter() - start}
+            self.stdout.write(f"  done in {report['seed']['seconds']:.1f}s")
+
+        db = get_db()
+        report['dataset'] = {
+            name: db[name].estimated_document_count()
+            for name in ('users', 'teams', 'activities', 'leaderboard', 'workouts')
+        }
+
+        host, port = options['host'], options['port']
+        server = None
+        if not options['no_server']:
+            server = subprocess.Popen([
+                sys.executable, '-m', 'uvicorn', 'octofit_tracker.asgi:application',
+                '--host', host, '--port', str(port), '--workers', str(options['workers']),
+                '--log-level', 'warning',
+            ])
+
+        try:
+            loadtest.wait_for_server(host, port)
+            base_url = f'http://{host}:{port}'
+            self.stdout.write(f"{'endpoint':<28}{'req/s':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'rss':>9}")
+            for name, path in self.endpoints().items():
+                stats = loadtest.run(base_url, [path], options['concurrency'], options['duration'])
+                if server is not None:
+                    stats['server_rss_mb'], stats['server_peak_rss_mb'] = rss_mb(server.pid)
+                report['endpoints'][name] = stats
+                rss = stats.get('server_rss_mb')
+                self.stdout.write(
+                    f"{name:<28}{stats['throughput']:>9.1f}{stats['p50_ms']:>8.1f}ms"
+                    f"{stats['p95_ms']:>8.1f}ms{stats['p99_ms']:>8.1f}ms"
+                    f"{(f'{rss:.0f}MB' if rss else '-'):>9}"
+                )
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+        output = options['output'] or f'benchmark-{commit}.json'
+        with open(output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {output}'))
+
+        if options['compare']:
+            self.compare(options['compare'], report)
+
+    def compare(self, path, report):
+        with open(path) as handle:
+            baseline = json.load(handle)
+        self.stdout.write(f"\nCompared with {baseline.get('commit')} ({path}):")
+        self.stdout.write(f"{'endpoint':<28}{'p95 before':>12}{'p95 after':>12}{'req/s change':>14}")
+        for name, stats in report['endpoints'].items():
+            before = baseline.get('endpoints', {}).get(name)
+            if not before:
+                continue
+            change = (stats['throughput'] / before['throughput'] - 1) * 100 if before['throughput'] else 0
+            self.stdout.write(
+                f"{name:<28}{before['p95_ms']:>10.1f}ms{stats['p95_ms']:>10.1f}ms{change:>+13.1f}%"
+            )
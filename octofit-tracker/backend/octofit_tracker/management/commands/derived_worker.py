@@ -0,0 +1,103 @@
+import time
+
+from django.core.management.base import BaseCommand
+from pymongo.errors import OperationFailure
+
+from octofit_tracker import changefeed
+from octofit_tracker.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = ('Apply derived-data updates (totals, ranks, rollups, stats, denormalized copies) '
+            'from changes to activities and users; use with OCTOFIT_DERIVED_DATA = "worker"')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['auto', 'stream', 'poll'], default='auto',
+                            help='Change streams (replica sets) or polling (single-node servers)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Most changes per micro-batch')
+        parser.add_argument('--max-wait', type=float, default=1.0,
+                            help='Seconds a change stream micro-batch stays open')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds between polls when nothing new was found')
+        parser.add_argument('--reconcile-interval', type=float, default=300.0,
+                            help='Seconds between update/delete sweeps in poll mode')
+        parser.add_argument('--bootstrap', action='store_true',
+                            help='Treat the current derived data as up to date and start from now')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once caught up instead of running forever')
+
+    def handle(self, *args, **options):
+        self.db = get_db()
+        self.options = options
+        mode = options['mode']
+        if mode == 'auto':
+            mode = 'stream' if changefeed.supports_change_streams(self.db) else 'poll'
+        state = changefeed.load_state(self.db)
+        fresh = state is None or options['bootstrap']
+        if fresh:
+            state = {}
+        self.stdout.write(f'Following activities and users ({mode} mode)')
+        if mode == 'stream':
+            self.stream(state.get('token'), fresh)
+        else:
+            self.poll(state.get('checkpoints'), fresh)
+
+    def apply(self, events):
+        changefeed.apply_events(events, self.db)
+        count = sum(len(documents) for documents in events.values())
+        if count and self.options['verbosity'] > 1:
+            self.stdout.write(f'Applied {count} changed documents')
+        return count
+
+    def catch_up(self, fresh):
+        """Start a follower that has no usable resume point"""
+        if fresh:
+            self.stdout.write('Bootstrapping shadows from the current data...')
+            return changefeed.bootstrap(self.db)
+        # Anything written from here on is picked up by polling anyway
+        checkpoints = changefeed.latest_ids(self.db)
+        self.stdout.write('Reconciling against the shadows...')
+        self.sweep()
+        return checkpoints
+
+    def sweep(self):
+        for events in changefeed.reconcile(self.db, self.options['batch_size']):
+            self.apply(events)
+
+    def stream(self, token, fresh):
+        options = self.options
+        batches = changefeed.watch(self.db, token, options['batch_size'], options['max_wait'])
+        try:
+            # Opening the stream first fixes the point replay starts from
+            events, token = next(batches)
+        except OperationFailure as exc:
+            if token is None:
+                raise
+            self.stderr.write(f'Cannot resume the change stream ({exc}); starting over')
+            return self.stream(None, fresh)
+        if fresh or token is None:
+            self.catch_up(fresh)
+        while True:
+            count = self.apply(events)
+            changefeed.save_state(self.db, mode='stream', token=token)
+            if options['once'] and not count:
+                return
+            events, token = next(batches)
+
+    def poll(self, checkpoints, fresh):
+        options = self.options
+        if fresh or checkpoints is None:
+            checkpoints = self.catch_up(fresh)
+        last_sweep = time.monotonic()
+        while True:
+            events, checkpoints = changefeed.poll(self.db, checkpoints, options['batch_size'])
+            count = self.apply(events)
+            changefeed.save_state(self.db, mode='poll', checkpoints=checkpoints)
+            if options['once'] and not count:
+                self.sweep()
+                return
+            if time.monotonic() - last_sweep >= options['reconcile_interval']:
+                self.sweep()
+                last_sweep = time.monotonic()
+            if not count:
+                time.sleep(options['poll_interval'])
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker import indexes
+
+
+class Command(BaseCommand):
+    help = 'Create the MongoDB indexes implied by the API viewsets and report unused or missing ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='List the indexes that would be created without creating them')
+        parser.add_argument('--report', action='store_true',
+                            help='Report unused indexes ($indexStats) and unindexed queries (explain)')
+
+    def handle(self, *args, **options):
+        created = indexes.ensure_indexes(dry_run=options['dry_run'])
+        verb = 'Would create' if options['dry_run'] else 'Created'
+        if not created:
+            self.stdout.write(self.style.SUCCESS('All indexes are in place'))
+        for collection, names in created.items():
+            for name in names:
+                self.stdout.write(self.style.SUCCESS(f'{verb} index {collection}.{name}'))
+
+        if not options['report']:
+            return
+
+        self.stdout.write('\nUnused indexes (no operations since server start):')
+        unused = indexes.unused_indexes()
+        for collection, name, ops in unused:
+            self.stdout.write(self.style.WARNING(f'  {collection}.{name}'))
+        if not unused:
+            self.stdout.write('  none')
+
+        self.stdout.write('\nQueries not served by an index:')
+        problems = indexes.unindexed_queries()
+        for collection, keys, stages in problems:
+            spec = ', '.join(f'{field} {direction}' for field, direction in keys)
+            self.stdout.write(self.style.WARNING(f"  {collection} ({spec}): {' + '.join(stages)}"))
+        if not problems:
+            self.stdout.write('  none')
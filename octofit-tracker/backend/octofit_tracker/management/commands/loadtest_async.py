@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+import shutil
+import subprocess
+import sys
+
+from octofit_tracker import loadtest
+
+
+class Command(BaseCommand):
+    help = ('Load test the sync DRF read API against the async Motor read API under '
+            'a single uvicorn worker pinned to one CPU core')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--duration', type=float, default=10.0,
+                            help='Seconds per resource, read path and concurrency level')
+        parser.add_argument('--concurrency', default='1,8,32,128',
+                            help='Comma-separated concurrency levels')
+        parser.add_argument('--resources', default='activities,leaderboard',
+                            help='Comma-separated router prefixes to exercise')
+        parser.add_argument('--cpu', type=int, default=0, help='CPU core to pin the server to')
+        parser.add_argument('--no-server', action='store_true',
+                            help='Use a server that is already listening on --host/--port')
+
+    def handle(self, *args, **options):
+        host, port = options['host'], options['port']
+        server = None
+        if not options['no_server']:
+            command = [
+                sys.executable, '-m', 'uvicorn', 'octofit_tracker.asgi:application',
+                '--host', host, '--port', str(port), '--workers', '1', '--log-level', 'warning',
+            ]
+            if shutil.which('taskset'):
+                command = ['taskset', '-c', str(options['cpu'])] + command
+            else:
+                self.stdout.write(self.style.WARNING('taskset not found; the server is not pinned'))
+            server = subprocess.Popen(command)
+
+        try:
+            loadtest.wait_for_server(host, port)
+            base_url = f'http://{host}:{port}'
+            levels = [int(level) for level in options['concurrency'].split(',')]
+            self.stdout.write(f"{'path':<28}{'clients':>8}{'req/s':>10}{'p50':>10}{'p99':>10}{'errors':>8}")
+            for resource in options['resources'].split(','):
+                for path in (f'/api/{resource}/', f'/api/async/{resource}/'):
+                    for level in levels:
+                        stats = loadtest.run(base_url, [path], level, options['duration'])
+                        self.stdout.write(
+                            f"{path:<28}{level:>8}{stats['throughput']:>10.1f}"
+                            f"{stats['p50_ms']:>8.1f}ms{stats['p99_ms']:>8.1f}ms{stats['errors']:>8}"
+                        )
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
@@ -1,16 +1,133 @@
-from django.core.management.base import BaseCommand
-from pymongo import MongoClient
+from django.core.management.base import BaseCommand, CommandError
+from array import array
+from collections import Counter
 from datetime import datetime, timedelta
+from itertools import count
+from multiprocessing import Pool
 import random
 
+from octofit_tracker import response_cache, rollups, scoring, stats
+from octofit_tracker.mongo import get_db
+
+
+CHUNK_SIZE = 5000
+ACTIVITY_TYPES = ['Running', 'Cycling', 'Swimming', 'Weightlifting', 'Yoga', 'Boxing', 'CrossFit']
+HERO_TEAMS = ['Team Marvel', 'Team DC']
+
+# Database handle of a pool worker, opened by init_worker
+_db = None
+
+
+def init_worker():
+    global _db
+    _db = get_db()
+
+
+def synthetic_user(n, teams):
+    return {'name': f'Athlete {n}', 'email': f'athlete{n}@octofit.test', 'team': teams[n % len(teams)]}
+
+
+def random_activity(rng, user, now):
+    activity_type = rng.choice(ACTIVITY_TYPES)
+    duration = rng.randint(20, 120)  # minutes
+    distance = round(rng.uniform(1.0, 15.0), 2) if rng.choice([True, False]) else None
+    points, calories = scoring.score(activity_type, duration, distance)
+    return {
+        'user_email': user['email'],
+        'user_name': user['name'],
+        'activity_type': activity_type,
+        'duration': duration,
+        'distance': distance,
+        'calories': calories,
+        'points': points,
+        'date': now - timedelta(days=rng.randint(0, 30)),
+        'notes': 'Great workout session!'
+    }
+
+
+def generate_users(task):
+    """Insert synthetic users ``start..end`` with their activities and
+    return their point totals in order"""
+    start, end, seed, activities_per_user, teams, now = task
+    rng = random.Random(f'{seed}:{start}')
+    users = []
+    activities = []
+    points = array('q')
+    for n in range(start, end):
+        user = synthetic_user(n, teams)
+        total = 0
+        for _ in range(activities_per_user if activities_per_user is not None else rng.randint(3, 8)):
+            activity = random_activity(rng, user, now)
+            total += activity['points']
+            activities.append(activity)
+        if len(activities) >= CHUNK_SIZE:
+            _db.activities.insert_many(activities, ordered=False)
+            activities = []
+        user['joined_date'] = now - timedelta(days=rng.randint(1, 365))
+        user['total_points'] = total
+        users.append(user)
+        points.append(total)
+    if activities:
+        _db.activities.insert_many(activities, ordered=False)
+    _db.users.insert_many(users, ordered=False)
+    return points
+
+
+def write_leaderboard(task):
+    """Insert the individual leaderboard entries of synthetic users ``start..``"""
+    start, points, ranks, teams, now = task
+    _db.leaderboard.insert_many([
+        {'type': 'individual', **synthetic_user(n, teams), 'points': value, 'rank': rank, 'last_updated': now}
+        for n, value, rank in zip(count(start), points, ranks)
+    ], ordered=False)
+    return len(points)
+
+
+def first_ranks(histogram):
+    """Map each points value to the first rank it occupies, highest first"""
+    ranks = {}
+    rank = 1
+    for value in sorted(histogram, reverse=True):
+        ranks[value] = rank
+        rank += histogram[value]
+    return ranks
+
+
+def run_tasks(func, tasks, workers):
+    """Yield ``func(task)`` for every task, in order, across ``workers`` processes"""
+    if workers > 1:
+        with Pool(workers, initializer=init_worker) as pool:
+            yield from pool.imap(func, tasks)
+    else:
+        init_worker()
+        yield from map(func, tasks)
+
 
 class Command(BaseCommand):
     help = 'Populate the octofit_db database with test data'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=0,
+                            help='Synthetic users to add on top of the heroes')
+        parser.add_argument('--teams', type=int, default=len(HERO_TEAMS),
+                            help='Teams, including the two hero teams, synthetic users are spread over')
+        parser.add_argument('--activities-per-user', type=int, default=None,
+                            help='Activities per synthetic user (default: 3-8 at random)')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed; the same seed and options reproduce the same data')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes generating and inserting synthetic users')
+
     def handle(self, *args, **options):
-        # Connect to MongoDB
-        client = MongoClient('localhost', 27017)
-        db = client['octofit_db']
+        if options['teams'] < len(HERO_TEAMS):
+            raise CommandError(f'--teams must be at least {len(HERO_TEAMS)}')
+        seed = options['seed'] if options['seed'] is not None else random.randrange(2 ** 32)
+        rng = random.Random(f'{seed}:heroes')
+        now = datetime.now()
+        team_names = HERO_TEAMS + [f'Team {n}' for n in range(len(HERO_TEAMS) + 1, options['teams'] + 1)]
+
+        # Writes go to the primary through the shared client of the default alias
+        db = get_db()
         
         self.stdout.write('Clearing existing data...')
         # Delete existing data
@@ -19,6 +136,8 @@ class Command(BaseCommand):
         db.activities.delete_many({})
         db.leaderboard.delete_many({})
         db.workouts.delete_many({})
+        db[stats.COLLECTION].delete_many({})
+        db[rollups.COLLECTION].delete_many({})
         
         # Create unique index on email field
         db.users.create_index('email', unique=True)
@@ -46,19 +165,45 @@ class Command(BaseCommand):
         
         all_heroes = marvel_heroes + dc_heroes
         
-        # Insert users
-        self.stdout.write('Inserting users...')
+        # Totals are accumulated while generating so nothing is read back
+        histogram = Counter()
+        team_totals = dict.fromkeys(team_names, 0)
+        
+        # Insert users and their activities
+        self.stdout.write('Inserting users and activities...')
+        users = []
+        activities = []
         for hero in all_heroes:
-            user_doc = {
+            hero_activities = [random_activity(rng, hero, now) for i in range(rng.randint(3, 8))]
+            users.append({
                 'name': hero['name'],
                 'email': hero['email'],
                 'team': hero['team'],
-                'joined_date': datetime.now() - timedelta(days=random.randint(1, 90)),
-                'total_points': 0
-            }
-            db.users.insert_one(user_doc)
+                'joined_date': now - timedelta(days=rng.randint(1, 90)),
+                'total_points': sum(activity['points'] for activity in hero_activities)
+            })
+            activities.extend(hero_activities)
+        db.users.insert_many(users)
+        db.activities.insert_many(activities)
+        for user in users:
+            histogram[user['total_points']] += 1
+            team_totals[user['team']] += user['total_points']
+        self.stdout.write(self.style.SUCCESS(f'Inserted {len(users)} users and {len(activities)} activities'))
         
-        self.stdout.write(self.style.SUCCESS(f'Inserted {len(all_heroes)} users'))
+        synthetic = options['users']
+        points = array('q')
+        if synthetic:
+            self.stdout.write(f"Inserting {synthetic} synthetic users and their activities (seed {seed})...")
+            tasks = (
+                (start, min(start + CHUNK_SIZE, synthetic), seed, options['activities_per_user'], team_names, now)
+                for start in range(0, synthetic, CHUNK_SIZE)
+            )
+            for chunk in run_tasks(generate_users, tasks, options['workers']):
+                for n, value in enumerate(chunk, len(points)):
+                    histogram[value] += 1
+                    team_totals[team_names[n % len(team_names)]] += value
+                points.extend(chunk)
+                self.stdout.write(f'  {len(points)}/{synthetic} synthetic users')
         
         # Insert teams
         self.stdout.write('Inserting teams...')
@@ -66,94 +211,83 @@ class Command(BaseCommand):
             {
                 'name': 'Team Marvel',
                 'description': 'Avengers assemble! The mightiest heroes of Earth.',
-                'created_date': datetime.now() - timedelta(days=60),
-                'total_points': 0,
+                'created_date': now - timedelta(days=60),
+                'total_points': team_totals['Team Marvel'],
                 'members': [hero['email'] for hero in marvel_heroes]
             },
             {
                 'name': 'Team DC',
                 'description': 'Justice League united! Defenders of truth and justice.',
-                'created_date': datetime.now() - timedelta(days=55),
-                'total_points': 0,
+                'created_date': now - timedelta(days=55),
+                'total_points': team_totals['Team DC'],
                 'members': [hero['email'] for hero in dc_heroes]
             }
         ]
+        # Synthetic members are found through users.team, as listing them
+        # here would outgrow the document size limit
+        teams.extend({
+            'name': name,
+            'description': f'Synthetic team {name}',
+            'created_date': now - timedelta(days=rng.randint(1, 365)),
+            'total_points': team_totals[name],
+            'members': []
+        } for name in team_names[len(HERO_TEAMS):])
         db.teams.insert_many(teams)
         self.stdout.write(self.style.SUCCESS(f'Inserted {len(teams)} teams'))
         
-        # Insert activities
-        self.stdout.write('Inserting activities...')
-        activity_types = ['Running', 'Cycling', 'Swimming', 'Weightlifting', 'Yoga', 'Boxing', 'CrossFit']
-        activities = []
-        
-        for hero in all_heroes:
-            for i in range(random.randint(3, 8)):
-                activity = {
-                    'user_email': hero['email'],
-                    'user_name': hero['name'],
-                    'activity_type': random.choice(activity_types),
-                    'duration': random.randint(20, 120),  # minutes
-                    'distance': round(random.uniform(1.0, 15.0), 2) if random.choice([True, False]) else None,
-                    'calories': random.randint(100, 800),
-                    'points': random.randint(10, 50),
-                    'date': datetime.now() - timedelta(days=random.randint(0, 30)),
-                    'notes': 'Great workout session!'
-                }
-                activities.append(activity)
-        
-        db.activities.insert_many(activities)
-        self.stdout.write(self.style.SUCCESS(f'Inserted {len(activities)} activities'))
-        
-        # Calculate and update user points
-        self.stdout.write('Calculating user points...')
-        for hero in all_heroes:
-            user_activities = db.activities.find({'user_email': hero['email']})
-            total_points = sum(activity['points'] for activity in user_activities)
-            db.users.update_one(
-                {'email': hero['email']},
-                {'$set': {'total_points': total_points}}
-            )
-        
-        # Calculate and update team points
-        self.stdout.write('Calculating team points...')
-        for team in teams:
-            team_users = db.users.find({'team': team['name']})
-            total_points = sum(user['total_points'] for user in team_users)
-            db.teams.update_one(
-                {'name': team['name']},
-                {'$set': {'total_points': total_points}}
-            )
-        
-        # Insert leaderboard entries
+        # Insert leaderboard entries, ranked from the points histogram:
+        # equal points take consecutive ranks in insertion order
         self.stdout.write('Inserting leaderboard entries...')
-        leaderboard_entries = []
+        next_rank = first_ranks(histogram)
+        
+        def take_rank(value):
+            rank = next_rank[value]
+            next_rank[value] += 1
+            return rank
         
         # Individual leaderboard
-        users = list(db.users.find().sort('total_points', -1))
-        for rank, user in enumerate(users, 1):
-            leaderboard_entries.append({
+        db.leaderboard.insert_many([
+            {
                 'type': 'individual',
                 'name': user['name'],
                 'email': user['email'],
                 'team': user['team'],
                 'points': user['total_points'],
-                'rank': rank,
-                'last_updated': datetime.now()
-            })
+                'rank': take_rank(user['total_points']),
+                'last_updated': now
+            }
+            for user in users
+        ])
+        tasks = (
+            (start, points[start:start + CHUNK_SIZE],
+             array('q', map(take_rank, points[start:start + CHUNK_SIZE])), team_names, now)
+            for start in range(0, len(points), CHUNK_SIZE)
+        )
+        for _ in run_tasks(write_leaderboard, tasks, options['workers']):
+            pass
         
         # Team leaderboard
-        teams_sorted = list(db.teams.find().sort('total_points', -1))
-        for rank, team in enumerate(teams_sorted, 1):
-            leaderboard_entries.append({
+        teams_sorted = sorted(teams, key=lambda team: team['total_points'], reverse=True)
+        db.leaderboard.insert_many([
+            {
                 'type': 'team',
                 'name': team['name'],
                 'points': team['total_points'],
                 'rank': rank,
-                'last_updated': datetime.now()
-            })
+                'last_updated': now
+            }
+            for rank, team in enumerate(teams_sorted, 1)
+        ])
+        self.stdout.write(self.style.SUCCESS(
+            f"Inserted {len(users) + len(points) + len(teams)} leaderboard entries"))
+        
+        self.stdout.write('Building day, week and month leaderboard rollups...')
+        rollups.rebuild(db)
+        self.stdout.write(self.style.SUCCESS(
+            f'Inserted {db[rollups.COLLECTION].count_documents({})} rollups'))
         
-        db.leaderboard.insert_many(leaderboard_entries)
-        self.stdout.write(self.style.SUCCESS(f'Inserted {len(leaderboard_entries)} leaderboard entries'))
+        self.stdout.write('Building per-user activity statistics...')
+        stats.rebuild(db)
         
         # Insert workout suggestions
         self.stdout.write('Inserting workout suggestions...')
@@ -240,4 +374,4 @@ class Command(BaseCommand):
         self.stdout.write(f'Leaderboard entries: {db.leaderboard.count_documents({})}')
         self.stdout.write(f'Workouts: {db.workouts.count_documents({})}')
         
-        client.close()
+        response_cache.invalidate('leaderboard', 'workouts')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from octofit_tracker import scoring
+
+
+class Command(BaseCommand):
+    help = ('Recompute the points and calories of every activity, hot and archived, with the '
+            'current scoring rules and rebuild user and team totals and the leaderboards')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=scoring.CHUNK_SIZE,
+                            help='Activities scored and written per batch')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Count the activities whose scores would change without writing')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+        result = scoring.rescore(chunk_size=options['chunk_size'], dry_run=options['dry_run'])
+        verb = 'Would rescore' if options['dry_run'] else 'Rescored'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {result.changed} of {result.scanned} activities'))
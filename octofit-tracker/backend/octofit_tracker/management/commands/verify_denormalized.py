@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker import propagation
+
+
+class Command(BaseCommand):
+    help = ('Find activities, leaderboard entries, rollups and team member lists whose copies '
+            'of user fields have drifted from the users collection, and optionally repair them')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Fix the drift that is found')
+        parser.add_argument('--chunk-size', type=int, default=propagation.CHUNK_SIZE,
+                            help='Users checked, and repairs written, per batch')
+
+    def handle(self, *args, **options):
+        found = {}
+        drift = []
+        for collection, operation, count in propagation.find_drift(chunk_size=options['chunk_size']):
+            found[collection] = found.get(collection, 0) + count
+            if options['repair']:
+                drift.append((collection, operation, count))
+                if len(drift) >= options['chunk_size']:
+                    propagation.repair(drift, chunk_size=options['chunk_size'])
+                    drift = []
+        if drift:
+            propagation.repair(drift, chunk_size=options['chunk_size'])
+
+        if not found:
+            self.stdout.write(self.style.SUCCESS('No drift found'))
+        for collection, count in sorted(found.items()):
+            verb = 'Repaired' if options['repair'] else 'Found'
+            self.stdout.write(self.style.WARNING(f'{verb} {count} drifted documents in {collection}'))
+
@@ -0,0 +1,91 @@
+"""
+Shared pymongo and Motor access for code paths that talk to MongoDB
+directly instead of going through djongo's SQL translation.
+
+Motor is only imported by the async API and the live feed. djongo needs
+pymongo 3, so Motor stays on 2.5, which does not import on Python 3.11 or
+later; the ``octofit_tracker.W001`` system check reports that combination.
+"""
+import asyncio
+import os
+import sys
+import threading
+import weakref
+from importlib import metadata
+
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from pymongo import MongoClient
+
+_clients = {}
+_lock = threading.Lock()
+# Motor clients are bound to the event loop they were first used on
+_motor_clients = weakref.WeakKeyDictionary()
+
+
+def _client_options(settings_dict):
+    options = dict(settings_dict.get('CLIENT', {}))
+    options.pop('name', None)
+    return options
+
+
+def get_client(alias='default'):
+    """Return the pooled MongoClient for a Django database alias.
+
+    Clients are per process: a forked worker (e.g. populate_db's pool) opens
+    its own instead of reusing its parent's sockets.
+    """
+    options = _client_options(connections[alias].settings_dict)
+    key = (os.getpid(), alias, tuple(sorted((k, repr(v)) for k, v in options.items())))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = MongoClient(**options)
+                _clients[key] = client
+    return client
+
+
+def get_db(alias='default'):
+    """Return the pymongo Database backing a Django database alias; read
+    paths pass ``routing.read_alias()``.
+
+    The name is read on every call so the test runner's ``test_`` database
+    is picked up once it has been created.
+    """
+    return get_client(alias)[connections[alias].settings_dict['NAME']]
+
+
+def check_motor(app_configs, **kwargs):
+    """Motor 2 (for pymongo 3) needs Python 3.10 or earlier"""
+    try:
+        version = metadata.version('motor')
+    except metadata.PackageNotFoundError:
+        return []
+    if version.startswith('2.') and sys.version_info >= (3, 11):
+        return [checks.Warning(
+            f'motor {version} does not run on Python {sys.version_info.major}.{sys.version_info.minor}',
+            hint='The async API (/api/async/) and the live leaderboard feed need Python 3.10; '
+                 'the synchronous API is unaffected.',
+            id='octofit_tracker.W001',
+        )]
+    return []
+
+
+def get_motor_db(alias='default'):
+    """Return a Motor (asyncio) Database for the running event loop"""
+    # Imported here so the synchronous API does not depend on Motor loading
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient
+    except ImportError as exc:
+        raise ImproperlyConfigured(
+            'The async API needs motor 2.5 (for pymongo 3), which runs on Python 3.10 or earlier') from exc
+
+    loop = asyncio.get_running_loop()
+    settings_dict = connections[alias].settings_dict
+    clients = _motor_clients.setdefault(loop, {})
+    if alias not in clients:
+        clients[alias] = AsyncIOMotorClient(io_loop=loop, **_client_options(settings_dict))
+    return clients[alias][settings_dict['NAME']]
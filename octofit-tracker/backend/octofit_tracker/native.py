@@ -0,0 +1,236 @@
+"""
+Native MongoDB read path.
+
+Builds pymongo queries straight from a viewset's ``filterset_fields``,
+``search_fields`` and ordering declarations so list and detail reads skip
+djongo's SQL generation and re-parsing. Documents are shaped with the
+viewset's own serializer fields, so responses match the ORM path.
+"""
+import copy
+import functools
+import heapq
+import itertools
+import re
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.http import Http404
+from pymongo import ASCENDING, DESCENDING
+from rest_framework import filters, serializers
+from rest_framework.exceptions import ValidationError
+
+from . import archive, routing, search
+from .mongo import get_db
+
+
+def collection_for(model):
+    return get_db(routing.read_alias())[model._meta.db_table]
+
+
+def to_sort(ordering):
+    """Turn Django ``order_by`` terms into a pymongo sort specification"""
+    return [
+        (term.lstrip('-'), DESCENDING if term.startswith('-') else ASCENDING)
+        for term in ordering
+    ]
+
+
+def sort_key(sort):
+    """Key ordering documents like the pymongo ``sort`` specification"""
+    def compare(a, b):
+        for field, direction in sort:
+            x, y = a.get(field), b.get(field)
+            if x == y:
+                continue
+            # Nulls sort first in ascending order, as in MongoDB
+            if x is None or (y is not None and x < y):
+                return -direction
+            return direction
+        return 0
+    return functools.cmp_to_key(compare)
+
+
+def _unchanged(value):
+    return value
+
+
+class DocumentSerializer:
+    """
+    Shape raw Mongo documents the way a ModelSerializer shapes model
+    instances, reusing the serializer's own field ``to_representation``.
+    """
+    # Document fields a ``subset`` needs from Mongo; None reads whole documents
+    projection_fields = None
+
+    def __init__(self, serializer_class):
+        self.fields = []
+        for name, field in serializer_class().fields.items():
+            if name == 'id' and isinstance(field, serializers.SerializerMethodField):
+                self.fields.append((name, '_id', str))
+            elif isinstance(field, serializers.ModelField):
+                # ModelField reads the value off a model instance; documents
+                # already hold it (e.g. a JSONField's list or dict)
+                self.fields.append((name, field.source, _unchanged))
+            else:
+                self.fields.append((name, field.source, field.to_representation))
+
+    def names(self):
+        return [name for name, _, _ in self.fields]
+
+    def subset(self, names):
+        """Return a copy shaping only ``names``; None keeps every field"""
+        if names is None:
+            return self
+        subset = copy.copy(self)
+        subset.fields = [field for field in self.fields if field[0] in names]
+        subset.projection_fields = [source for _, source, _ in subset.fields]
+        return subset
+
+    def to_representation(self, document):
+        data = {}
+        for name, source, to_representation in self.fields:
+            value = document.get(source)
+            data[name] = None if value is None else to_representation(value)
+        return data
+
+    def many(self, documents):
+        return [self.to_representation(document) for document in documents]
+
+
+_document_serializers = {}
+
+
+def document_serializer(serializer_class):
+    if serializer_class not in _document_serializers:
+        _document_serializers[serializer_class] = DocumentSerializer(serializer_class)
+    return _document_serializers[serializer_class]
+
+
+class NativeQuery:
+    """
+    A pymongo query equivalent to what the view's filter backends would
+    apply to its queryset for the current request
+    """
+    def __init__(self, view, request, model=None, filter_request=True, fields=None, **conditions):
+        self.view = view
+        self.request = request
+        self.model = model or view.queryset.model
+        # Fields to read from each document (see DocumentSerializer.subset)
+        self.fields = fields
+        self.filter_request = filter_request and self.model is view.queryset.model
+        self.collection = collection_for(self.model)
+        # A $text search ranked by relevance
+        self.text_search = False
+        self.spec = self.build_filter(conditions)
+        # Archived documents are read too, unless relevance decides the order:
+        # the archive has no relevance scores
+        self.archive = None if self.text_search else archive.for_collection(self.collection.name)
+
+    def coerce(self, name, value):
+        try:
+            return self.model._meta.get_field(name).to_python(value)
+        except DjangoValidationError as exc:
+            raise ValidationError({name: exc.messages})
+
+    def build_filter(self, conditions):
+        clauses = [{name: self.coerce(name, value)} for name, value in conditions.items()]
+        if self.filter_request:
+            backends = getattr(self.view, 'filter_backends', [])
+            params = self.request.query_params
+            for name in getattr(self.view, 'filterset_fields', []):
+                if params.get(name):
+                    clauses.append({name: self.coerce(name, params[name])})
+            search_fields = getattr(self.view, 'search_fields', None)
+            if search_fields and any(issubclass(b, filters.SearchFilter) for b in backends):
+                clauses.extend(self.search_clauses(search_fields))
+        if not clauses:
+            return {}
+        if len(clauses) == 1:
+            return clauses[0]
+        return {'$and': clauses}
+
+    def search_clauses(self, search_fields):
+        terms = filters.SearchFilter().get_search_terms(self.request)
+        if not terms:
+            return []
+        if search.uses_text_search(self.view) and search.has_text_index(self.collection.name):
+            self.text_search = self.orders_by_relevance()
+            return [search.text_clause(terms)]
+        # Every term must match one of the fields, case-insensitively
+        return [
+            {'$or': [{field: {'$regex': re.escape(term), '$options': 'i'}} for field in search_fields]}
+            for term in terms
+        ]
+
+    def orders_by_relevance(self):
+        """Text searches are ranked by relevance unless ``?ordering=`` asks
+        otherwise"""
+        for backend in getattr(self.view, 'filter_backends', []):
+            if issubclass(backend, filters.OrderingFilter):
+                return not self.request.query_params.get(backend.ordering_param)
+        return False
+
+    def ordering(self):
+        if self.model is self.view.queryset.model:
+            for backend in getattr(self.view, 'filter_backends', []):
+                if issubclass(backend, filters.OrderingFilter):
+                    if self.text_search:
+                        return ['-' + search.SCORE_FIELD]
+                    return backend().get_ordering(self.request, self.view.queryset, self.view) or []
+            return list(getattr(self.view, 'ordering', None) or [])
+        return list(self.model._meta.ordering)
+
+    def projection(self):
+        projection = dict.fromkeys(self.fields, 1) if self.fields is not None else {}
+        if self.text_search:
+            projection[search.SCORE_FIELD] = search.SCORE
+        return projection or None
+
+    def sort(self, ordering):
+        return [
+            (search.SCORE_FIELD, search.SCORE) if field == search.SCORE_FIELD else (field, direction)
+            for field, direction in to_sort(ordering)
+        ]
+
+    def cursor(self, limit=0, ordering=None):
+        """Return an ordered pymongo cursor over all matching documents"""
+        ordering = self.ordering() if ordering is None else ordering
+        cursor = self.collection.find(self.spec, self.projection(), limit=limit)
+        if ordering:
+            cursor = cursor.sort(self.sort(ordering))
+        return cursor
+
+    def documents(self, limit=0, ordering=None, batch_size=0):
+        """Iterate over the matching documents of the collection and its archive"""
+        ordering = self.ordering() if ordering is None else ordering
+        cursor = self.cursor(limit, ordering)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        if self.archive is None:
+            return cursor
+        sort = self.sort(ordering)
+        archived = self.archive.scan(self.spec, self.projection(), sort, limit)
+        documents = heapq.merge(cursor, archived, key=sort_key(sort)) if sort else itertools.chain(cursor, archived)
+        return itertools.islice(documents, limit) if limit else documents
+
+    def find(self, paginator=None, limit=0, ordering=None):
+        """Return matching documents, one page of them if a paginator is given"""
+        if paginator is not None:
+            ordering = self.ordering() if ordering is None else ordering
+            return paginator.paginate_collection(
+                self.collection, self.spec, self.request, ordering, self.text_search, self.fields, self.archive)
+        return list(self.documents(limit, ordering))
+
+
+def get_document(model, pk, fields=None):
+    """Fetch a single document (only ``fields`` if given) by its ObjectId or
+    raise Http404"""
+    projection = dict.fromkeys(fields, 1) if fields is not None else None
+    try:
+        document = collection_for(model).find_one({'_id': ObjectId(str(pk))}, projection)
+    except (InvalidId, TypeError):
+        document = None
+    if document is None:
+        raise Http404
+    return document
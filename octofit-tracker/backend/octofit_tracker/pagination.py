@@ -0,0 +1,352 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are ordered by the view's primary ordering field with ``_id`` as a
+tie-breaker, and the cursor encodes the ``(value, _id)`` position of the
+boundary row. Each page is a range query on that pair, so deep pages cost the
+same as the first one instead of skipping over everything before them.
+
+Pages say whether there is a next one (``has_next``) without counting
+anything. ``?count=estimated`` adds a total taken from collection metadata
+for unfiltered lists and from a per-filter cache for filtered ones. Cached
+counts expire after ``OCTOFIT_COUNT_CACHE_TTL`` seconds or on the next
+write to the collection. ``?count=exact`` counts every time.
+"""
+import base64
+import hashlib
+import json
+from collections import OrderedDict
+from datetime import datetime
+
+from bson import ObjectId, SON, json_util
+from bson.errors import InvalidId
+from django.conf import settings
+from django.db.models import Q
+from rest_framework import filters
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from . import response_cache, routing
+from .mongo import get_db
+from .native import sort_key, to_sort
+from .search import SCORE, SCORE_FIELD
+
+COUNT_NONE = 'none'
+COUNT_ESTIMATED = 'estimated'
+COUNT_EXACT = 'exact'
+COUNT_MODES = [COUNT_NONE, COUNT_ESTIMATED, COUNT_EXACT]
+# How an estimated count of a filtered list is served
+COUNT_CACHED = 'cached'
+
+
+def _count_key(collection, spec):
+    generation = response_cache.generations([collection])[0]
+    digest = hashlib.sha256(json_util.dumps(spec).encode('utf-8')).hexdigest()
+    return f'count:{collection}:{generation}:{digest}'
+
+
+def cached_count(collection, spec):
+    """A count of ``spec`` on ``collection`` cached since its last write, or None"""
+    return response_cache.get_cache().get(_count_key(collection, spec))
+
+
+def store_count(collection, spec, count):
+    timeout = getattr(settings, 'OCTOFIT_COUNT_CACHE_TTL', 30)
+    response_cache.get_cache().set(_count_key(collection, spec), count, timeout)
+
+
+class KeysetPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = '-_id'
+    invalid_cursor_message = 'Invalid cursor'
+    count_query_param = 'count'
+    count = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.field, self.descending = self.get_ordering(request, queryset, view)
+        self.count = self.count_queryset(queryset)
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor['reverse'])
+
+        queryset = queryset.order_by(*self.order_by(reverse))
+        if cursor is not None:
+            queryset = queryset.filter(self.position_filter(cursor['value'], cursor['pk'], reverse))
+
+        results = list(queryset[:self.page_size + 1])
+        return self.finish_page(results, cursor)
+
+    def paginate_collection(self, collection, spec, request, ordering, text_search=False, fields=None,
+                            archive=None):
+        """Native counterpart of ``paginate_queryset`` for a pymongo collection,
+        merging in the archived documents of ``archive`` if given"""
+        operation, arguments = self.collection_query(spec, request, ordering, text_search, fields)
+        if operation == 'aggregate':
+            results = list(collection.aggregate(arguments))
+        else:
+            results = list(collection.find(arguments['filter'], arguments['projection'])
+                           .sort(arguments['sort']).limit(arguments['limit']))
+        if archive is None:
+            self.count = self.resolve_count(
+                self.count_method(spec), collection.name, spec,
+                lambda: collection.count_documents(spec), collection.estimated_document_count)
+        else:
+            results = self.merge_archive(results, archive, arguments)
+            self.count = self.resolve_count(
+                self.count_method(spec), collection.name, spec,
+                lambda: collection.count_documents(spec) + archive.count(spec),
+                lambda: collection.estimated_document_count() + archive.count({}))
+        return self.finish_page(results, self.cursor)
+
+    def merge_archive(self, results, archive, arguments):
+        """Merge the archived rows that belong on the page into ``results``,
+        the hot rows fetched with ``collection_query``'s find ``arguments``"""
+        spec, limit = arguments['filter'], arguments['limit']
+        if len(results) == limit:
+            # Only archived rows ahead of the hot look-ahead row can make the page
+            reverse = bool(self.cursor and self.cursor['reverse'])
+            ahead = self.position_query(*self.position_of(results[-1]), reverse=not reverse)
+            spec = {'$and': [spec, ahead]} if spec else ahead
+        archived = archive.find(spec, arguments['projection'], arguments['sort'], limit)
+        return sorted(results + archived, key=sort_key(arguments['sort']))[:limit]
+
+    def get_count_mode(self, request):
+        mode = request.query_params.get(self.count_query_param) or getattr(
+            settings, 'OCTOFIT_PAGINATION_COUNT', COUNT_NONE)
+        if mode not in COUNT_MODES:
+            raise ValidationError({self.count_query_param: [f"Must be one of: {', '.join(COUNT_MODES)}."]})
+        return mode
+
+    def count_method(self, spec):
+        """How to count the rows matching ``spec`` in the requested count
+        mode: None (don't), COUNT_ESTIMATED, COUNT_CACHED or COUNT_EXACT"""
+        mode = self.get_count_mode(self.request)
+        if mode == COUNT_NONE:
+            return None
+        if mode == COUNT_ESTIMATED:
+            # Collection metadata only knows the unfiltered total
+            return COUNT_CACHED if spec else COUNT_ESTIMATED
+        return COUNT_EXACT
+
+    def resolve_count(self, method, collection, key, count, estimate):
+        """Apply ``count_method``'s choice; ``count`` and ``estimate`` are
+        callables, ``key`` identifies the filter in the count cache"""
+        if method is None:
+            return None
+        if method == COUNT_ESTIMATED:
+            return estimate()
+        if method == COUNT_EXACT:
+            return count()
+        value = cached_count(collection, key)
+        if value is None:
+            value = count()
+            store_count(collection, key, value)
+        return value
+
+    def count_queryset(self, queryset):
+        """ORM counterpart of the counting in ``paginate_collection``"""
+        table = queryset.model._meta.db_table
+        return self.resolve_count(
+            self.count_method(queryset.query.where), table, str(queryset.query),
+            queryset.count, get_db(routing.read_alias())[table].estimated_document_count)
+
+    def collection_query(self, spec, request, ordering, text_search=False, fields=None):
+        """Build the Mongo query for the requested page.
+
+        Returns ``('find', {filter, projection, sort, limit})`` or
+        ``('aggregate', pipeline)``; the caller runs it (with pymongo or Motor)
+        and passes the documents to ``finish_page(results, self.cursor)``.
+        Text searches run as an aggregation so the relevance score can be the
+        keyset column. ``fields`` limits the documents to those fields plus
+        the keyset column.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.field, self.descending = self.parse_term(ordering[0] if ordering else self.ordering)
+        self.cursor = cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor['reverse'])
+        sort = to_sort(self.order_by(reverse))
+        position = None
+        if cursor is not None:
+            position = self.position_query(cursor['value'], cursor['pk'], reverse)
+
+        projection = None
+        if fields is not None:
+            projection = dict.fromkeys([*fields, self.field], 1)
+
+        if text_search:
+            pipeline = [{'$match': spec}, {'$addFields': {SCORE_FIELD: SCORE}}]
+            if position is not None:
+                pipeline.append({'$match': position})
+            pipeline += [{'$sort': SON(sort)}, {'$limit': self.page_size + 1}]
+            if projection is not None:
+                pipeline.append({'$project': projection})
+            return 'aggregate', pipeline
+        if position is not None:
+            spec = {'$and': [spec, position]} if spec else position
+        return 'find', {'filter': spec, 'projection': projection, 'sort': sort, 'limit': self.page_size + 1}
+
+    def finish_page(self, results, cursor):
+        """Trim the look-ahead row and work out the neighbouring cursors"""
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if cursor is not None and cursor['reverse']:
+            results.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, cursor is not None
+
+        self.next_position = self.position_of(results[-1]) if has_next and results else None
+        self.previous_position = self.position_of(results[0]) if has_previous and results else None
+        if cursor is not None and not results:
+            # Paging past either end: keep a way back to where we came from
+            position = (cursor['value'], cursor['pk'])
+            if cursor['reverse']:
+                self.next_position = position
+            else:
+                self.previous_position = position
+        return results
+
+    def get_paginated_response(self, data):
+        fields = [
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('has_next', self.next_position is not None),
+        ]
+        if self.count is not None:
+            fields.append(('count', self.count))
+        return Response(OrderedDict(fields + [('results', data)]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'previous': {'type': 'string', 'nullable': True},
+                'has_next': {'type': 'boolean'},
+                'count': {'type': 'integer', 'description': 'Only with ?count=estimated or exact'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(
+                    request.query_params[self.page_size_query_param],
+                    strict=True,
+                    cutoff=self.max_page_size,
+                )
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_limit(self, request, param='limit', default=10):
+        """Parse the ``?limit=`` of an unpaginated list like a page size:
+        a positive integer, capped at ``max_page_size``"""
+        value = request.query_params.get(param)
+        if value is None:
+            return default
+        try:
+            return _positive_int(value, strict=True, cutoff=self.max_page_size)
+        except ValueError:
+            raise ValidationError({param: ['A positive integer is required.']})
+
+    def get_ordering(self, request, queryset, view):
+        """Return ``(field, descending)`` for the primary keyset column"""
+        ordering = None
+        view_queryset = getattr(view, 'queryset', None)
+        if view_queryset is not None and view_queryset.model is queryset.model:
+            for backend in getattr(view, 'filter_backends', []):
+                if issubclass(backend, filters.OrderingFilter):
+                    ordering = backend().get_ordering(request, queryset, view)
+                    break
+            if not ordering:
+                ordering = getattr(view, 'ordering', None)
+        else:
+            # e.g. team members listed from the team endpoint
+            ordering = queryset.query.order_by or queryset.model._meta.ordering
+        if isinstance(ordering, str):
+            ordering = [ordering]
+        return self.parse_term(ordering[0] if ordering else self.ordering)
+
+    def parse_term(self, term):
+        field = term.lstrip('-')
+        if field in ('id', 'pk'):
+            field = '_id'
+        return field, term.startswith('-')
+
+    def order_by(self, reverse=False):
+        descending = self.descending != reverse
+        prefix = '-' if descending else ''
+        if self.field == '_id':
+            return [prefix + '_id']
+        return [prefix + self.field, prefix + '_id']
+
+    def position_filter(self, value, pk, reverse=False):
+        """Return a Q selecting rows strictly after ``(value, pk)``"""
+        lookup = 'lt' if self.descending != reverse else 'gt'
+        after_pk = Q(**{'_id__' + lookup: pk})
+        if self.field == '_id':
+            return after_pk
+        return Q(**{self.field + '__' + lookup: value}) | (Q(**{self.field: value}) & after_pk)
+
+    def position_query(self, value, pk, reverse=False):
+        """Mongo filter equivalent of ``position_filter``"""
+        operator = '$lt' if self.descending != reverse else '$gt'
+        after_pk = {'_id': {operator: pk}}
+        if self.field == '_id':
+            return after_pk
+        return {'$or': [{self.field: {operator: value}}, dict(after_pk, **{self.field: value})]}
+
+    def position_of(self, item):
+        if isinstance(item, dict):
+            return item.get(self.field), item['_id']
+        return getattr(item, self.field), item._id
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position, reverse=True)
+
+    def encode_cursor(self, position, reverse):
+        value, pk = position
+        if isinstance(value, datetime):
+            value = {'$date': value.isoformat()}
+        elif isinstance(value, ObjectId):
+            value = {'$oid': str(value)}
+        tokens = {'v': value, 'p': str(pk)}
+        if reverse:
+            tokens['r'] = 1
+        querystring = json.dumps(tokens, separators=(',', ':'))
+        encoded = base64.urlsafe_b64encode(querystring.encode('ascii')).decode('ascii')
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            tokens = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii'))
+            value = tokens['v']
+            if isinstance(value, dict) and '$date' in value:
+                value = datetime.fromisoformat(value['$date'])
+            elif isinstance(value, dict) and '$oid' in value:
+                value = ObjectId(value['$oid'])
+            pk = ObjectId(tokens['p'])
+        except (TypeError, ValueError, KeyError, UnicodeError, InvalidId):
+            raise NotFound(self.invalid_cursor_message)
+        return {'value': value, 'pk': pk, 'reverse': bool(tokens.get('r'))}
@@ -0,0 +1,35 @@
+import codecs
+import json
+
+from django.conf import settings
+from rest_framework.parsers import BaseParser
+
+
+class InvalidRecord:
+    """Placeholder for an NDJSON line that is not a JSON document"""
+    def __init__(self, message):
+        self.message = message
+
+
+class NDJSONParser(BaseParser):
+    """
+    Parses newline-delimited JSON lazily, one document per line, so large
+    uploads are consumed as a stream. Malformed lines become InvalidRecord
+    items instead of failing the whole request.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        return self.records(codecs.getreader(encoding)(stream))
+
+    def records(self, lines):
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as exc:
+                yield InvalidRecord(f'Invalid JSON: {exc}')
@@ -0,0 +1,293 @@
+"""
+Propagation of user changes to the collections that copy user fields.
+
+Activities, archived ones included, copy ``user_name``, leaderboard
+entries and rollups copy ``name``/``email``/``team``, per-user statistics
+and workout profiles are keyed by ``email`` and ``Team.members`` lists
+emails. A deleted user's leaderboard entry is removed and their points
+leave their team's total. User writes only enqueue ``(old, new)``
+snapshots; a background worker drains the queue, collapses successive
+changes to the same user into one and fans them out as a few batched
+``update_many`` writes per collection, plus one rewrite per archived month
+holding their activities. ``find_drift`` and ``repair`` catch whatever a
+lost job or an out-of-band write left behind.
+"""
+import logging
+import queue
+import threading
+
+from pymongo import UpdateMany, UpdateOne
+
+from . import archive, leaderboard, recommendations, response_cache, rollups, stats
+from .mongo import get_db
+
+logger = logging.getLogger(__name__)
+
+USER_FIELDS = ['_id', 'email', 'name', 'team', 'total_points']
+# find_drift/repair label of archived activities, whose repair operations
+# are ``(user_email, {column: value})``
+ARCHIVED_ACTIVITIES = 'activities (archive)'
+BATCH_SIZE = 100
+CHUNK_SIZE = 1000
+
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def user_snapshot(user):
+    """Return the fields of a User that other collections copy"""
+    return {field: getattr(user, field) for field in USER_FIELDS}
+
+
+def enqueue(old=None, new=None):
+    """Queue a user create (``old`` None), update or delete (``new`` None)"""
+    if old == new or not leaderboard.updates_inline():
+        return
+    _queue.put((old, new))
+    _ensure_worker()
+
+
+def wait():
+    """Block until every queued change has been propagated"""
+    _queue.join()
+
+
+def _ensure_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name='octofit-propagation', daemon=True)
+            _worker.start()
+
+
+def _run():
+    while True:
+        batch = [_queue.get()]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            propagate(batch)
+        except Exception:
+            # Archive rewrites and malformed changes fail too; the worker
+            # must outlive them, find_drift reports what was missed
+            logger.exception('Could not propagate %d user changes', len(batch))
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+
+def coalesce(changes):
+    """Collapse successive changes of one user into ``(first old, last new)``"""
+    merged = {}
+    for old, new in changes:
+        pk = (old or new)['_id']
+        if pk in merged:
+            merged[pk][1] = new
+        else:
+            merged[pk] = [old, new]
+    return [(old, new) for old, new in merged.values() if old != new]
+
+
+def activity_fields(old, new):
+    """Return the ``user_*`` fields that change on the activities of ``old``"""
+    fields = {}
+    if new['email'] != old['email']:
+        fields['user_email'] = new['email']
+    if new['name'] != old['name']:
+        fields['user_name'] = new['name']
+    return fields
+
+
+def operations(old, new):
+    """Return ``{collection: [write operations]}`` bringing the copies of
+    ``old`` in line with ``new``"""
+    ops = {}
+    if old is not None and new is not None:
+        activity = activity_fields(old, new)
+        entry = {}
+        if 'user_email' in activity:
+            entry['email'] = new['email']
+            ops[stats.COLLECTION] = [UpdateOne({'email': old['email']}, {'$set': {'email': new['email']}})]
+            ops[recommendations.COLLECTION] = [
+                UpdateOne({'email': old['email']}, {'$set': {'email': new['email']}})]
+        if 'user_name' in activity:
+            entry['name'] = new['name']
+        if activity:
+            ops['activities'] = [UpdateMany({'user_email': old['email']}, {'$set': activity})]
+            # Rollups keep the team the points were scored for
+            ops[rollups.COLLECTION] = [UpdateMany(
+                {'type': leaderboard.INDIVIDUAL, 'email': old['email']}, {'$set': dict(entry)})]
+        if new['team'] != old['team']:
+            entry['team'] = new['team']
+        if entry:
+            ops['leaderboard'] = [UpdateOne(
+                {'type': leaderboard.INDIVIDUAL, 'email': old['email']}, {'$set': entry})]
+
+    members = []
+    moved = old is None or new is None or (new['email'], new['team']) != (old['email'], old['team'])
+    if moved and old is not None and old['team']:
+        members.append(UpdateOne({'name': old['team']}, {'$pull': {'members': old['email']}}))
+    if moved and new is not None and new['team']:
+        members.append(UpdateOne({'name': new['team']}, {'$addToSet': {'members': new['email']}}))
+    if members:
+        ops['teams'] = members
+    return ops
+
+
+def propagate(changes, db=None):
+    """Apply a batch of ``(old, new)`` user snapshots to every copy"""
+    db = db if db is not None else get_db()
+    batched = {}
+    team_deltas = {}
+    removed = []
+    archived = {}
+    # Emails whose recommendation profile was renamed
+    profiles = set()
+    for old, new in coalesce(changes):
+        for collection, ops in operations(old, new).items():
+            batched.setdefault(collection, []).extend(ops)
+        if old is not None and new is not None and activity_fields(old, new):
+            archived[old['email']] = activity_fields(old, new)
+            if 'user_email' in archived[old['email']]:
+                profiles.update((old['email'], new['email']))
+        if old is not None and new is not None and old['team'] != new['team']:
+            # The user's points so far move to the new team with them
+            points = new['total_points'] or 0
+            team_deltas[old['team']] = team_deltas.get(old['team'], 0) - points
+            team_deltas[new['team']] = team_deltas.get(new['team'], 0) + points
+        elif new is None:
+            removed.append(old)
+    for collection, ops in batched.items():
+        # Ordered, so a member pulled from a team and re-added stays listed
+        db[collection].bulk_write(ops, ordered=collection == 'teams')
+    archive.activities.update_rows('user_email', archived)
+    response_cache.invalidate(*map(recommendations.cache_collection, profiles))
+    for old in removed:
+        # A deleted user's points leave the board and their team. The entry
+        # holds them even when the user document is already gone
+        entry = leaderboard.remove_entry(db, leaderboard.INDIVIDUAL, {'email': old['email']})
+        points = entry['points'] if entry is not None else old['total_points']
+        team_deltas[old['team']] = team_deltas.get(old['team'], 0) - (points or 0)
+    team_deltas.pop(None, None)
+    leaderboard.apply_team_deltas(team_deltas, db)
+    if batched or team_deltas or removed:
+        # Renamed users change which activities a filter or search matches
+        response_cache.invalidate('leaderboard', 'activities')
+
+
+def _drift_in_chunk(users, db, archived):
+    by_email = {user['email']: user for user in users}
+    emails = list(by_email)
+    drift = []
+
+    for email in emails:
+        for name, count in archived.get(email, ()):
+            if name != by_email[email]['name']:
+                drift.append((ARCHIVED_ACTIVITIES, (email, {'user_name': by_email[email]['name']}), count))
+
+    for group in db.activities.aggregate([
+        {'$match': {'user_email': {'$in': emails}}},
+        {'$group': {'_id': {'email': '$user_email', 'name': '$user_name'}, 'count': {'$sum': 1}}},
+    ]):
+        email, name = group['_id']['email'], group['_id'].get('name')
+        if name != by_email[email]['name']:
+            drift.append(('activities', UpdateMany(
+                {'user_email': email, 'user_name': name}, {'$set': {'user_name': by_email[email]['name']}}
+            ), group['count']))
+
+    for entry in db.leaderboard.find({'type': leaderboard.INDIVIDUAL, 'email': {'$in': emails}},
+                                     {'email': 1, 'name': 1, 'team': 1}):
+        user = by_email[entry['email']]
+        fields = {field: user.get(field) for field in ('name', 'team') if entry.get(field) != user.get(field)}
+        if fields:
+            drift.append(('leaderboard', UpdateOne({'_id': entry['_id']}, {'$set': fields}), 1))
+
+    for group in db[rollups.COLLECTION].aggregate([
+        {'$match': {'type': leaderboard.INDIVIDUAL, 'email': {'$in': emails}}},
+        {'$group': {'_id': {'email': '$email', 'name': '$name'}, 'count': {'$sum': 1}}},
+    ]):
+        email, name = group['_id']['email'], group['_id'].get('name')
+        if name != by_email[email]['name']:
+            drift.append((rollups.COLLECTION, UpdateMany(
+                {'type': leaderboard.INDIVIDUAL, 'email': email, 'name': name},
+                {'$set': {'name': by_email[email]['name']}}
+            ), group['count']))
+
+    listed = set()
+    for team in db.teams.aggregate([
+        {'$match': {'members': {'$in': emails}}},
+        {'$project': {'name': 1, 'members': {
+            '$filter': {'input': '$members', 'cond': {'$in': ['$$this', emails]}}}}},
+    ]):
+        for email in team['members']:
+            if by_email[email].get('team') == team['name']:
+                listed.add(email)
+            else:
+                drift.append(('teams', UpdateOne({'_id': team['_id']}, {'$pull': {'members': email}}), 1))
+    for email in emails:
+        # Users without a team are listed nowhere
+        if email not in listed and by_email[email].get('team'):
+            drift.append(('teams', UpdateOne(
+                {'name': by_email[email]['team']}, {'$addToSet': {'members': email}}), 1))
+    return drift
+
+
+def find_drift(db=None, chunk_size=CHUNK_SIZE):
+    """Yield ``(collection, repair operation, documents affected)`` for every
+    copy that disagrees with its user, checking ``chunk_size`` users at a time"""
+    db = db if db is not None else get_db()
+    # Archived names per email, read in one pass over the archive
+    archived = {}
+    for (email, name), count in archive.activities.group_counts(['user_email', 'user_name']).items():
+        archived.setdefault(email, []).append((name, count))
+    last_id = None
+    while True:
+        query = {} if last_id is None else {'_id': {'$gt': last_id}}
+        users = list(db.users.find(query, {'email': 1, 'name': 1, 'team': 1})
+                     .sort('_id', 1).limit(chunk_size))
+        if not users:
+            break
+        yield from _drift_in_chunk(users, db, archived)
+        last_id = users[-1]['_id']
+
+    # Members whose user no longer exists
+    for team in db.teams.aggregate([
+        {'$unwind': '$members'},
+        {'$lookup': {'from': 'users', 'localField': 'members', 'foreignField': 'email', 'as': 'user'}},
+        {'$match': {'user': {'$size': 0}}},
+        {'$project': {'members': 1}},
+    ]):
+        yield 'teams', UpdateOne({'_id': team['_id']}, {'$pull': {'members': team['members']}}), 1
+
+
+def repair(drift, db=None, chunk_size=CHUNK_SIZE):
+    """Apply the repair operations from ``find_drift`` in batches; return the
+    number of operations applied per collection"""
+    db = db if db is not None else get_db()
+    pending = {}
+    applied = {}
+    for collection, operation, _ in drift:
+        ops = pending.setdefault(collection, [])
+        ops.append(operation)
+        if len(ops) >= chunk_size:
+            _write(db, collection, ops)
+            applied[collection] = applied.get(collection, 0) + len(ops)
+            pending[collection] = []
+    for collection, ops in pending.items():
+        if ops:
+            _write(db, collection, ops)
+            applied[collection] = applied.get(collection, 0) + len(ops)
+    if applied:
+        response_cache.invalidate('leaderboard', 'activities')
+    return applied
+
+
+def _write(db, collection, ops):
+    if collection == ARCHIVED_ACTIVITIES:
+        archive.activities.update_rows('user_email', dict(ops))
+    else:
+        db[collection].bulk_write(ops, ordered=False)
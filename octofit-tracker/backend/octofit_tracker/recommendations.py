@@ -0,0 +1,162 @@
+"""
+Personalized workout recommendations.
+
+Users and workouts are described by the same features: the share of
+training time per workout category, the typical session length and the
+intensity. A user's features come from their ``user_stats`` counters, that
+is the duration per activity type and the overall duration, count and
+calories. A workout's features come from its category, duration and
+difficulty.
+
+Profiles live in ``workout_profiles``, one document per user, and are
+refreshed with the statistics they are computed from, so only the users
+touched by a batch of activity writes are recomputed.
+``GET /api/workouts/recommended/?email=`` reads one profile and ranks the
+whole catalog by one vectorized weighted distance to it. Each process
+keeps the catalog matrix until the workout count or newest ``_id`` on the
+primary changes, and for ``CATALOG_TTL`` seconds at most so that edits in
+place show up too. Cached rankings are keyed on the user as well, so a
+profile refresh only invalidates that user's responses.
+"""
+import time
+from datetime import datetime
+
+import numpy as np
+from pymongo import ASCENDING, DESCENDING, DeleteOne, UpdateOne
+from rest_framework.exceptions import ValidationError
+
+from . import response_cache, stats
+from .mongo import get_db
+
+COLLECTION = 'workout_profiles'
+
+CATEGORIES = ['Cardio', 'Strength', 'Flexibility', 'Combat', 'Full Body']
+# Activity type (as in scoring.RULES) -> workout category it trains
+ACTIVITY_CATEGORIES = {
+    'running': 'Cardio',
+    'cycling': 'Cardio',
+    'swimming': 'Cardio',
+    'walking': 'Cardio',
+    'weightlifting': 'Strength',
+    'yoga': 'Flexibility',
+    'boxing': 'Combat',
+    'crossfit': 'Full Body',
+}
+DIFFICULTIES = {'easy': 0.0, 'medium': 0.5, 'hard': 1.0}
+# Session length mapped to 1.0; longer sessions count as this long
+MAX_DURATION = 120
+# Calories per minute mapped to intensities 0.0 and 1.0: yoga and boxing
+# under scoring.RULES
+LOW_BURN = 4.0
+HIGH_BURN = 12.0
+# Feature weights: category shares, duration, intensity
+WEIGHTS = np.array([1.0] * len(CATEGORIES) + [0.5, 0.75])
+# Features of a user without activities: short, easy sessions of anything
+NEW_USER = [0.0] * len(CATEGORIES) + [20 / MAX_DURATION, 0.0]
+
+INDEXES = [
+    [('email', ASCENDING)],
+]
+
+CATALOG_TTL = 300
+
+# (catalog version, expiry on the monotonic clock, workout documents,
+# feature rows)
+_catalog = None
+
+
+def profile_vector(counters):
+    """Features of a ``user_stats`` document"""
+    vector = [0.0] * len(CATEGORIES)
+    for key, totals in (counters.get('by_type') or {}).items():
+        category = ACTIVITY_CATEGORIES.get(stats._unkey(key).lower())
+        if category is not None and totals.get('duration', 0) > 0:
+            vector[CATEGORIES.index(category)] += totals['duration']
+    categorized = sum(vector)
+    if categorized:
+        vector = [minutes / categorized for minutes in vector]
+    count = counters.get('count', 0)
+    duration = counters.get('duration', 0)
+    typical = duration / count if count > 0 else 0
+    burn = counters.get('calories', 0) / duration if duration > 0 else LOW_BURN
+    intensity = (burn - LOW_BURN) / (HIGH_BURN - LOW_BURN)
+    return vector + [min(max(typical, 0) / MAX_DURATION, 1.0), min(max(intensity, 0.0), 1.0)]
+
+
+def workout_vectors(workouts):
+    """Feature rows of workout documents, one per workout"""
+    matrix = np.zeros((len(workouts), len(CATEGORIES) + 2))
+    for row, workout in enumerate(workouts):
+        if workout.get('category') in CATEGORIES:
+            matrix[row, CATEGORIES.index(workout['category'])] = 1.0
+        matrix[row, -2] = min((workout.get('duration') or 0) / MAX_DURATION, 1.0)
+        matrix[row, -1] = DIFFICULTIES.get(str(workout.get('difficulty')).lower(), 0.5)
+    return matrix
+
+
+def refresh(emails, db=None):
+    """Recompute the profiles of ``emails`` from their statistics"""
+    db = db if db is not None else get_db()
+    emails = set(emails)
+    if not emails:
+        return
+    now = datetime.now()
+    updates = []
+    found = set()
+    for counters in db[stats.COLLECTION].find(
+            {'email': {'$in': list(emails)}}, {'email': 1, 'count': 1, 'duration': 1, 'calories': 1, 'by_type': 1}):
+        if counters.get('count', 0) <= 0:
+            continue
+        found.add(counters['email'])
+        updates.append(UpdateOne({'email': counters['email']}, {'$set': {
+            'vector': profile_vector(counters),
+            'activities': counters['count'],
+            'last_updated': now,
+        }}, upsert=True))
+    updates += [DeleteOne({'email': email}) for email in emails - found]
+    db[COLLECTION].bulk_write(updates, ordered=False)
+    response_cache.invalidate(*map(cache_collection, emails))
+
+
+def cache_collection(email):
+    """The response cache generation of ``email``'s recommendations"""
+    return f'{COLLECTION}:{email}'
+
+
+def catalog_version(db):
+    """What identifies the stored catalog: workout count, newest ``_id`` and
+    this process's cache generation"""
+    newest = db.workouts.find_one({}, {'_id': 1}, sort=[('_id', DESCENDING)])
+    return (db.workouts.count_documents({}), newest and newest['_id'],
+            response_cache.generations(['workouts'])[0])
+
+
+def catalog(db=None):
+    """Return ``(workouts, feature rows)`` read from the primary, rebuilt
+    when its version changes or has been kept ``CATALOG_TTL`` seconds"""
+    global _catalog
+    db = db if db is not None else get_db()
+    version = catalog_version(db)
+    if _catalog is None or _catalog[0] != version or time.monotonic() >= _catalog[1]:
+        workouts = list(db.workouts.find().sort('name', ASCENDING))
+        _catalog = (version, time.monotonic() + CATALOG_TTL, workouts, workout_vectors(workouts))
+    return _catalog[2], _catalog[3]
+
+
+def recommend(email, limit, db=None):
+    """Return up to ``limit`` workout documents for ``email``, most similar
+    first, each with its ``score``: 1 / (1 + weighted distance), so 1.0 for
+    a workout matching the profile exactly"""
+    if not email:
+        raise ValidationError({'email': ['This query parameter is required.']})
+    db = db if db is not None else get_db()
+    profile = db[COLLECTION].find_one({'email': email}, {'vector': 1})
+    vector = profile['vector'] if profile is not None else NEW_USER
+    # The catalog is read from the primary: it is kept well past any
+    # replication lag
+    workouts, rows = catalog()
+    distances = np.linalg.norm((rows - np.array(vector)) * WEIGHTS, axis=1)
+    scores = 1 / (1 + distances)
+    # Stable, so equal scores keep the catalog's name order
+    order = np.argsort(-scores, kind='stable')[:limit]
+    return [dict(workouts[index], score=round(float(scores[index]), 4)) for index in order.tolist()]
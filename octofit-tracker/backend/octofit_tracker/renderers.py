@@ -0,0 +1,66 @@
+import csv
+import io
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+def _rows(data):
+    if isinstance(data, dict):
+        return data['results'] if isinstance(data.get('results'), list) else [data]
+    return data or []
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    One JSON document per line. ``stream`` encodes rows lazily for
+    streaming exports; ``render`` handles ordinary responses.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def encode(self, row):
+        return json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    def stream(self, rows):
+        for row in rows:
+            yield self.encode(row).encode(self.charset)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b''.join(self.stream(_rows(data)))
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Comma-separated values with a header row taken from the first row's
+    keys. ``stream`` writes rows in batches of ``batch_size``.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+    batch_size = 500
+
+    def stream(self, rows):
+        buffer = io.StringIO()
+        writer = None
+        pending = 0
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(row), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow({
+                key: json.dumps(value) if isinstance(value, (list, dict)) else value
+                for key, value in row.items()
+            })
+            pending += 1
+            if pending >= self.batch_size:
+                yield buffer.getvalue().encode(self.charset)
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+        if buffer.tell():
+            yield buffer.getvalue().encode(self.charset)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b''.join(self.stream(_rows(data)))
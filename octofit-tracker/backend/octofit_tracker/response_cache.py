@@ -0,0 +1,140 @@
+"""
+Response cache for read-only endpoints.
+
+Rendered responses are stored in the ``responses`` cache alias (local memory
+by default, Redis when configured) under a key built from the path, the
+normalized query string, the Accept header and a generation counter per
+source collection. Writing to a collection bumps its generation, which
+orphans every cached response built from it without having to find them.
+
+Generations only reach the processes sharing the cache, so running the
+derived-data worker, which writes from its own process, needs Redis; the
+``octofit_tracker.E001`` system check stops ``derived_worker`` (and other
+management commands) otherwise.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+CACHE_ALIAS = 'responses'
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """Worker mode invalidates cached responses from another process"""
+    if getattr(settings, 'OCTOFIT_DERIVED_DATA', 'inline') == 'worker' and isinstance(get_cache(), LocMemCache):
+        return [checks.Error(
+            "OCTOFIT_DERIVED_DATA = 'worker' needs a response cache shared between processes",
+            hint='Set OCTOFIT_REDIS_URL; with local memory caches the web workers never see '
+                 "the derived worker's invalidations and keep serving stale totals.",
+            id='octofit_tracker.E001',
+        )]
+    return []
+
+
+def _generation_key(collection):
+    return f'generation:{collection}'
+
+
+def generations(collections):
+    cache = get_cache()
+    keys = [_generation_key(collection) for collection in collections]
+    values = cache.get_many(keys)
+    return [values.get(key, 0) for key in keys]
+
+
+def invalidate(*collections):
+    """Orphan every cached response that was built from ``collections``"""
+    cache = get_cache()
+    for collection in collections:
+        key = _generation_key(collection)
+        if not cache.add(key, 1, timeout=None):
+            try:
+                cache.incr(key)
+            except ValueError:
+                # Evicted between add() and incr()
+                cache.set(key, 1, timeout=None)
+
+
+def cache_key(request, collections):
+    query = sorted((name, value) for name, values in request.GET.lists() for value in values)
+    parts = [
+        request.path,
+        repr(query),
+        request.META.get('HTTP_ACCEPT', ''),
+        repr(generations(collections)),
+    ]
+    digest = hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+    return f'response:{digest}'
+
+
+def etag_for(content):
+    return '"%s"' % hashlib.md5(content).hexdigest()
+
+
+def etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH', '')
+    candidates = [candidate.strip() for candidate in header.split(',')]
+    return etag in candidates or '*' in candidates
+
+
+class CachedResponseMixin:
+    """
+    Cache successful GET responses of a viewset until one of its
+    ``cache_collections`` is written to, and answer ``If-None-Match``
+    revalidations with 304 Not Modified.
+    """
+    cache_collections = ()
+    cache_timeout = None
+    # True while a miss is rendered: a view honouring it reads from the
+    # primary, so a lagging secondary's data is never cached under the
+    # current generation
+    filling_cache = False
+
+    def get_cache_collections(self, request):
+        """Collections whose writes invalidate the response to ``request``"""
+        return self.cache_collections
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+
+        cache = get_cache()
+        key = cache_key(request, self.get_cache_collections(request))
+        entry = cache.get(key)
+        if entry is None:
+            self.filling_cache = True
+            try:
+                response = super().dispatch(request, *args, **kwargs)
+            finally:
+                self.filling_cache = False
+            if response.status_code != 200 or response.streaming:
+                return response
+            if hasattr(response, 'render'):
+                response.render()
+            entry = {
+                'content': response.content,
+                'content_type': response['Content-Type'],
+                'etag': etag_for(response.content),
+            }
+            timeout = self.cache_timeout if self.cache_timeout is not None else cache.default_timeout
+            cache.set(key, entry, timeout)
+            cache_status = 'MISS'
+        else:
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+            cache_status = 'HIT'
+
+        if etag_matches(request, entry['etag']):
+            response = HttpResponseNotModified()
+        response['ETag'] = entry['etag']
+        response['X-Cache'] = cache_status
+        patch_vary_headers(response, ['Accept'])
+        return response
@@ -0,0 +1,187 @@
+"""
+Time-windowed leaderboards.
+
+Points are rolled up per user and per team into one document per day, ISO
+week and calendar month in ``leaderboard_rollups``, incremented as
+activities are written. A windowed board is then an indexed range over the
+rollups of a single period, so its cost grows with the number of entries on
+that board rather than with the number of activities behind it.
+"""
+import re
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from rest_framework.exceptions import ValidationError
+
+from . import leaderboard
+from .mongo import get_db
+
+COLLECTION = 'leaderboard_rollups'
+CHUNK_SIZE = 5000
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+WINDOWS = [DAY, WEEK, MONTH]
+
+PERIOD_FORMATS = {
+    DAY: (re.compile(r'^\d{4}-\d{2}-\d{2}$'), '%Y-%m-%d', 'YYYY-MM-DD'),
+    WEEK: (re.compile(r'^\d{4}-W\d{2}$'), '%G-W%V-%u', 'YYYY-Www'),
+    MONTH: (re.compile(r'^\d{4}-\d{2}$'), '%Y-%m', 'YYYY-MM'),
+}
+
+INDEXES = [
+    [('type', ASCENDING), ('window', ASCENDING), ('period', ASCENDING),
+     ('points', DESCENDING), ('_id', DESCENDING)],
+    [('type', ASCENDING), ('window', ASCENDING), ('period', ASCENDING), ('team', ASCENDING),
+     ('points', DESCENDING), ('_id', DESCENDING)],
+    [('type', ASCENDING), ('window', ASCENDING), ('period', ASCENDING), ('email', ASCENDING)],
+    [('type', ASCENDING), ('window', ASCENDING), ('period', ASCENDING), ('name', ASCENDING)],
+]
+
+
+def _naive_utc(date):
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def period_key(window, date):
+    """Return the period of ``window`` containing ``date``, e.g. ``2026-W42``"""
+    date = _naive_utc(date)
+    if window == WEEK:
+        year, week, _ = date.isocalendar()
+        return f'{year}-W{week:02d}'
+    return date.strftime(PERIOD_FORMATS[window][1])
+
+
+def parse_window(params):
+    """Return ``(window, period)`` from ``?window=&period=`` query params.
+
+    The period defaults to the current one and is normalised, so
+    ``2026-W42`` and the week's dates share one cache key and rollup.
+    """
+    window = params.get('window')
+    if window not in PERIOD_FORMATS:
+        raise ValidationError({'window': [f"Must be one of: {', '.join(WINDOWS)}."]})
+    period = params.get('period')
+    if not period:
+        return window, period_key(window, datetime.now(timezone.utc))
+    pattern, date_format, example = PERIOD_FORMATS[window]
+    try:
+        if not pattern.match(period):
+            raise ValueError(period)
+        date = datetime.strptime(period + '-1' if window == WEEK else period, date_format)
+    except ValueError:
+        raise ValidationError({'period': [f'Expected a {window} period like {example}.']})
+    return window, period_key(window, date)
+
+
+def add_activity(increments, activity, sign=1):
+    """Fold one activity into ``increments``, keyed by ``(user_email,
+    window, period)``; ``sign`` is -1 to take a removed activity back out"""
+    points = sign * (activity['points'] or 0)
+    for window in WINDOWS:
+        key = (activity['user_email'], window, period_key(window, activity['date']))
+        totals = increments.setdefault(key, [0, 0])
+        totals[0] += points
+        totals[1] += sign
+
+
+def apply_increments(increments, db=None):
+    """Write the user and team rollups for a batch of ``add_activity``
+    increments and drop the ones left without activities"""
+    db = db if db is not None else get_db()
+    increments = {key: totals for key, totals in increments.items() if any(totals)}
+    if not increments:
+        return
+    emails = {email for email, _, _ in increments}
+    users = {
+        user['email']: user
+        for user in db.users.find({'email': {'$in': list(emails)}}, {'name': 1, 'email': 1, 'team': 1})
+    }
+
+    rows = []
+    team_increments = {}
+    for (email, window, period), (points, activities) in increments.items():
+        user = users.get(email, {})
+        team = user.get('team')
+        rows.append(({'type': leaderboard.INDIVIDUAL, 'email': email}, window, period, points, activities,
+                     {'name': user.get('name', email), 'team': team}))
+        if team:
+            totals = team_increments.setdefault((team, window, period), [0, 0])
+            totals[0] += points
+            totals[1] += activities
+    for (team, window, period), (points, activities) in team_increments.items():
+        if points or activities:
+            rows.append(({'type': leaderboard.TEAM, 'name': team}, window, period, points, activities, {}))
+
+    now = datetime.now()
+    updates = []
+    emptied = []
+    for key, window, period, points, activities, fields in rows:
+        query = dict(key, window=window, period=period)
+        updates.append(UpdateOne(query, {
+            '$inc': {'points': points, 'activities': activities},
+            '$set': dict(fields, last_updated=now),
+        }, upsert=True))
+        if activities < 0:
+            emptied.append(query)
+
+    rollups = db[COLLECTION]
+    rollups.bulk_write(updates, ordered=False)
+    if emptied:
+        rollups.delete_many({'$or': emptied, 'activities': {'$lte': 0}})
+
+
+def board_filter(params, board=None):
+    """Return the Mongo filter for the windowed board a request asks for"""
+    window, period = parse_window(params)
+    board = board or params.get('type') or leaderboard.INDIVIDUAL
+    if board not in (leaderboard.INDIVIDUAL, leaderboard.TEAM):
+        raise ValidationError({'type': [f'Must be {leaderboard.INDIVIDUAL} or {leaderboard.TEAM}.']})
+    spec = {'type': board, 'window': window, 'period': period}
+    if params.get('team'):
+        spec['team'] = params['team']
+    return spec
+
+
+def ranked(collection, spec, documents, paginator=None):
+    """Number a page of board rows by their position on the whole board.
+
+    Later pages count the rows ranked above their first row once; ties keep
+    the ``_id`` order the page was sorted in.
+    """
+    rank = 1
+    if documents and paginator is not None and paginator.cursor is not None:
+        first = documents[0]
+        above = paginator.position_query(first['points'], first['_id'], reverse=True)
+        rank += collection.count_documents({'$and': [spec, above]})
+    for offset, document in enumerate(documents):
+        document['rank'] = rank + offset
+    return documents
+
+
+def rebuild(db=None):
+    """Recompute every rollup from the activities collection and its
+    archive, a few thousand users at a time"""
+    # Imported here: archive -> changefeed -> leaderboard imports this module
+    from . import archive
+
+    db = db if db is not None else get_db()
+    db[COLLECTION].delete_many({})
+    increments = {}
+    email = None
+    activities = db.activities.find({}, {'user_email': 1, 'points': 1, 'date': 1})
+    for activity in activities.sort('user_email', ASCENDING).batch_size(CHUNK_SIZE):
+        if activity['user_email'] != email and len(increments) >= CHUNK_SIZE:
+            apply_increments(increments, db)
+            increments = {}
+        email = activity['user_email']
+        add_activity(increments, activity)
+    for activity in archive.activities.scan({}, ['user_email', 'points', 'date']):
+        if len(increments) >= CHUNK_SIZE:
+            apply_increments(increments, db)
+            increments = {}
+        add_activity(increments, activity)
+    apply_increments(increments, db)
@@ -0,0 +1,128 @@
+"""
+Team rosters in one aggregation.
+
+``GET /api/teams/<id>/?expand=members,recent_activities`` returns the team
+with its members embedded in place of the ``members`` email list, each
+member optionally carrying their latest activities. One aggregation
+answers it. The team is matched by ``_id``. ``$lookup`` stages fetch the
+users whose ``team`` is the team's name and the users listed in
+``members``, each stage capped at ``OCTOFIT_ROSTER_MAX_MEMBERS``. A
+nested ``$lookup`` takes the ``OCTOFIT_ROSTER_RECENT_ACTIVITIES`` latest
+activities of each member. When ``?fields=`` leaves out ``members`` the
+lookups are skipped and the team is returned without it.
+
+The lookups use the equality form with a sub-pipeline (MongoDB 5.0+), so
+they are served by the ``users.team``, ``users.email`` and
+``activities.user_email`` indexes.
+"""
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from django.http import Http404
+from rest_framework.exceptions import ValidationError
+
+from . import native, routing
+from .mongo import get_db
+from .serializers import ActivitySerializer, UserSerializer
+
+EXPAND_PARAM = 'expand'
+MEMBERS = 'members'
+RECENT_ACTIVITIES = 'recent_activities'
+EXPANSIONS = [MEMBERS, RECENT_ACTIVITIES]
+
+
+def requested_expansions(request):
+    """Return the set named in ``?expand=a,b``; recent_activities implies
+    members"""
+    value = request.query_params.get(EXPAND_PARAM, '')
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = sorted(names - set(EXPANSIONS))
+    if unknown:
+        raise ValidationError({EXPAND_PARAM: [
+            f"Unknown expansion(s): {', '.join(unknown)}. Choose from: {', '.join(EXPANSIONS)}."
+        ]})
+    if RECENT_ACTIVITIES in names:
+        names.add(MEMBERS)
+    return names
+
+
+def _projection(serializer):
+    return dict.fromkeys((source for _, source, _ in serializer.fields), 1)
+
+
+def member_pipeline(recent_activities):
+    """Sub-pipeline run on the users matched for a team"""
+    pipeline = [
+        # Same order as the users.team index: -total_points, -_id
+        {'$sort': {'total_points': -1, '_id': -1}},
+        {'$limit': getattr(settings, 'OCTOFIT_ROSTER_MAX_MEMBERS', 1000)},
+    ]
+    projection = _projection(native.document_serializer(UserSerializer))
+    if recent_activities:
+        pipeline.append({'$lookup': {
+            'from': 'activities',
+            'localField': 'email',
+            'foreignField': 'user_email',
+            'pipeline': [
+                {'$sort': {'date': -1, '_id': -1}},
+                {'$limit': getattr(settings, 'OCTOFIT_ROSTER_RECENT_ACTIVITIES', 5)},
+                {'$project': _projection(native.document_serializer(ActivitySerializer))},
+            ],
+            'as': RECENT_ACTIVITIES,
+        }})
+        projection[RECENT_ACTIVITIES] = 1
+    pipeline.append({'$project': projection})
+    return pipeline
+
+
+def roster_pipeline(team_id, expansions):
+    if MEMBERS not in expansions:
+        return [{'$match': {'_id': team_id}}]
+    members = member_pipeline(RECENT_ACTIVITIES in expansions)
+    return [
+        {'$match': {'_id': team_id}},
+        {'$lookup': {'from': 'users', 'localField': 'name', 'foreignField': 'team',
+                     'pipeline': members, 'as': 'by_team'}},
+        # members is an email array: any listed email matches
+        {'$lookup': {'from': 'users', 'localField': 'members', 'foreignField': 'email',
+                     'pipeline': members, 'as': 'listed'}},
+    ]
+
+
+def team_roster(pk, expansions, db=None):
+    """Return the team document for ``pk`` with ``members`` replaced by its
+    member documents, highest points first (when ``expansions`` has
+    members); raise Http404 if there is none"""
+    db = db if db is not None else get_db(routing.read_alias())
+    try:
+        team_id = ObjectId(str(pk))
+    except (InvalidId, TypeError):
+        raise Http404
+    team = next(db['teams'].aggregate(roster_pipeline(team_id, expansions)), None)
+    if team is None:
+        raise Http404
+    if MEMBERS not in expansions:
+        return team
+    members = {}
+    # Users listed in the team's members who moved elsewhere still appear
+    for user in team.pop('by_team') + team.pop('listed'):
+        members.setdefault(user['_id'], user)
+    team[MEMBERS] = sorted(members.values(), key=lambda user: (user.get('total_points') or 0, user['_id']),
+                           reverse=True)[:getattr(settings, 'OCTOFIT_ROSTER_MAX_MEMBERS', 1000)]
+    return team
+
+
+def roster_representation(team, team_serializer):
+    """Shape a ``team_roster`` document with the document serializers"""
+    users = native.document_serializer(UserSerializer)
+    activities = native.document_serializer(ActivitySerializer)
+    data = team_serializer.to_representation(team)
+    if MEMBERS not in team_serializer.names():
+        return data
+    data[MEMBERS] = []
+    for member in team[MEMBERS]:
+        row = users.to_representation(member)
+        if RECENT_ACTIVITIES in member:
+            row[RECENT_ACTIVITIES] = activities.many(member[RECENT_ACTIVITIES])
+        data[MEMBERS].append(row)
+    return data
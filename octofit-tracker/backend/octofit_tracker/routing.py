@@ -0,0 +1,96 @@
+"""
+Read/write splitting.
+
+When ``OCTOFIT_READ_PREFERENCE`` is not ``primary``, settings add a
+``reads`` database alias. It connects to the same replica set with that
+read preference and ``OCTOFIT_MAX_STALENESS``. Reads that can tolerate a
+few seconds of lag use it:
+
+* every read of a viewset with ``secondary_reads`` (leaderboard, workouts)
+* collection reads of the other viewsets: lists, searches, filtered lists
+
+Detail reads stay on the primary. So does every request made within
+``OCTOFIT_READ_YOUR_WRITES_SECONDS`` of the client's last successful write,
+which is remembered in a cookie; it defaults to ``OCTOFIT_MAX_STALENESS``,
+the furthest a secondary in use can be behind. Responses rendered for the
+response cache are read from the primary too, since the cache keeps them
+past any replication lag. Writes always go to the primary.
+
+Viewsets pick the alias for the request with ``route_reads``. The ORM
+follows it through ``ReadReplicaRouter``, and pymongo read paths pass
+``read_alias()`` to ``mongo.get_db``.
+"""
+import contextvars
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+READS = 'reads'
+WROTE_COOKIE = 'octofit_wrote'
+
+_read_alias = contextvars.ContextVar('octofit_read_alias', default=DEFAULT_DB_ALIAS)
+
+
+def replicas_configured():
+    return READS in settings.DATABASES
+
+
+def reporting_alias():
+    """The alias for reads that may be served by a secondary"""
+    return READS if replicas_configured() else DEFAULT_DB_ALIAS
+
+
+def read_alias():
+    """The alias the current request reads from"""
+    return _read_alias.get()
+
+
+def wrote_recently(request):
+    try:
+        return float(request.COOKIES.get(WROTE_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def request_alias(request, secondary_ok):
+    """Return the alias a read request should use; ``secondary_ok`` says
+    whether the endpoint tolerates replication lag"""
+    if secondary_ok and request.method in SAFE_METHODS and not wrote_recently(request):
+        return reporting_alias()
+    return DEFAULT_DB_ALIAS
+
+
+def route_reads(alias):
+    """Send the current context's reads to ``alias``; returns a token for
+    ``restore``"""
+    return _read_alias.set(alias)
+
+
+def restore(token):
+    _read_alias.reset(token)
+
+
+def remember_write(response):
+    """Keep the client's reads on the primary until its write has replicated"""
+    seconds = getattr(settings, 'OCTOFIT_READ_YOUR_WRITES_SECONDS', 0)
+    if seconds and replicas_configured():
+        response.set_cookie(WROTE_COOKIE, str(int(time.time() + seconds)), max_age=seconds,
+                            httponly=True, samesite='Lax')
+
+
+class ReadReplicaRouter:
+    """Database router sending ORM reads to the current request's read alias"""
+
+    def db_for_read(self, model, **hints):
+        return read_alias()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,154 @@
+"""
+Activity scoring.
+
+Points and calories follow from an activity's type, duration and distance:
+each type has a rate per minute and per kilometre for points and a rate per
+minute for calories. ``score_batch`` evaluates whole columns at once with
+NumPy. Activities created without points or calories are scored this way.
+
+``manage.py rescore`` applies the current rules to every activity. It covers
+the hot collection, a chunk at a time with one ``bulk_write`` per chunk, and
+the archived months. User and team totals and both leaderboards are rebuilt
+from the points summed in the same pass. Rollups and statistics receive the
+difference of every rescored activity.
+"""
+from itertools import islice
+
+import numpy as np
+from pymongo import UpdateOne
+
+from . import archive, changefeed, leaderboard, response_cache, rollups, stats
+from .mongo import get_db
+
+CHUNK_SIZE = 5000
+
+# activity_type (case-insensitive): (points per minute, points per km,
+# calories per minute)
+RULES = {
+    'running': (0.3, 2.0, 11.0),
+    'cycling': (0.2, 0.8, 8.0),
+    'swimming': (0.35, 8.0, 10.0),
+    'walking': (0.15, 1.0, 4.5),
+    'weightlifting': (0.3, 0.0, 6.0),
+    'yoga': (0.2, 0.0, 4.0),
+    'boxing': (0.4, 0.0, 12.0),
+    'crossfit': (0.4, 0.0, 12.0),
+}
+DEFAULT_RULE = (0.25, 1.0, 7.0)
+
+
+def score_batch(activity_types, durations, distances):
+    """Return ``(points, calories)`` int64 arrays for parallel sequences of
+    activity types, durations in minutes and distances in km (None for
+    none)"""
+    names, inverse = np.unique(np.char.lower(np.asarray(activity_types, dtype=str)), return_inverse=True)
+    rates = np.array([RULES.get(name, DEFAULT_RULE) for name in names], dtype=float).reshape(-1, 3)
+    per_minute, per_km, calories_per_minute = rates[inverse.reshape(-1)].T
+    duration = np.maximum(np.nan_to_num(np.asarray(durations, dtype=float)), 0)
+    distance = np.maximum(np.nan_to_num(np.asarray(distances, dtype=float)), 0)
+    points = np.rint(duration * per_minute + distance * per_km).astype(np.int64)
+    calories = np.rint(duration * calories_per_minute).astype(np.int64)
+    return points, calories
+
+
+def score(activity_type, duration, distance=None):
+    """Return ``(points, calories)`` for a single activity"""
+    points, calories = score_batch([activity_type], [duration], [distance])
+    return int(points[0]), int(calories[0])
+
+
+class Rescore:
+    """One pass of the current rules over every activity"""
+
+    def __init__(self, db=None, chunk_size=CHUNK_SIZE, dry_run=False):
+        self.db = db if db is not None else get_db()
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        # user_email -> points under the current rules
+        self.totals = {}
+        self.scanned = 0
+        self.changed = 0
+
+    def run(self):
+        cursor = self.db.activities.find({}, dict.fromkeys(leaderboard.ACTIVITY_FIELDS, 1))
+        cursor = cursor.sort('_id', 1).batch_size(self.chunk_size)
+        while True:
+            chunk = list(islice(cursor, self.chunk_size))
+            if not chunk:
+                break
+            self.rescore_chunk(chunk)
+        for month in archive.activities.months():
+            self.rescore_month(month)
+        if not self.dry_run:
+            leaderboard.rebuild_totals(self.totals, self.db)
+            response_cache.invalidate('activities')
+        return self
+
+    def add_totals(self, emails, points):
+        for email, value in zip(emails, points.tolist()):
+            self.totals[email] = self.totals.get(email, 0) + value
+
+    def changes(self, activities, points, calories):
+        """Return the indexes of ``activities`` whose scores change, with
+        the rollup and statistics increments that moves them"""
+        changed = np.flatnonzero(
+            (points != np.array([a['points'] or 0 for a in activities]))
+            | (calories != np.array([a['calories'] or 0 for a in activities]))
+        )
+        rollup_increments = {}
+        stats_increments = {}
+        for index in changed.tolist():
+            old = activities[index]
+            new = dict(old, points=int(points[index]), calories=int(calories[index]))
+            for increments, module in ((rollup_increments, rollups), (stats_increments, stats)):
+                module.add_activity(increments, old, -1)
+                module.add_activity(increments, new)
+        self.scanned += len(activities)
+        self.changed += len(changed)
+        return changed.tolist(), rollup_increments, stats_increments
+
+    def apply_increments(self, rollup_increments, stats_increments):
+        rollups.apply_increments(rollup_increments, self.db)
+        stats.apply_increments(stats_increments, self.db)
+
+    def rescore_chunk(self, activities):
+        points, calories = score_batch(
+            [a['activity_type'] for a in activities],
+            [a['duration'] for a in activities],
+            [a.get('distance') for a in activities],
+        )
+        self.add_totals([a['user_email'] for a in activities], points)
+        changed, rollup_increments, stats_increments = self.changes(activities, points, calories)
+        if self.dry_run or not changed:
+            return
+        updates = [
+            UpdateOne({'_id': activities[index]['_id']}, {'$set': {
+                'points': int(points[index]), 'calories': int(calories[index]),
+            }})
+            for index in changed
+        ]
+        # Shadows first, so a derived-data worker sees the new scores as
+        # already applied
+        self.db[changefeed.SHADOWS['activities']].bulk_write(updates, ordered=False)
+        self.db.activities.bulk_write(updates, ordered=False)
+        self.apply_increments(rollup_increments, stats_increments)
+
+    def rescore_month(self, month):
+        table = archive.activities.month_dataset(month).to_table()
+        columns = table.to_pydict()
+        points, calories = score_batch(columns['activity_type'], columns['duration'], columns['distance'])
+        self.add_totals(columns['user_email'], points)
+        activities = [dict(zip(columns, values)) for values in zip(*columns.values())]
+        changed, rollup_increments, stats_increments = self.changes(activities, points, calories)
+        if self.dry_run or not changed:
+            return
+        table = table.set_column(table.schema.get_field_index('points'), 'points', archive.pa.array(points))
+        table = table.set_column(table.schema.get_field_index('calories'), 'calories', archive.pa.array(calories))
+        archive.activities.rewrite_month(month, table)
+        self.apply_increments(rollup_increments, stats_increments)
+
+
+def rescore(db=None, chunk_size=CHUNK_SIZE, dry_run=False):
+    """Apply the current rules to every activity; returns the Rescore with
+    its ``scanned`` and ``changed`` counts"""
+    return Rescore(db, chunk_size, dry_run).run()
@@ -0,0 +1,88 @@
+"""
+Full-text search backed by a MongoDB ``$text`` index over a viewset's
+``search_fields``.
+
+``TextSearchFilter`` is a drop-in replacement for DRF's ``SearchFilter``:
+views keep declaring ``search_fields`` and clients keep sending
+``?search=``. Until the text index exists (see ``indexes.py``) it falls back
+to the regular ``icontains`` behaviour.
+"""
+import time
+
+from pymongo.errors import OperationFailure
+from rest_framework import filters
+
+from . import routing
+from .mongo import get_db
+
+# Relevance is exposed to the pagination and ordering code as this field
+SCORE_FIELD = 'score'
+SCORE = {'$meta': 'textScore'}
+
+# collection -> (has text index, checked at); negative answers are re-checked
+# after NEGATIVE_TTL seconds so a newly built index is picked up
+_text_indexed = {}
+NEGATIVE_TTL = 60
+
+
+def has_text_index(collection):
+    """Whether ``collection`` has a text index"""
+    known, checked_at = _text_indexed.get(collection, (False, None))
+    if known or (checked_at is not None and time.monotonic() - checked_at < NEGATIVE_TTL):
+        return known
+    indexes = get_db()[collection].index_information().values()
+    known = any(direction == 'text' for info in indexes for _, direction in info['key'])
+    _text_indexed[collection] = (known, time.monotonic())
+    return known
+
+
+def forget_text_index(collection):
+    """Drop the cached answer after the collection's indexes changed"""
+    _text_indexed.pop(collection, None)
+
+
+def text_clause(terms):
+    """Every term must match, as with SearchFilter: each is searched as a
+    quoted phrase, and ``$text`` ANDs phrases"""
+    phrases = [term.replace('"', ' ').strip() for term in terms]
+    return {'$text': {'$search': ' '.join(f'"{phrase}"' for phrase in phrases if phrase)}}
+
+
+def uses_text_search(view):
+    return any(
+        issubclass(backend, TextSearchFilter) for backend in getattr(view, 'filter_backends', [])
+    ) and bool(getattr(view, 'search_fields', None))
+
+
+class TextSearchFilter(filters.SearchFilter):
+    """
+    SearchFilter served from the collection's text index. The ORM path can
+    only apply the match as an ``_id`` list, so it keeps the view ordering;
+    the matching ids are read in ``_id`` order, ``batch_size`` at a time, so
+    large result sets are paged through the index rather than fetched in one
+    query. The native read path also orders by relevance.
+    """
+    batch_size = 1000
+
+    def matching_ids(self, collection, terms):
+        """Every ``_id`` matching ``terms``, paged by ``_id`` keyset"""
+        clause = text_clause(terms)
+        ids = []
+        while True:
+            spec = dict(clause, _id={'$gt': ids[-1]}) if ids else clause
+            batch = [document['_id'] for document in collection.find(spec, {'_id': 1})
+                     .sort('_id', 1).limit(self.batch_size)]
+            ids.extend(batch)
+            if len(batch) < self.batch_size:
+                return ids
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        collection = queryset.model._meta.db_table
+        if not terms or not self.get_search_fields(view, request) or not has_text_index(collection):
+            return super().filter_queryset(request, queryset, view)
+        try:
+            ids = self.matching_ids(get_db(routing.read_alias())[collection], terms)
+        except OperationFailure:
+            return super().filter_queryset(request, queryset, view)
+        return queryset.filter(_id__in=ids)
@@ -1,8 +1,39 @@
 from rest_framework import serializers
+from . import scoring
 from .models import User, Team, Activity, Leaderboard, Workout
 
-
-class UserSerializer(serializers.ModelSerializer):
+FIELDS_PARAM = 'fields'
+# Fields the scoring rules read
+SCORING_INPUTS = ['activity_type', 'duration', 'distance']
+
+
+def requested_fields(request, available):
+    """Return the names listed in ``?fields=a,b`` in ``available`` order, or
+    None when the parameter is absent"""
+    value = request.query_params.get(FIELDS_PARAM) if request is not None else None
+    if not value:
+        return None
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = sorted(names - set(available))
+    if unknown:
+        raise serializers.ValidationError({FIELDS_PARAM: [
+            f"Unknown field(s): {', '.join(unknown)}. Choose from: {', '.join(available)}."
+        ]})
+    return [name for name in available if name in names]
+
+
+class SparseFieldsMixin:
+    """Drop the fields a read request left out of ``?fields=``"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is not None and request.method in ('GET', 'HEAD'):
+            names = requested_fields(request, list(self.fields))
+            for name in set(self.fields) - set(names or self.fields):
+                self.fields.pop(name)
+
+
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
 
     class Meta:
@@ -13,7 +44,7 @@ class UserSerializer(serializers.ModelSerializer):
         return str(obj._id)
 
 
-class TeamSerializer(serializers.ModelSerializer):
+class TeamSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
 
     class Meta:
@@ -24,19 +55,36 @@ class TeamSerializer(serializers.ModelSerializer):
         return str(obj._id)
 
 
-class ActivitySerializer(serializers.ModelSerializer):
+class ActivitySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
 
     class Meta:
         model = Activity
         fields = ['id', 'user_email', 'user_name', 'activity_type', 'duration', 
                   'distance', 'calories', 'points', 'date', 'notes']
+        extra_kwargs = {'calories': {'required': False}, 'points': {'required': False}}
 
     def get_id(self, obj):
         return str(obj._id)
 
-
-class LeaderboardSerializer(serializers.ModelSerializer):
+    def validate(self, attrs):
+        """Score new activities posted without points or calories, and rescore
+        updates that change a scoring input; points or calories given
+        explicitly are kept"""
+        if self.instance is None:
+            rescore = 'points' not in attrs or 'calories' not in attrs
+        else:
+            rescore = any(name in attrs for name in SCORING_INPUTS)
+        if rescore:
+            inputs = {name: attrs[name] if name in attrs else getattr(self.instance, name, None)
+                      for name in SCORING_INPUTS}
+            points, calories = scoring.score(inputs['activity_type'], inputs['duration'], inputs['distance'])
+            attrs.setdefault('points', points)
+            attrs.setdefault('calories', calories)
+        return attrs
+
+
+class LeaderboardSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
 
     class Meta:
@@ -47,7 +95,15 @@ class LeaderboardSerializer(serializers.ModelSerializer):
         return str(obj._id)
 
 
-class WorkoutSerializer(serializers.ModelSerializer):
+class WindowedLeaderboardSerializer(LeaderboardSerializer):
+    window = serializers.CharField()
+    period = serializers.CharField()
+
+    class Meta(LeaderboardSerializer.Meta):
+        fields = LeaderboardSerializer.Meta.fields + ['window', 'period']
+
+
+class WorkoutSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
 
     class Meta:
@@ -55,6 +55,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'octofit_tracker.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -89,17 +90,117 @@ WSGI_APPLICATION = 'octofit_tracker.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# OCTOFIT_MONGO_HOST may be a URI, e.g. a local single-host replica set:
+# mongodb://localhost:27017/?replicaSet=rs0
+MONGO_CLIENT = {
+    'host': os.environ.get('OCTOFIT_MONGO_HOST', 'localhost'),
+    'port': 27017,
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'djongo',
         'NAME': 'octofit_db',
+        'CLIENT': MONGO_CLIENT,
+    }
+}
+
+# Read/write splitting (see octofit_tracker.routing): with a read preference
+# other than 'primary', leaderboard, workout and list/search reads use the
+# 'reads' alias, skipping secondaries more than OCTOFIT_MAX_STALENESS
+# seconds behind (90 at least, -1 for no limit). A client's reads stay on
+# the primary for OCTOFIT_READ_YOUR_WRITES_SECONDS after each of its writes,
+# as long as a secondary may lag (90 seconds without a limit).
+OCTOFIT_READ_PREFERENCE = os.environ.get('OCTOFIT_READ_PREFERENCE', 'primary')
+OCTOFIT_MAX_STALENESS = int(os.environ.get('OCTOFIT_MAX_STALENESS', 90))
+OCTOFIT_READ_YOUR_WRITES_SECONDS = OCTOFIT_MAX_STALENESS if OCTOFIT_MAX_STALENESS > 0 else 90
+
+if OCTOFIT_READ_PREFERENCE != 'primary':
+    DATABASES['reads'] = {
+        'ENGINE': 'djongo',
+        'NAME': DATABASES['default']['NAME'],
         'CLIENT': {
-            'host': 'localhost',
-            'port': 27017,
-        }
+            **MONGO_CLIENT,
+            'readPreference': OCTOFIT_READ_PREFERENCE,
+            'maxStalenessSeconds': OCTOFIT_MAX_STALENESS,
+        },
+        'TEST': {'MIRROR': 'default'},
     }
+
+DATABASE_ROUTERS = ['octofit_tracker.routing.ReadReplicaRouter']
+
+# Django REST Framework
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'octofit_tracker.pagination.KeysetPagination',
+    'PAGE_SIZE': 50,
 }
 
+# Serve list/detail reads with pymongo queries instead of djongo's SQL translation
+OCTOFIT_NATIVE_READS = True
+
+# Encode native user, activity and leaderboard reads with precompiled field
+# converters (and orjson when installed) instead of DRF serializer fields
+OCTOFIT_COMPACT_JSON = True
+
+# Create the indexes derived from the viewsets when the WSGI/ASGI app loads
+OCTOFIT_ENSURE_INDEXES_ON_STARTUP = True
+
+# 'inline' updates totals, ranks, rollups, stats and denormalized copies as
+# part of each write; 'worker' leaves them to `manage.py derived_worker` and
+# needs OCTOFIT_REDIS_URL so the worker's cache invalidations reach the web
+# processes
+OCTOFIT_DERIVED_DATA = 'inline'
+
+# Live leaderboard feed (ASGI only): seconds between reads of each board and
+# how many top entries subscribers follow
+OCTOFIT_LIVE_INTERVAL = 1.0
+OCTOFIT_LIVE_BOARD_SIZE = 100
+
+# Per-request Mongo/djongo timings in Server-Timing headers and /metrics.
+# Mongo commands slower than OCTOFIT_SLOW_QUERY_MS are logged with their
+# explain() plan to the octofit_tracker.slow_queries logger; set
+# OCTOFIT_SLOW_QUERY_SAMPLE below 1 to log only that fraction of them
+OCTOFIT_INSTRUMENTATION = True
+OCTOFIT_SLOW_QUERY_MS = 100
+OCTOFIT_SLOW_QUERY_SAMPLE = 0.1
+
+# Default for ?count= on paginated lists: 'none' (has_next only), 'estimated'
+# (collection metadata, or a per-filter count cached for
+# OCTOFIT_COUNT_CACHE_TTL seconds or until the next write) or 'exact'
+OCTOFIT_PAGINATION_COUNT = 'none'
+OCTOFIT_COUNT_CACHE_TTL = 30
+
+# Bounds of /api/teams/<id>/?expand=members,recent_activities: members
+# embedded per team and latest activities embedded per member
+OCTOFIT_ROSTER_MAX_MEMBERS = 1000
+OCTOFIT_ROSTER_RECENT_ACTIVITIES = 5
+
+# `manage.py archive_activities` moves activities older than
+# OCTOFIT_ARCHIVE_AFTER_DAYS into monthly Parquet files under
+# OCTOFIT_ARCHIVE_DIR (needs pyarrow); activity lists keep returning them
+OCTOFIT_ARCHIVE_DIR = os.environ.get('OCTOFIT_ARCHIVE_DIR', BASE_DIR / 'archive')
+OCTOFIT_ARCHIVE_AFTER_DAYS = 365
+
+# Caches
+# Set OCTOFIT_REDIS_URL (e.g. redis://localhost:6379/0) to share cached API
+# responses between workers; this needs the redis package installed.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'octofit-responses',
+        'TIMEOUT': 300,
+    },
+}
+if os.environ.get('OCTOFIT_REDIS_URL'):
+    CACHES['responses'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['OCTOFIT_REDIS_URL'],
+        'TIMEOUT': 300,
+    }
+
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOW_METHODS = ['DELETE', 'GET', 'OPTIONS', 'PATCH', 'POST', 'PUT']
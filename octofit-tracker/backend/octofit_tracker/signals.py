@@ -0,0 +1,21 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import response_cache
+from .models import User, Team, Activity, Leaderboard, Workout
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+@receiver(post_save, sender=Activity)
+@receiver(post_delete, sender=Activity)
+@receiver(post_save, sender=Leaderboard)
+@receiver(post_delete, sender=Leaderboard)
+@receiver(post_save, sender=Workout)
+@receiver(post_delete, sender=Workout)
+def invalidate_cached_responses(sender, **kwargs):
+    """Drop cached API responses and list counts built from the written
+    collection"""
+    response_cache.invalidate(sender._meta.db_table)
@@ -0,0 +1,142 @@
+"""
+Per-user activity statistics.
+
+Each user has one ``user_stats`` document holding running sums of their
+activities' duration, distance, calories and points, overall and broken
+down by activity type, ISO week and month. Activity writes ``$inc`` the
+counters, so serving a user's statistics is a single document read however
+many activities they have logged. The workout recommendation profiles of
+the users touched are refreshed along with them.
+"""
+from pymongo import ASCENDING, UpdateOne
+from rest_framework.exceptions import ValidationError
+
+from . import recommendations, response_cache, rollups
+from .mongo import get_db
+
+COLLECTION = 'user_stats'
+CHUNK_SIZE = 5000
+
+MEASURES = ['duration', 'distance', 'calories', 'points']
+# Keyed by rollups.WEEK and rollups.MONTH, spelled out because rollups may
+# still be initializing when this module is imported
+BUCKETS = {'week': 'by_week', 'month': 'by_month'}
+
+INDEXES = [
+    [('email', ASCENDING)],
+]
+
+
+def _key(value):
+    """Escape a value for use as a field name in a dotted update path"""
+    return str(value).replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+
+def _unkey(key):
+    return key.replace('%24', '$').replace('%2E', '.').replace('%25', '%')
+
+
+def _counters(activity, sign):
+    counters = {
+        'count': sign,
+        'duration': sign * (activity['duration'] or 0),
+        'calories': sign * (activity['calories'] or 0),
+        'points': sign * (activity['points'] or 0),
+    }
+    if activity.get('distance') is not None:
+        counters['distance'] = sign * activity['distance']
+        counters['distance_count'] = sign
+    return counters
+
+
+def add_activity(increments, activity, sign=1):
+    """Fold one activity into ``increments``, keyed by user email and then by
+    dotted counter path; ``sign`` is -1 to take a removed activity back out"""
+    paths = increments.setdefault(activity['user_email'], {})
+    prefixes = ['', f"by_type.{_key(activity['activity_type'])}."]
+    prefixes += [
+        f"{field}.{rollups.period_key(window, activity['date'])}." for window, field in BUCKETS.items()
+    ]
+    for name, value in _counters(activity, sign).items():
+        for prefix in prefixes:
+            paths[prefix + name] = paths.get(prefix + name, 0) + value
+
+
+def apply_increments(increments, db=None):
+    """``$inc`` a batch of ``add_activity`` increments into the stats documents"""
+    db = db if db is not None else get_db()
+    updates = []
+    for email, paths in increments.items():
+        paths = {path: value for path, value in paths.items() if value}
+        if paths:
+            updates.append(UpdateOne({'email': email}, {'$inc': paths}, upsert=True))
+    if updates:
+        db[COLLECTION].bulk_write(updates, ordered=False)
+        recommendations.refresh(increments, db)
+
+
+def summary(counters):
+    """Totals and averages of one set of counters"""
+    count = counters.get('count', 0)
+    distance_count = counters.get('distance_count', 0)
+    totals = {name: counters.get(name, 0) for name in MEASURES}
+    averages = {}
+    for name in MEASURES:
+        # Distance is averaged over the activities that recorded one
+        divisor = distance_count if name == 'distance' else count
+        averages[name] = totals[name] / divisor if divisor else None
+    return {'count': count, 'totals': totals, 'averages': averages}
+
+
+def _breakdown(groups):
+    return {
+        _unkey(key): summary(counters)
+        for key, counters in sorted((groups or {}).items())
+        if counters.get('count', 0) > 0
+    }
+
+
+def user_stats(email, bucket='month', db=None):
+    """Return a user's statistics, broken down by activity type and by
+    ``bucket`` (week or month)"""
+    if bucket not in BUCKETS:
+        raise ValidationError({'bucket': [f"Must be one of: {', '.join(BUCKETS)}."]})
+    db = db if db is not None else get_db()
+    document = db[COLLECTION].find_one(
+        {'email': email}, {'_id': 0, 'count': 1, 'distance_count': 1, 'by_type': 1,
+                           BUCKETS[bucket]: 1, **dict.fromkeys(MEASURES, 1)}
+    ) or {}
+    return dict(
+        email=email,
+        **summary(document),
+        by_type=_breakdown(document.get('by_type')),
+        bucket=bucket,
+        by_period=_breakdown(document.get(BUCKETS[bucket])),
+    )
+
+
+def rebuild(db=None):
+    """Recompute every user's statistics from the activities collection and
+    its archive, a few thousand users at a time"""
+    # Imported here: archive -> changefeed -> leaderboard imports this module
+    from . import archive
+
+    db = db if db is not None else get_db()
+    db[COLLECTION].delete_many({})
+    db[recommendations.COLLECTION].delete_many({})
+    increments = {}
+    email = None
+    activities = db.activities.find({}, {'_id': 0, 'notes': 0, 'user_name': 0})
+    for activity in activities.sort('user_email', ASCENDING).batch_size(CHUNK_SIZE):
+        if activity['user_email'] != email and len(increments) >= CHUNK_SIZE:
+            apply_increments(increments, db)
+            increments = {}
+        email = activity['user_email']
+        add_activity(increments, activity)
+    for activity in archive.activities.scan({}, ['user_email', 'activity_type', *MEASURES, 'date']):
+        if len(increments) >= CHUNK_SIZE:
+            apply_increments(increments, db)
+            increments = {}
+        add_activity(increments, activity)
+    apply_increments(increments, db)
+    response_cache.invalidate(recommendations.COLLECTION)
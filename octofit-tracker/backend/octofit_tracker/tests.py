@@ -1,9 +1,27 @@
-from django.test import TestCase
-from rest_framework.test import APITestCase, APIClient
+from django.conf import settings
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APITestCase, APIClient, APIRequestFactory
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from django.urls import reverse
+from . import (archive, compact, indexes, leaderboard, live, native, propagation, recommendations, roster,
+               response_cache, rollups, routing, scoring, search, stats)
 from .models import User, Team, Activity, Leaderboard, Workout
-from datetime import datetime
+from .mongo import get_db
+from .serializers import ActivitySerializer, LeaderboardSerializer, UserSerializer
+from .views import ActivityViewSet, LeaderboardViewSet, WorkoutViewSet
+from bson import ObjectId
+from datetime import datetime, timedelta
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+from unittest.mock import patch
 
 
 class UserAPITestCase(APITestCase):
@@ -31,6 +49,15 @@ class UserAPITestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['name'], self.user_data['name'])
 
+    def test_requests_report_query_timings(self):
+        """Test Server-Timing headers and /metrics count Mongo round trips"""
+        response = self.client.get(reverse('user-by-team'), {'team': 'Test Team'})
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('octofit_http_requests_total{method="GET",status="200",view="user-by-team"}', metrics)
+        self.assertIn('octofit_http_request_db_queries_total{view="user-by-team"}', metrics)
+
 
 class TeamAPITestCase(APITestCase):
     def setUp(self):
@@ -57,6 +84,37 @@ class TeamAPITestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['name'], self.team_data['name'])
 
+    def test_team_detail_expands_members_and_recent_activities(self):
+        """Test ?expand= embeds members (by team or listed) and their latest activities"""
+        now = datetime.now()
+        User.objects.create(name='Low', email='test1@hero.com', team='Other Team', joined_date=now, total_points=5)
+        User.objects.create(name='High', email='high@hero.com', team='Test Team', joined_date=now, total_points=50)
+        User.objects.create(name='Outsider', email='out@hero.com', team='Other Team', joined_date=now)
+        for day in range(7):
+            Activity.objects.create(user_email='high@hero.com', user_name='High', activity_type='Running',
+                                    duration=30, calories=300, points=10, date=now - timedelta(days=day))
+        url = reverse('team-detail', kwargs={'pk': self.team._id})
+
+        response = self.client.get(url, {'expand': 'recent_activities'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        members = response.data['members']
+        self.assertEqual([member['name'] for member in members], ['High', 'Low'])
+        self.assertEqual(len(members[0]['recent_activities']), 5)
+        self.assertEqual(members[0]['recent_activities'][0]['date'], ActivitySerializer().fields['date']
+                         .to_representation(Activity.objects.first().date))
+        self.assertEqual(members[1]['recent_activities'], [])
+        self.assertNotIn('recent_activities', self.client.get(url, {'expand': 'members'}).data['members'][0])
+        self.assertEqual(self.client.get(url, {'expand': 'everything'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_team_expansion_respects_sparse_fieldsets(self):
+        """Test ?fields= without members skips the member lookups"""
+        url = reverse('team-detail', kwargs={'pk': self.team._id})
+        with patch.object(roster, 'member_pipeline', wraps=roster.member_pipeline) as member_pipeline:
+            response = self.client.get(url, {'expand': 'members', 'fields': 'name,total_points'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'name': 'Test Team', 'total_points': 500})
+        member_pipeline.assert_not_called()
+
 
 class ActivityAPITestCase(APITestCase):
     def setUp(self):
@@ -93,6 +151,190 @@ class ActivityAPITestCase(APITestCase):
         response = self.client.get(url, {'user_email': 'test@hero.com'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_native_and_orm_reads_match(self):
+        """Test the native pymongo read path returns the ORM path's payload"""
+        url = reverse('activity-list')
+        params = {'user_email': 'test@hero.com', 'search': 'great'}
+        with override_settings(OCTOFIT_NATIVE_READS=False):
+            orm_response = self.client.get(url, params)
+        with override_settings(OCTOFIT_NATIVE_READS=True):
+            native_response = self.client.get(url, params)
+        self.assertEqual(native_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(native_response.json(), orm_response.json())
+        self.assertEqual(len(native_response.data['results']), 1)
+
+    def test_sparse_fieldsets(self):
+        """Test ?fields= trims both read paths and rejects unknown fields"""
+        url = reverse('activity-list')
+        params = {'fields': 'points,id'}
+        with override_settings(OCTOFIT_NATIVE_READS=False):
+            orm_response = self.client.get(url, params)
+        with override_settings(OCTOFIT_NATIVE_READS=True):
+            native_response = self.client.get(url, params)
+        self.assertEqual(native_response.json(), orm_response.json())
+        self.assertEqual(native_response.json()['results'],
+                         [{'id': str(self.activity._id), 'points': self.activity_data['points']}])
+
+        response = self.client.get(url, {'fields': 'points,bogus'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_pagination_count_modes(self):
+        """Test pages report has_next and, when asked, an estimated or exact count"""
+        url = reverse('activity-list')
+        response = self.client.get(url)
+        self.assertFalse(response.data['has_next'])
+        self.assertNotIn('count', response.data)
+
+        params = {'count': 'estimated', 'user_email': 'test@hero.com'}
+        self.assertEqual(self.client.get(url, params).data['count'], 1)
+        # Writes invalidate cached filtered counts
+        Activity.objects.create(**self.activity_data)
+        self.assertEqual(self.client.get(url, params).data['count'], 2)
+        self.assertEqual(self.client.get(url, {'count': 'exact', 'page_size': 1}).data['count'], 2)
+        self.assertEqual(self.client.get(url, {'count': 'all'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_archived_activities_are_still_listed(self):
+        """Test activities moved to the archive keep appearing in lists"""
+        Activity.objects.create(**dict(self.activity_data, activity_type='Rowing',
+                                       date=datetime.now() - timedelta(days=400)))
+        url = reverse('activity-list')
+        with tempfile.TemporaryDirectory() as archive_dir, override_settings(OCTOFIT_ARCHIVE_DIR=archive_dir):
+            call_command('archive_activities', '--older-than', '30', stdout=io.StringIO())
+            self.assertEqual(get_db()['activities'].count_documents({}), 1)
+
+            response = self.client.get(url, {'count': 'exact', 'page_size': 1})
+            self.assertEqual(response.data['count'], 2)
+            self.assertEqual([row['activity_type'] for row in response.data['results']], ['Running'])
+            response = self.client.get(response.data['next'])
+            self.assertEqual([row['activity_type'] for row in response.data['results']], ['Rowing'])
+
+    def test_archived_activities_are_searched_and_rebuilt(self):
+        """Test archived activities keep matching searches and count in rebuilt statistics"""
+        indexes.ensure_indexes()
+        Activity.objects.create(**dict(self.activity_data, notes='Hill sprints in the rain',
+                                       date=datetime.now() - timedelta(days=400)))
+        url = reverse('activity-list')
+        with tempfile.TemporaryDirectory() as archive_dir, override_settings(OCTOFIT_ARCHIVE_DIR=archive_dir):
+            call_command('archive_activities', '--older-than', '30', stdout=io.StringIO())
+            response = self.client.get(url, {'search': 'sprints rain', 'ordering': '-date'})
+            self.assertEqual([row['notes'] for row in response.data['results']], ['Hill sprints in the rain'])
+
+            stats.rebuild()
+            rollups.rebuild()
+            self.assertEqual(stats.user_stats('test@hero.com')['count'], 2)
+            self.assertEqual(sum(rollup['activities'] for rollup in get_db()[rollups.COLLECTION].find(
+                {'type': 'individual', 'email': 'test@hero.com', 'window': rollups.MONTH})), 2)
+
+    def test_async_reads_match_sync_reads(self):
+        """Test the Motor-backed async endpoints return the DRF payloads"""
+        sync_response = self.client.get(reverse('activity-list'), {'user_email': 'test@hero.com'})
+        async_response = self.client.get(reverse('async-activity-list'), {'user_email': 'test@hero.com'})
+        self.assertEqual(async_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(async_response.json()['results'], sync_response.json()['results'])
+
+        url = reverse('async-activity-detail', kwargs={'pk': str(self.activity._id)})
+        response = self.client.get(url)
+        self.assertEqual(response.json()['activity_type'], self.activity_data['activity_type'])
+
+        for params in ({'cursor': 'not-a-cursor'}, {'count': 'all'}):
+            sync_response = self.client.get(reverse('activity-list'), params)
+            async_response = self.client.get(reverse('async-activity-list'), params)
+            self.assertEqual(async_response.status_code, sync_response.status_code)
+            self.assertEqual(async_response.json(), sync_response.json())
+
+    def test_export_activities_as_ndjson_and_csv(self):
+        """Test streaming exports honour the list filters"""
+        Activity.objects.create(**dict(self.activity_data, user_email='other@hero.com'))
+        url = reverse('activity-list')
+        response = self.client.get(url, {'format': 'ndjson', 'user_email': 'test@hero.com'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['user_email'] for line in lines], ['test@hero.com'])
+
+        response = self.client.get(url, {'format': 'csv', 'ordering': 'date'})
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['activity_type'], 'Running')
+
+    def test_paginate_activities_with_cursor(self):
+        """Test walking the activity list page by page with cursors"""
+        for days in range(1, 4):
+            Activity.objects.create(**dict(self.activity_data, date=datetime.now() - timedelta(days=days)))
+        url = reverse('activity-list')
+        response = self.client.get(url, {'page_size': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertIsNone(response.data['previous'])
+        first_page = [item['id'] for item in response.data['results']]
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
+        self.assertNotIn(response.data['results'][0]['id'], first_page)
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([item['id'] for item in response.data['results']], first_page)
+
+    def test_recent_activities_validate_limit(self):
+        """Test ?limit= must be a positive integer"""
+        url = reverse('activity-recent')
+        response = self.client.get(url, {'limit': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        for limit in ('ten', '-1', '0'):
+            response = self.client.get(url, {'limit': limit})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ActivitySearchTestCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        indexes.ensure_indexes()
+        base = {
+            'user_email': 'test@hero.com',
+            'user_name': 'Test Hero',
+            'activity_type': 'Running',
+            'duration': 30,
+            'calories': 300,
+            'points': 25,
+            'date': datetime.now(),
+        }
+        Activity.objects.create(**dict(base, notes='Hill sprints in the rain'))
+        Activity.objects.create(**dict(base, activity_type='Yoga', notes='Slow stretching'))
+
+    def test_search_uses_text_index(self):
+        """Test ?search= is answered from the text index on both read paths"""
+        url = reverse('activity-list')
+        for native_reads in (True, False):
+            with override_settings(OCTOFIT_NATIVE_READS=native_reads):
+                response = self.client.get(url, {'search': 'sprints'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([item['notes'] for item in response.data['results']],
+                             ['Hill sprints in the rain'])
+
+    def test_search_requires_every_term(self):
+        """Test a multi-word search only returns activities matching all words"""
+        url = reverse('activity-list')
+        for native_reads in (True, False):
+            with override_settings(OCTOFIT_NATIVE_READS=native_reads):
+                response = self.client.get(url, {'search': 'slow sprints'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['results'], [])
+
+    def test_search_pages_text_matches(self):
+        """Test the ORM path reads every text match across id batches"""
+        url = reverse('activity-list')
+        Activity.objects.create(user_email='test@hero.com', user_name='Test Hero', activity_type='Running',
+                                duration=20, calories=200, points=15, date=datetime.now(),
+                                notes='More sprints')
+        with override_settings(OCTOFIT_NATIVE_READS=False), \
+                patch.object(search.TextSearchFilter, 'batch_size', 1):
+            response = self.client.get(url, {'search': 'sprints'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(item['notes'] for item in response.data['results']),
+                         ['Hill sprints in the rain', 'More sprints'])
+
 
 class LeaderboardAPITestCase(APITestCase):
     def setUp(self):
@@ -120,6 +362,394 @@ class LeaderboardAPITestCase(APITestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_slow_stream_subscriber_gets_a_snapshot(self):
+        """Test a full live feed queue is replaced by a snapshot"""
+        async def overflow():
+            hub = live.LeaderboardHub()
+            hub.entries['individual'] = {'1': {'id': '1', 'rank': 1}}
+            subscriber = live.Subscriber(hub, ['individual'])
+            hub.subscribers.add(subscriber)
+            for _ in range(live.QUEUE_SIZE + 1):
+                hub.publish('individual', [{'id': '1', 'rank': 1}], [])
+            return [subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize())]
+
+        events = asyncio.run(overflow())
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0][1], 'snapshot')
+        self.assertEqual(events[0][2]['entries'], [{'id': '1', 'rank': 1}])
+
+
+class LeaderboardEngineTestCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        # Not a model table, so not reset between tests
+        get_db()[rollups.COLLECTION].delete_many({})
+        get_db()[stats.COLLECTION].delete_many({})
+        now = datetime.now()
+        Team.objects.create(name='Test Team', description='A test team', created_date=now,
+                            total_points=30, members=['lead@hero.com', 'chaser@hero.com'])
+        User.objects.create(name='Lead Hero', email='lead@hero.com', team='Test Team',
+                            joined_date=now, total_points=20)
+        User.objects.create(name='Chasing Hero', email='chaser@hero.com', team='Test Team',
+                            joined_date=now, total_points=10)
+        Leaderboard.objects.create(type='individual', name='Lead Hero', email='lead@hero.com',
+                                   team='Test Team', points=20, rank=1, last_updated=now)
+        Leaderboard.objects.create(type='individual', name='Chasing Hero', email='chaser@hero.com',
+                                   team='Test Team', points=10, rank=2, last_updated=now)
+        Leaderboard.objects.create(type='team', name='Test Team', points=30, rank=1,
+                                   last_updated=now)
+        self.activity_data = {
+            'user_email': 'chaser@hero.com',
+            'user_name': 'Chasing Hero',
+            'activity_type': 'Running',
+            'duration': 30,
+            'calories': 300,
+            'points': 25,
+            'date': now,
+            'notes': '',
+        }
+
+    def test_create_activity_updates_totals_and_ranks(self):
+        """Test creating an activity moves the user up the leaderboard"""
+        response = self.client.post(reverse('activity-list'), self.activity_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(User.objects.get(email='chaser@hero.com').total_points, 35)
+        self.assertEqual(Team.objects.get(name='Test Team').total_points, 55)
+        chaser = Leaderboard.objects.get(type='individual', email='chaser@hero.com')
+        lead = Leaderboard.objects.get(type='individual', email='lead@hero.com')
+        self.assertEqual((chaser.rank, chaser.points), (1, 35))
+        self.assertEqual(lead.rank, 2)
+
+    def test_bulk_insert_reports_per_item_errors(self):
+        """Test bulk ingestion inserts valid items and updates totals once"""
+        items = [
+            dict(self.activity_data, date='2026-10-01T10:00:00Z'),
+            dict(self.activity_data, date='2026-10-02T10:00:00Z', points=5),
+            dict(self.activity_data, date='2026-10-03T10:00:00Z', duration='long'),
+        ]
+        response = self.client.post(reverse('activity-bulk'), items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data['inserted'], 2)
+        self.assertEqual(response.data['errors'],
+                         [{'index': 2, 'errors': {'duration': ['A valid integer is required.']}}])
+        self.assertEqual(Activity.objects.filter(user_email='chaser@hero.com').count(), 2)
+        self.assertEqual(User.objects.get(email='chaser@hero.com').total_points, 40)
+        chaser = Leaderboard.objects.get(type='individual', email='chaser@hero.com')
+        self.assertEqual(chaser.rank, 1)
+
+    def test_bulk_insert_matches_single_insert_validation(self):
+        """Test bulk ingestion rejects scalar bodies and coerces numeric strings"""
+        for body in (5, True, None):
+            response = self.client.post(reverse('activity-bulk'), body, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        items = [dict(self.activity_data, date='2026-10-01T10:00:00Z', duration='30', distance='4.5')]
+        response = self.client.post(reverse('activity-bulk'), items, format='json')
+        self.assertEqual(response.data['inserted'], 1)
+        activity = Activity.objects.get(user_email='chaser@hero.com')
+        self.assertEqual((activity.duration, activity.distance), (30, 4.5))
+
+    def test_windowed_leaderboards_count_only_their_period(self):
+        """Test weekly boards are built from the activities of that week"""
+        items = [
+            dict(self.activity_data, date='2026-10-14T10:00:00Z'),
+            dict(self.activity_data, date='2026-10-20T10:00:00Z', points=5),
+            dict(self.activity_data, user_email='lead@hero.com', date='2026-10-15T10:00:00Z', points=7),
+        ]
+        self.client.post(reverse('activity-bulk'), items, format='json')
+        response = self.client.get(reverse('leaderboard-individual'), {'window': 'week', 'period': '2026-W42'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(row['email'], row['points'], row['rank']) for row in response.data['results']],
+                         [('chaser@hero.com', 25, 1), ('lead@hero.com', 7, 2)])
+        response = self.client.get(reverse('leaderboard-team'), {'window': 'month', 'period': '2026-10'})
+        self.assertEqual([(row['name'], row['points']) for row in response.data['results']],
+                         [('Test Team', 37)])
+        response = self.client.get(reverse('leaderboard-list'), {'window': 'week', 'period': '2026-10'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_user_stats_follow_activity_writes(self):
+        """Test the stats endpoint reflects created and deleted activities"""
+        chaser = User.objects.get(email='chaser@hero.com')
+        url = reverse('user-stats', kwargs={'pk': chaser._id})
+        self.client.post(reverse('activity-list'), self.activity_data, format='json')
+        response = self.client.post(reverse('activity-list'),
+                                    dict(self.activity_data, activity_type='Swimming', duration=50,
+                                         distance=2.0, points=15), format='json')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(response.data['totals']['points'], 40)
+        self.assertEqual(response.data['averages']['duration'], 40)
+        self.assertEqual(response.data['averages']['distance'], 2.0)
+        self.assertEqual(response.data['by_type']['Swimming']['totals']['duration'], 50)
+
+        swim = Activity.objects.get(user_email='chaser@hero.com', activity_type='Swimming')
+        self.client.delete(reverse('activity-detail', kwargs={'pk': swim._id}))
+        response = self.client.get(url)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(list(response.data['by_type']), ['Running'])
+        self.assertIsNone(response.data['averages']['distance'])
+
+    def test_user_changes_propagate_to_copies(self):
+        """Test renaming a user and moving them to another team updates the copies"""
+        Team.objects.create(name='Other Team', description='Another team', created_date=datetime.now(),
+                            total_points=0, members=[])
+        self.client.post(reverse('activity-list'), self.activity_data, format='json')
+        chaser = User.objects.get(email='chaser@hero.com')
+        response = self.client.patch(reverse('user-detail', kwargs={'pk': chaser._id}),
+                                     {'name': 'Renamed Hero', 'team': 'Other Team'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        propagation.wait()
+        activities = Activity.objects.filter(user_email='chaser@hero.com')
+        self.assertEqual({activity.user_name for activity in activities}, {'Renamed Hero'})
+        entry = Leaderboard.objects.get(type='individual', email='chaser@hero.com')
+        self.assertEqual((entry.name, entry.team), ('Renamed Hero', 'Other Team'))
+        self.assertEqual(Team.objects.get(name='Test Team').members, ['lead@hero.com'])
+        other = Team.objects.get(name='Other Team')
+        self.assertEqual((other.members, other.total_points), (['chaser@hero.com'], 35))
+        self.assertEqual(list(propagation.find_drift()), [])
+
+    def test_propagation_survives_failed_batches(self):
+        """Test a batch failing with a non-Mongo error does not stop later propagation"""
+        url = reverse('user-detail', kwargs={'pk': User.objects.get(email='chaser@hero.com')._id})
+        with patch.object(propagation, 'propagate', side_effect=OSError('No space left on device')), \
+                self.assertLogs('octofit_tracker.propagation', 'ERROR'):
+            self.client.patch(url, {'name': 'Lost Rename'}, format='json')
+            propagation.wait()
+        self.client.patch(url, {'name': 'Renamed Hero'}, format='json')
+        propagation.wait()
+        self.assertEqual(Leaderboard.objects.get(type='individual', email='chaser@hero.com').name, 'Renamed Hero')
+
+    def test_user_changes_reach_archived_activities(self):
+        """Test renames and email changes rewrite archived activities and drift covers them"""
+        Activity.objects.create(**dict(self.activity_data, date=datetime.now() - timedelta(days=400)))
+        chaser = User.objects.get(email='chaser@hero.com')
+        with tempfile.TemporaryDirectory() as archive_dir, override_settings(OCTOFIT_ARCHIVE_DIR=archive_dir):
+            call_command('archive_activities', '--older-than', '30', stdout=io.StringIO())
+            self.client.patch(reverse('user-detail', kwargs={'pk': chaser._id}),
+                              {'name': 'Renamed Hero', 'email': 'renamed@hero.com'}, format='json')
+            propagation.wait()
+            self.assertEqual(archive.activities.group_counts(['user_email', 'user_name']),
+                             {('renamed@hero.com', 'Renamed Hero'): 1})
+
+            get_db().users.update_one({'_id': chaser._id}, {'$set': {'name': 'Quiet Rename'}})
+            drift = list(propagation.find_drift())
+            self.assertIn((propagation.ARCHIVED_ACTIVITIES, 1), [(collection, count) for collection, _, count in drift])
+            propagation.repair(drift)
+            self.assertEqual(list(propagation.find_drift()), [])
+            self.assertEqual(archive.activities.find({}, ['user_name'])[0]['user_name'], 'Quiet Rename')
+
+    def test_deleted_user_leaves_board_and_team_total(self):
+        """Test deleting a user removes their entry and their points from the team"""
+        lead = User.objects.get(email='lead@hero.com')
+        response = self.client.delete(reverse('user-detail', kwargs={'pk': lead._id}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        propagation.wait()
+        self.assertEqual([(entry.email, entry.rank) for entry in Leaderboard.objects.filter(type='individual')],
+                         [('chaser@hero.com', 1)])
+        team = Team.objects.get(name='Test Team')
+        self.assertEqual((team.members, team.total_points), (['chaser@hero.com'], 10))
+        self.assertEqual(Leaderboard.objects.get(type='team', name='Test Team').points, 10)
+
+        # A user stored without a team is consistent as it is
+        get_db().users.insert_one({'name': 'Solo Hero', 'email': 'solo@hero.com',
+                                   'joined_date': datetime.now(), 'total_points': 0})
+        self.assertEqual(list(propagation.find_drift()), [])
+
+    @override_settings(OCTOFIT_DERIVED_DATA='worker')
+    def test_derived_worker_applies_activity_changes(self):
+        """Test the worker, not the request, updates totals in worker mode"""
+        call_command('derived_worker', bootstrap=True, once=True, stdout=io.StringIO())
+        response = self.client.post(reverse('activity-list'), self.activity_data, format='json')
+        self.assertEqual(User.objects.get(email='chaser@hero.com').total_points, 10)
+        call_command('derived_worker', once=True, stdout=io.StringIO())
+        self.assertEqual(User.objects.get(email='chaser@hero.com').total_points, 35)
+        self.assertEqual(Leaderboard.objects.get(type='individual', email='chaser@hero.com').rank, 1)
+
+        self.client.delete(reverse('activity-detail', kwargs={'pk': response.data['id']}))
+        call_command('derived_worker', once=True, stdout=io.StringIO())
+        call_command('derived_worker', once=True, stdout=io.StringIO())
+        self.assertEqual(User.objects.get(email='chaser@hero.com').total_points, 10)
+
+    def test_worker_mode_needs_a_shared_response_cache(self):
+        """Test the system checks reject worker mode with a local memory cache"""
+        with override_settings(OCTOFIT_DERIVED_DATA='worker'):
+            self.assertEqual([error.id for error in response_cache.check_shared_cache(None)],
+                             ['octofit_tracker.E001'])
+        self.assertEqual(response_cache.check_shared_cache(None), [])
+
+    def test_board_lock_left_by_a_crashed_process_is_taken_over(self):
+        """Test rank moves wait for other processes only until their lease expires"""
+        locks = get_db()[leaderboard.LOCK_COLLECTION]
+        locks.delete_many({})
+        locks.insert_one({'_id': 'individual', 'owner': ObjectId(),
+                          'expires': datetime.utcnow() - timedelta(seconds=1)})
+        response = self.client.post(reverse('activity-list'), self.activity_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Leaderboard.objects.get(type='individual', email='chaser@hero.com').rank, 1)
+        self.assertIsNone(locks.find_one({'_id': 'individual'})['owner'])
+
+    def test_board_lock_lease_is_renewed_while_held(self):
+        """Test a lock held past its lease is extended rather than left to expire"""
+        locks = get_db()[leaderboard.LOCK_COLLECTION]
+        with leaderboard.board_lock(get_db(), 'team'):
+            locks.update_one({'_id': 'team'}, {'$set': {'expires': datetime.utcnow() - timedelta(seconds=1)}})
+            leaderboard.renew_leases()
+            self.assertGreater(locks.find_one({'_id': 'team'})['expires'], datetime.utcnow())
+
+    def test_delete_activity_reverts_totals_and_ranks(self):
+        """Test deleting an activity takes its points back"""
+        response = self.client.post(reverse('activity-list'), self.activity_data, format='json')
+        url = reverse('activity-detail', kwargs={'pk': response.data['id']})
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(User.objects.get(email='chaser@hero.com').total_points, 10)
+        self.assertEqual(Team.objects.get(name='Test Team').total_points, 30)
+        chaser = Leaderboard.objects.get(type='individual', email='chaser@hero.com')
+        self.assertEqual((chaser.rank, chaser.points), (2, 10))
+
+    def test_rescore_applies_rules_and_rebuilds_totals(self):
+        """Test activities posted without scores are scored and rescore rebuilds totals"""
+        data = {key: value for key, value in self.activity_data.items() if key not in ('points', 'calories')}
+        response = self.client.post(reverse('activity-list'), dict(data, distance=5.0), format='json')
+        points, calories = scoring.score('Running', 30, 5.0)
+        self.assertEqual((response.data['points'], response.data['calories']), (points, calories))
+
+        # As if the activity had been scored under older rules
+        get_db().activities.update_one({'_id': ObjectId(response.data['id'])}, {'$set': {'points': 1, 'calories': 1}})
+        call_command('rescore', stdout=io.StringIO())
+        self.assertEqual(Activity.objects.get(pk=ObjectId(response.data['id'])).points, points)
+        self.assertEqual(User.objects.get(email='chaser@hero.com').total_points, points)
+        self.assertEqual(User.objects.get(email='lead@hero.com').total_points, 0)
+        self.assertEqual(Team.objects.get(name='Test Team').total_points, points)
+        self.assertEqual(Leaderboard.objects.get(type='individual', email='chaser@hero.com').rank, 1)
+
+    def test_update_rescores_changed_inputs(self):
+        """Test updating a scoring input rescores the activity and the totals"""
+        data = {key: value for key, value in self.activity_data.items() if key not in ('points', 'calories')}
+        response = self.client.post(reverse('activity-list'), dict(data, distance=5.0), format='json')
+        url = reverse('activity-detail', kwargs={'pk': response.data['id']})
+
+        response = self.client.patch(url, {'duration': 60}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        points, calories = scoring.score('Running', 60, 5.0)
+        self.assertEqual((response.data['points'], response.data['calories']), (points, calories))
+        self.assertEqual(User.objects.get(email='chaser@hero.com').total_points, 10 + points)
+
+        response = self.client.patch(url, {'notes': 'Longer run'}, format='json')
+        self.assertEqual(response.data['points'], points)
+
+
+class ScoringTestCase(SimpleTestCase):
+    def test_batch_matches_single_scores(self):
+        """Test vectorized scoring agrees with scoring one activity at a time"""
+        activities = [('Running', 30, 5.0), ('running', 30, 5.0), ('Yoga', 60, None), ('Parkour', 20, 2.5)]
+        points, calories = scoring.score_batch(*zip(*activities))
+        self.assertEqual(list(zip(points.tolist(), calories.tolist())),
+                         [scoring.score(*activity) for activity in activities])
+        self.assertEqual(points[0], points[1])
+        self.assertEqual(scoring.score('Running', 0), (0, 0))
+
+
+class CompactSerializerTestCase(SimpleTestCase):
+    """The compact fast path against golden files written by the DRF path"""
+    golden_dir = os.path.join(os.path.dirname(__file__), 'golden')
+    documents = {
+        'users': (UserSerializer, [
+            {'_id': ObjectId('6523c0ffee00000000000001'), 'name': 'Zoë Hero', 'email': 'zoe@hero.com',
+             'team': 'Team Marvel', 'joined_date': datetime(2026, 1, 2, 3, 4, 5), 'total_points': 1200},
+            {'_id': ObjectId('6523c0ffee00000000000002'), 'name': 'No Points', 'email': 'none@hero.com',
+             'team': 'Team DC', 'joined_date': datetime(2026, 1, 2, 3, 4, 5, 678000), 'total_points': None},
+        ]),
+        'activities': (ActivitySerializer, [
+            {'_id': ObjectId('6523c0ffee00000000000003'), 'user_email': 'zoe@hero.com', 'user_name': 'Zoë Hero',
+             'activity_type': 'Running', 'duration': 30, 'distance': 5.25, 'calories': 300, 'points': 35,
+             'date': datetime(2026, 10, 1, 7, 30), 'notes': 'Quotes " and \\ and a\u2028break\n'},
+            {'_id': ObjectId('6523c0ffee00000000000004'), 'user_email': 'none@hero.com', 'user_name': 'No Points',
+             'activity_type': 'Yoga', 'duration': 45, 'distance': None, 'calories': 120, 'points': 22,
+             'date': datetime(2026, 10, 2, 18, 0, 0, 250000), 'notes': ''},
+        ]),
+        'leaderboard': (LeaderboardSerializer, [
+            {'_id': ObjectId('6523c0ffee00000000000005'), 'type': 'individual', 'name': 'Zoë Hero',
+             'email': 'zoe@hero.com', 'team': 'Team Marvel', 'points': 1200, 'rank': 1,
+             'last_updated': datetime(2026, 10, 3)},
+            {'_id': ObjectId('6523c0ffee00000000000006'), 'type': 'team', 'name': 'Team DC', 'email': None,
+             'team': None, 'points': 800, 'rank': 2, 'last_updated': datetime(2026, 10, 3, 12, 0, 1)},
+        ]),
+    }
+
+    def render_compact(self, serializer_class, documents):
+        serializer = compact.CompactSerializer(serializer_class)
+        rows = serializer.many(documents)
+        data = {'next': None, 'previous': None, 'results': rows}
+        return serializer.dumps(data, rows)
+
+    def render_drf(self, serializer_class, documents):
+        rows = native.document_serializer(serializer_class).many(documents)
+        return JSONRenderer().render({'next': None, 'previous': None, 'results': rows})
+
+    def test_compact_output_matches_golden_files(self):
+        """Test the compact path writes the golden bytes for each endpoint"""
+        for name, (serializer_class, documents) in self.documents.items():
+            with open(os.path.join(self.golden_dir, f'{name}.json'), 'rb') as golden:
+                expected = golden.read()
+            self.assertEqual(self.render_drf(serializer_class, documents), expected, name)
+            self.assertEqual(self.render_compact(serializer_class, documents), expected, name)
+
+    def test_compact_output_matches_drf_for_exponent_floats(self):
+        """Test floats the encoders write differently fall back to JSONRenderer"""
+        _, documents = self.documents['activities']
+        documents = [dict(document, distance=distance)
+                     for document, distance in zip(documents, [1e-05, 2.5e16])]
+        self.assertEqual(self.render_compact(ActivitySerializer, documents),
+                         self.render_drf(ActivitySerializer, documents))
+
+
+class ReadRoutingTestCase(SimpleTestCase):
+    """Routing decisions only; set OCTOFIT_READ_PREFERENCE and point
+    OCTOFIT_MONGO_HOST at a replica set to run the API tests on the reads alias"""
+
+    def alias(self, viewset, method='get', detail=False, cookies=None, **initkwargs):
+        request = getattr(APIRequestFactory(), method)('/')
+        request.COOKIES.update(cookies or {})
+        return viewset(detail=detail, **initkwargs).read_alias(request)
+
+    def test_reads_stay_on_the_primary_without_replicas(self):
+        if routing.READS in settings.DATABASES:
+            self.skipTest('a reads alias is configured')
+        self.assertEqual(self.alias(LeaderboardViewSet), DEFAULT_DB_ALIAS)
+
+    def test_collection_reads_use_secondaries_until_the_client_writes(self):
+        with self.settings(DATABASES={**settings.DATABASES, routing.READS: settings.DATABASES['default']}):
+            self.assertEqual(self.alias(ActivityViewSet), routing.READS)
+            self.assertEqual(self.alias(ActivityViewSet, detail=True), DEFAULT_DB_ALIAS)
+            self.assertEqual(self.alias(WorkoutViewSet, detail=True), routing.READS)
+            self.assertEqual(self.alias(ActivityViewSet, method='post'), DEFAULT_DB_ALIAS)
+
+            response = HttpResponse()
+            routing.remember_write(response)
+            cookies = {routing.WROTE_COOKIE: response.cookies[routing.WROTE_COOKIE].value}
+            self.assertEqual(self.alias(LeaderboardViewSet, cookies=cookies), DEFAULT_DB_ALIAS)
+
+            token = routing.route_reads(routing.READS)
+            try:
+                router = routing.ReadReplicaRouter()
+                self.assertEqual(router.db_for_read(Activity), routing.READS)
+                self.assertEqual(router.db_for_write(Activity), DEFAULT_DB_ALIAS)
+            finally:
+                routing.restore(token)
+
+    def test_cached_responses_are_built_from_the_primary(self):
+        with self.settings(DATABASES={**settings.DATABASES, routing.READS: settings.DATABASES['default']}):
+            self.assertEqual(self.alias(LeaderboardViewSet), routing.READS)
+            self.assertEqual(self.alias(LeaderboardViewSet, filling_cache=True), DEFAULT_DB_ALIAS)
+
+    def test_writes_pin_reads_while_secondaries_may_lag(self):
+        self.assertGreaterEqual(settings.OCTOFIT_READ_YOUR_WRITES_SECONDS, settings.OCTOFIT_MAX_STALENESS)
+        with self.settings(DATABASES={**settings.DATABASES, routing.READS: settings.DATABASES['default']}):
+            response = HttpResponse()
+            routing.remember_write(response)
+        self.assertGreaterEqual(response.cookies[routing.WROTE_COOKIE]['max-age'], settings.OCTOFIT_MAX_STALENESS)
+
 
 class WorkoutAPITestCase(APITestCase):
     def setUp(self):
@@ -153,6 +783,59 @@ class WorkoutAPITestCase(APITestCase):
         response = self.client.get(url, {'difficulty': 'Medium'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_workout_list_is_cached_until_written(self):
+        """Test cached responses, ETag revalidation and write invalidation"""
+        url = reverse('workout-list')
+        first = self.client.get(url)
+        self.assertEqual(first['X-Cache'], 'MISS')
+        second = self.client.get(url)
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.content, first.content)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Workout.objects.create(**dict(self.workout_data, name='Another Workout'))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_recommended_workouts_follow_activity_history(self):
+        """Test recommendations rank workouts like the user's recent training"""
+        get_db()[recommendations.COLLECTION].delete_many({})
+        get_db()[stats.COLLECTION].delete_many({})
+        Workout.objects.create(**dict(self.workout_data, name='Easy Stretch', difficulty='Easy',
+                                      duration=30, category='Flexibility'))
+        Workout.objects.create(**dict(self.workout_data, name='Long Run', difficulty='Hard',
+                                      duration=60, category='Cardio'))
+        url = reverse('workout-recommended')
+        activity = {'user_email': 'yogi@hero.com', 'user_name': 'Yogi', 'activity_type': 'Yoga',
+                    'duration': 30, 'date': datetime.now()}
+        self.client.post(reverse('activity-list'), activity, format='json')
+        response = self.client.get(url, {'email': 'yogi@hero.com'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['name'] for row in response.json()][:1], ['Easy Stretch'])
+        self.assertEqual(len(response.json()), 3)
+
+        # Another user's activity leaves this user's cached ranking alone
+        self.client.post(reverse('activity-list'), dict(activity, user_email='other@hero.com'), format='json')
+        self.assertEqual(self.client.get(url, {'email': 'yogi@hero.com'})['X-Cache'], 'HIT')
+
+        # New activities refresh the profile and the cached ranking
+        for _ in range(3):
+            self.client.post(reverse('activity-list'),
+                             dict(activity, activity_type='Running', duration=60, distance=12.0), format='json')
+        response = self.client.get(url, {'email': 'yogi@hero.com'})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()[0]['name'], 'Long Run')
+
+        # Workouts written without a cache invalidation, e.g. by another process
+        get_db().workouts.insert_one(dict(self.workout_data, name='Direct Insert'))
+        self.assertIn('Direct Insert', [workout['name'] for workout in recommendations.catalog()[0]])
+
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+
 
 class APIRootTestCase(APITestCase):
     def test_api_root(self):
@@ -19,6 +19,8 @@ from rest_framework import routers
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from .async_views import async_urlpatterns
+from .instrumentation import metrics_view
 from .views import (
     UserViewSet, TeamViewSet, ActivityViewSet,
     LeaderboardViewSet, WorkoutViewSet
@@ -69,5 +71,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', api_root, name='api-root'),
     path('api/', api_root, name='api-root'),
+    path('metrics', metrics_view, name='metrics'),
+    path('api/async/', include(async_urlpatterns(router))),
     path('api/', include(router.urls)),
 ]
@@ -1,15 +1,154 @@
-from rest_framework import viewsets, filters
+import types
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework import viewsets, filters, status
+from rest_framework.permissions import SAFE_METHODS
 from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from django_filters.rest_framework import DjangoFilterBackend
+from . import archive
+from . import compact
+from . import ingest
+from . import leaderboard as leaderboard_engine
+from . import native
+from . import propagation
+from . import recommendations
+from . import rollups
+from . import roster
+from . import routing
+from . import stats as activity_stats
 from .models import User, Team, Activity, Leaderboard, Workout
+from .mongo import get_db
+from .parsers import NDJSONParser
+from .renderers import CSVRenderer, NDJSONRenderer
+from .response_cache import CachedResponseMixin
+from .search import TextSearchFilter
 from .serializers import (
-    UserSerializer, TeamSerializer, ActivitySerializer,
-    LeaderboardSerializer, WorkoutSerializer
+    requested_fields, UserSerializer, TeamSerializer, ActivitySerializer,
+    LeaderboardSerializer, WindowedLeaderboardSerializer, WorkoutSerializer
 )
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class ReadPathMixin:
+    """
+    Serve list and detail reads through the ORM or, when
+    OCTOFIT_NATIVE_READS is enabled, with native pymongo queries
+    """
+    # Serve every read from secondaries, not just collection reads (see routing)
+    secondary_reads = False
+
+    def use_native_reads(self, model=None):
+        if getattr(settings, 'OCTOFIT_NATIVE_READS', False):
+            return True
+        # Only the native path reads archived documents
+        model = model or self.queryset.model
+        return archive.for_collection(model._meta.db_table) is not None
+
+    def read_alias(self, request):
+        """Collection reads (lists, searches, filtered lists) tolerate
+        replication lag; detail reads only with ``secondary_reads``.
+        Responses about to be cached never do."""
+        secondary_ok = self.secondary_reads or not self.detail
+        return routing.request_alias(request, secondary_ok and not getattr(self, 'filling_cache', False))
+
+    def initial(self, request, *args, **kwargs):
+        self.read_route = routing.route_reads(self.read_alias(request))
+        super().initial(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if getattr(self, 'read_route', None) is not None:
+            routing.restore(self.read_route)
+            self.read_route = None
+        if request.method not in SAFE_METHODS and status.is_success(response.status_code):
+            routing.remember_write(response)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    export_batch_size = 1000
+
+    def list(self, request, *args, **kwargs):
+        if not self.is_export() and not self.use_native_reads():
+            return super().list(request, *args, **kwargs)
+        serializer = self.document_serializer()
+        query = native.NativeQuery(self, request, fields=serializer.projection_fields)
+        if self.is_export():
+            return self.export_response(query, serializer)
+        return self.native_response(query, serializer)
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.use_native_reads():
+            return super().retrieve(request, *args, **kwargs)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        serializer = self.document_serializer()
+        document = native.get_document(
+            self.queryset.model, kwargs[lookup_url_kwarg], serializer.projection_fields)
+        return Response(serializer.to_representation(document))
+
+    def document_serializer(self, serializer_class=None):
+        """Shape raw documents with ``serializer_class`` (the compact fast path
+        when it is enabled for it), limited to the ``?fields=`` requested"""
+        serializer_class = serializer_class or self.get_serializer_class()
+        serializer = compact.compact_serializer(serializer_class)
+        if serializer is None:
+            serializer = native.document_serializer(serializer_class)
+        return serializer.subset(requested_fields(self.request, serializer.names()))
+
+    def is_export(self):
+        """Whether the negotiated renderer streams (?format=ndjson or csv)"""
+        return hasattr(getattr(self.request, 'accepted_renderer', None), 'stream')
+
+    def export_response(self, query, serializer):
+        """Stream every matching document from a Mongo cursor in batches"""
+        documents = query.documents(batch_size=self.export_batch_size)
+        rows = (serializer.to_representation(document) for document in documents)
+        return self.stream_response(rows, query.model._meta.db_table)
+
+    def stream_response(self, rows, name):
+        renderer = self.request.accepted_renderer
+        response = StreamingHttpResponse(
+            renderer.stream(rows), content_type=f'{renderer.media_type}; charset={renderer.charset}')
+        filename = f'{name}.{renderer.format}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    def native_response(self, query, serializer):
+        documents = query.find(self.paginator)
+        return self.documents_response(documents, serializer, paginate=self.paginator is not None)
+
+    def documents_response(self, documents, serializer, paginate=False):
+        """Respond with raw documents shaped by ``serializer``"""
+        rows = serializer.many(documents)
+        response = self.get_paginated_response(rows) if paginate else Response(rows)
+        if isinstance(serializer, compact.CompactSerializer):
+            return compact.CompactResponse(response.data, serializer, rows)
+        return response
+
+    def filtered_response(self, model=None, serializer_class=None, **conditions):
+        """Respond with the (paginated) rows of ``model`` matching ``conditions``"""
+        if self.is_export() or self.use_native_reads(model):
+            serializer = self.document_serializer(serializer_class)
+            query = native.NativeQuery(self, self.request, model, filter_request=False,
+                                       fields=serializer.projection_fields, **conditions)
+            if self.is_export():
+                return self.export_response(query, serializer)
+            return self.native_response(query, serializer)
+        model = model or self.queryset.model
+        return self.paginated_response(model.objects.filter(**conditions), serializer_class)
+
+    def paginated_response(self, queryset, serializer_class=None):
+        serializer_class = serializer_class or self.get_serializer_class()
+        context = self.get_serializer_context()
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = serializer_class(page, many=True, context=context)
+            return self.get_paginated_response(serializer.data)
+        serializer = serializer_class(queryset, many=True, context=context)
+        return Response(serializer.data)
+
+
+class UserViewSet(ReadPathMixin, viewsets.ModelViewSet):
     """
     API endpoint for users
     """
@@ -21,126 +160,241 @@ class UserViewSet(viewsets.ModelViewSet):
     ordering_fields = ['total_points', 'joined_date', 'name']
     ordering = ['-total_points']
 
+    def perform_create(self, serializer):
+        user = serializer.save()
+        propagation.enqueue(new=propagation.user_snapshot(user))
+
+    def perform_update(self, serializer):
+        old = propagation.user_snapshot(serializer.instance)
+        user = serializer.save()
+        propagation.enqueue(old, propagation.user_snapshot(user))
+
+    def perform_destroy(self, instance):
+        old = propagation.user_snapshot(instance)
+        instance.delete()
+        propagation.enqueue(old=old)
+
     @action(detail=False, methods=['get'])
     def by_team(self, request):
         """Get users grouped by team"""
         team = request.query_params.get('team', None)
         if team:
-            users = User.objects.filter(team=team)
+            return self.filtered_response(team=team)
+        return self.filtered_response()
+
+    @action(detail=True, methods=['get'])
+    def stats(self, request, pk=None):
+        """Get a user's activity totals and averages (?bucket=week|month)"""
+        if self.use_native_reads():
+            email = native.get_document(User, pk)['email']
         else:
-            users = User.objects.all()
-        serializer = self.get_serializer(users, many=True)
-        return Response(serializer.data)
+            email = self.get_object().email
+        bucket = request.query_params.get('bucket', 'month')
+        return Response(activity_stats.user_stats(email, bucket))
 
 
-class TeamViewSet(viewsets.ModelViewSet):
+class TeamViewSet(ReadPathMixin, viewsets.ModelViewSet):
     """
     API endpoint for teams
     """
     queryset = Team.objects.all()
     serializer_class = TeamSerializer
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [TextSearchFilter, filters.OrderingFilter]
     search_fields = ['name', 'description']
     ordering_fields = ['total_points', 'created_date', 'name']
     ordering = ['-total_points']
 
+    def retrieve(self, request, *args, **kwargs):
+        expansions = roster.requested_expansions(request)
+        if not expansions:
+            return super().retrieve(request, *args, **kwargs)
+        serializer = self.document_serializer()
+        if roster.MEMBERS not in serializer.names():
+            # ?fields= left members out: nothing to look up
+            expansions = set()
+        # The team, its members and their latest activities in one aggregation
+        team = roster.team_roster(kwargs[self.lookup_url_kwarg or self.lookup_field], expansions)
+        return Response(roster.roster_representation(team, serializer))
+
     @action(detail=True, methods=['get'])
     def members(self, request, pk=None):
         """Get team members"""
         team = self.get_object()
-        users = User.objects.filter(team=team.name)
-        serializer = UserSerializer(users, many=True)
-        return Response(serializer.data)
+        return self.filtered_response(User, UserSerializer, team=team.name)
 
 
-class ActivityViewSet(viewsets.ModelViewSet):
+class ActivityViewSet(ReadPathMixin, viewsets.ModelViewSet):
     """
     API endpoint for activities
     """
     queryset = Activity.objects.all()
     serializer_class = ActivitySerializer
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer, CSVRenderer]
+    filter_backends = [DjangoFilterBackend, TextSearchFilter, filters.OrderingFilter]
     filterset_fields = ['user_email', 'activity_type']
     search_fields = ['user_name', 'activity_type', 'notes']
     ordering_fields = ['date', 'points', 'duration', 'calories']
     ordering = ['-date']
 
+    def perform_create(self, serializer):
+        activity = serializer.save()
+        leaderboard_engine.record_activity_change(
+            new=leaderboard_engine.activity_snapshot(activity))
+
+    def perform_update(self, serializer):
+        old = leaderboard_engine.activity_snapshot(serializer.instance)
+        activity = serializer.save()
+        leaderboard_engine.record_activity_change(
+            old, leaderboard_engine.activity_snapshot(activity))
+
+    def perform_destroy(self, instance):
+        old = leaderboard_engine.activity_snapshot(instance)
+        instance.delete()
+        leaderboard_engine.record_activity_change(old=old)
+
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """Insert many activities from a JSON array or an NDJSON stream"""
+        records = request.data
+        # A JSON array, or the records the NDJSON parser yields
+        if not isinstance(records, (list, types.GeneratorType)):
+            return Response({'detail': 'Expected a list of activities.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        inserted, errors = ingest.ingest(records)
+        if not errors:
+            response_status = status.HTTP_201_CREATED
+        elif inserted:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({'inserted': inserted, 'errors': errors}, status=response_status)
+
     @action(detail=False, methods=['get'])
     def by_user(self, request):
         """Get activities for a specific user"""
         email = request.query_params.get('email', None)
         if email:
-            activities = Activity.objects.filter(user_email=email)
-        else:
-            activities = Activity.objects.all()
-        serializer = self.get_serializer(activities, many=True)
-        return Response(serializer.data)
+            return self.filtered_response(user_email=email)
+        return self.filtered_response()
 
     @action(detail=False, methods=['get'])
     def recent(self, request):
         """Get recent activities"""
-        limit = int(request.query_params.get('limit', 10))
+        limit = self.paginator.get_limit(request)
+        if self.use_native_reads():
+            serializer = self.document_serializer()
+            query = native.NativeQuery(self, request, filter_request=False, fields=serializer.projection_fields)
+            return self.documents_response(query.find(limit=limit, ordering=Activity._meta.ordering), serializer)
         activities = Activity.objects.all()[:limit]
         serializer = self.get_serializer(activities, many=True)
         return Response(serializer.data)
 
 
-class LeaderboardViewSet(viewsets.ReadOnlyModelViewSet):
+class LeaderboardViewSet(CachedResponseMixin, ReadPathMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for leaderboard (read-only)
     """
     queryset = Leaderboard.objects.all()
     serializer_class = LeaderboardSerializer
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer, CSVRenderer]
+    secondary_reads = True
+    cache_collections = ['leaderboard']
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['type', 'team']
     ordering_fields = ['rank', 'points']
     ordering = ['rank']
 
+    def list(self, request, *args, **kwargs):
+        if 'window' in request.query_params:
+            return self.window_response()
+        return super().list(request, *args, **kwargs)
+
     @action(detail=False, methods=['get'])
     def individual(self, request):
         """Get individual leaderboard"""
-        leaderboard = Leaderboard.objects.filter(type='individual')
-        serializer = self.get_serializer(leaderboard, many=True)
-        return Response(serializer.data)
+        if 'window' in request.query_params:
+            return self.window_response('individual')
+        return self.filtered_response(type='individual')
 
     @action(detail=False, methods=['get'])
     def team(self, request):
         """Get team leaderboard"""
-        leaderboard = Leaderboard.objects.filter(type='team')
-        serializer = self.get_serializer(leaderboard, many=True)
-        return Response(serializer.data)
+        if 'window' in request.query_params:
+            return self.window_response('team')
+        return self.filtered_response(type='team')
 
+    def window_response(self, board=None):
+        """Rank a day, week or month board (?window=week&period=2026-W42)
+        from its rollups"""
+        spec = rollups.board_filter(self.request.query_params, board)
+        collection = get_db(routing.read_alias())[rollups.COLLECTION]
+        serializer = self.document_serializer(WindowedLeaderboardSerializer)
+        fields = serializer.projection_fields
+        # ranked() positions a page by the points of its first row
+        projection = dict.fromkeys([*fields, 'points'], 1) if fields is not None else None
+        ordering = ['-points', '-_id']
+        if self.is_export():
+            documents = collection.find(spec, projection).sort(native.to_sort(ordering))
+            documents = documents.batch_size(self.export_batch_size)
+            rows = (
+                serializer.to_representation(dict(document, rank=rank))
+                for rank, document in enumerate(documents, 1)
+            )
+            return self.stream_response(rows, f"leaderboard-{spec['window']}-{spec['period']}")
+        if self.paginator is None:
+            documents = list(collection.find(spec, projection).sort(native.to_sort(ordering)))
+            return Response(serializer.many(rollups.ranked(collection, spec, documents)))
+        documents = self.paginator.paginate_collection(
+            collection, spec, self.request, ordering, fields=fields)
+        documents = rollups.ranked(collection, spec, documents, self.paginator)
+        return self.get_paginated_response(serializer.many(documents))
 
-class WorkoutViewSet(viewsets.ReadOnlyModelViewSet):
+
+class WorkoutViewSet(CachedResponseMixin, ReadPathMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for workout suggestions (read-only)
     """
     queryset = Workout.objects.all()
     serializer_class = WorkoutSerializer
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    secondary_reads = True
+    cache_collections = ['workouts']
+    filter_backends = [DjangoFilterBackend, TextSearchFilter, filters.OrderingFilter]
     filterset_fields = ['difficulty', 'category']
     search_fields = ['name', 'description', 'category']
     ordering_fields = ['duration', 'difficulty', 'name']
     ordering = ['name']
 
+    def get_cache_collections(self, request):
+        if getattr(self, 'action_map', {}).get(request.method.lower()) == 'recommended':
+            # Every profile (a stats rebuild), then the requested user's
+            email = request.GET.get('email', '')
+            return [*self.cache_collections, recommendations.COLLECTION, recommendations.cache_collection(email)]
+        return self.cache_collections
+
+    @action(detail=False, methods=['get'])
+    def recommended(self, request):
+        """Get workouts ranked by similarity to a user's activities (?email=)"""
+        limit = self.paginator.get_limit(request)
+        workouts = recommendations.recommend(
+            request.query_params.get('email'), limit, get_db(routing.read_alias()))
+        serializer = self.document_serializer()
+        rows = serializer.many(workouts)
+        for row, workout in zip(rows, workouts):
+            row['score'] = workout['score']
+        return Response(rows)
+
     @action(detail=False, methods=['get'])
     def by_difficulty(self, request):
         """Get workouts by difficulty level"""
         difficulty = request.query_params.get('difficulty', None)
         if difficulty:
-            workouts = Workout.objects.filter(difficulty=difficulty)
-        else:
-            workouts = Workout.objects.all()
-        serializer = self.get_serializer(workouts, many=True)
-        return Response(serializer.data)
+            return self.filtered_response(difficulty=difficulty)
+        return self.filtered_response()
 
     @action(detail=False, methods=['get'])
     def by_category(self, request):
         """Get workouts by category"""
         category = request.query_params.get('category', None)
         if category:
-            workouts = Workout.objects.filter(category=category)
-        else:
-            workouts = Workout.objects.all()
-        serializer = self.get_serializer(workouts, many=True)
-        return Response(serializer.data)
+            return self.filtered_response(category=category)
+        return self.filtered_response()
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'octofit_tracker.settings')
 
 application = get_wsgi_application()
+
+from octofit_tracker.indexes import ensure_indexes_on_startup  # noqa: E402
+
+ensure_indexes_on_startup()